@@ -25,18 +25,145 @@ except PackageNotFoundError:
     pass
 
 
+DEFAULT_API_URL = "https://api.openweathermap.org/data"
 DEFAULT_FILE_PATH_LOCATION = "weather-forecasts"
 DEFAULT_DATA_SOURCE_NAME = "OpenWeatherMap"
 DEFAULT_WEATHER_STATION_NAME = "weather station (created by FM-OWM)"
 WEATHER_STATION_TYPE_NAME = "weather station"
 DEFAULT_MAXIMAL_DEGREE_LOCATION_DISTANCE = 1
+DEFAULT_CONNECT_TIMEOUT = 5  # seconds
+DEFAULT_READ_TIMEOUT = 30  # seconds
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 1  # seconds
+DEFAULT_MAX_BACKOFF = 60  # seconds
+DEFAULT_CONNECTION_POOL_SIZE = 10
+DEFAULT_CALLS_PER_MINUTE = 60  # limit of the free tier
+DEFAULT_CALLS_PER_DAY = 1000  # limit of the free tier
+DEFAULT_API_KEY_SUSPENSION = 5 * 60  # seconds
+DEFAULT_CLEAR_SKY_CACHE_SIZE = 100_000
+DEFAULT_CLEAR_SKY_CACHE_TTL = (
+    2 * 24 * 60 * 60
+)  # seconds, forecasts reach 48 hours ahead
+DEFAULT_CLEAR_SKY_CACHE_PRECISION = 2  # decimals of latitude & longitude, roughly 1 km
+DEFAULT_RESPONSE_CACHE_TTL = 0  # seconds, i.e. switched off
+DEFAULT_RESPONSE_CACHE_PRECISION = 2  # decimals of latitude & longitude, roughly 1 km
+DEFAULT_RESPONSE_CACHE_FILE_NAME = "owm-response-cache.sqlite"
+DEFAULT_COMPACTION_AGE = 7  # days
+DEFAULT_COMPACTION_KEEP_HORIZONS = (1, 6, 24)  # hours
+DEFAULT_COMPACTION_BATCH_SIZE = 10_000  # beliefs per DELETE (and transaction)
+DEFAULT_REGISTRATION_BATCH_SIZE = 1000  # locations (or stations) per lookup query
+DEFAULT_SERVE_INTERVAL = 60 * 60  # seconds
+DEFAULT_SERVE_SENSOR_INDEX_TTL = 60 * 60  # seconds
+DEFAULT_LOCATIONS_PER_JOB = 10
+DEFAULT_JOB_TIMEOUT = 10 * 60  # seconds
+DEFAULT_JOBS_WAIT_TIMEOUT = 60 * 60  # seconds
 
 __version__ = "0.1"
 __settings__ = {
     "OPENWEATHERMAP_API_KEY": dict(
-        description="You can generate this token after you made an account at OpenWeatherMap.",
+        description="You can generate this token after you made an account at OpenWeatherMap. To spread calls over several keys, give a list of keys (each a string, or a dict with 'key' and optionally its own 'calls_per_minute' and 'calls_per_day').",
         level="error",
     ),
+    "OPENWEATHERMAP_API_KEY_SUSPENSION": dict(
+        description=f"Seconds for which we stop using an API key from a list of keys after OpenWeatherMap rejected it (status 401 or 429 without Retry-After), defaults to {DEFAULT_API_KEY_SUSPENSION}",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_API_URL": dict(
+        description=f"Base URL of the OpenWeatherMap API (e.g. to use a local stub server for benchmarks), defaults to '{DEFAULT_API_URL}'",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_CONNECT_TIMEOUT": dict(
+        description=f"Seconds to wait for a connection to the OpenWeatherMap API, defaults to {DEFAULT_CONNECT_TIMEOUT}",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_READ_TIMEOUT": dict(
+        description=f"Seconds to wait for a response from the OpenWeatherMap API, defaults to {DEFAULT_READ_TIMEOUT}",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_MAX_RETRIES": dict(
+        description=f"How often to retry a failed call to the OpenWeatherMap API (e.g. after status 429 or 5xx), defaults to {DEFAULT_MAX_RETRIES}",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_BACKOFF_FACTOR": dict(
+        description=f"Base of the exponential backoff between retries (in seconds, jittered), defaults to {DEFAULT_BACKOFF_FACTOR}",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_MAX_BACKOFF": dict(
+        description=f"Maximum backoff between retries (in seconds), defaults to {DEFAULT_MAX_BACKOFF}",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_CONNECTION_POOL_SIZE": dict(
+        description=f"Number of connections to the OpenWeatherMap API to keep alive for re-use, defaults to {DEFAULT_CONNECTION_POOL_SIZE}",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_CALLS_PER_MINUTE": dict(
+        description=f"Maximal number of calls to the OpenWeatherMap API per minute (None for no limit, only used with OPENWEATHERMAP_CALL_BUDGET_FILE), defaults to {DEFAULT_CALLS_PER_MINUTE}",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_CALLS_PER_DAY": dict(
+        description=f"Maximal number of calls to the OpenWeatherMap API per UTC day (None for no limit, only used with OPENWEATHERMAP_CALL_BUDGET_FILE), defaults to {DEFAULT_CALLS_PER_DAY}",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_CALL_BUDGET_FILE": dict(
+        description="SQLite file in which the call budget is kept (shared by all runs, so it needs to be writable by all of them). Calls are only limited if this is set. Absolute path.",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_CLEAR_SKY_CACHE_SIZE": dict(
+        description=f"Number of clear-sky irradiance values to cache (0 switches the cache off), defaults to {DEFAULT_CLEAR_SKY_CACHE_SIZE}",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_CLEAR_SKY_CACHE_TTL": dict(
+        description=f"Seconds to keep cached clear-sky irradiance values, defaults to {DEFAULT_CLEAR_SKY_CACHE_TTL}",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_CLEAR_SKY_CACHE_PRECISION": dict(
+        description=f"Decimals to which locations are rounded for caching clear-sky irradiance, defaults to {DEFAULT_CLEAR_SKY_CACHE_PRECISION}",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_CLEAR_SKY_CACHE_FILE": dict(
+        description="File to persist cached clear-sky irradiance values in, between runs (not persisted by default). Absolute path.",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_RESPONSE_CACHE_TTL": dict(
+        description=f"Seconds for which a response from OpenWeatherMap is re-used for the same (rounded) location, defaults to {DEFAULT_RESPONSE_CACHE_TTL} (no caching)",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_RESPONSE_CACHE_PRECISION": dict(
+        description=f"Decimals to which locations are rounded for caching responses, defaults to {DEFAULT_RESPONSE_CACHE_PRECISION}",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_RESPONSE_CACHE_FILE": dict(
+        description=f"SQLite file in which responses are cached (shared by all runs), defaults to '{DEFAULT_RESPONSE_CACHE_FILE_NAME}' in the folder for JSON files",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_CHANGE_TOLERANCES": dict(
+        description="How much new forecasts may differ from the latest stored ones and still be skipped as unchanged, per sensor name (e.g. {'temperature': 0.1}). A sensor's owm_change_tolerance attribute takes precedence. Defaults to 0 (only equal values are skipped).",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_GRID_RESOLUTION": dict(
+        description="Resolution (in degrees) of the grid to which locations are snapped before calling OpenWeatherMap when storing JSON files, so that close-by locations share one call. Not set by default.",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_METRICS_DIR": dict(
+        description="Directory to write the metrics of each run to, in the Prometheus text format (e.g. for the textfile collector of the node exporter), as one <run>.prom file per run name (e.g. serve-<region>). Not written by default. Absolute path.",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_SERVE_SCHEDULE": dict(
+        description=f"What the serve command gets forecasts for: a list of regions, each a dict with 'region', 'location' (as for get-weather-forecasts, with optional 'num_cells' and 'method') or 'asset_id', and optionally 'interval' (in seconds, defaults to {DEFAULT_SERVE_INTERVAL}), 'store_as' and 'max_concurrency'",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_SERVE_SENSOR_INDEX_TTL": dict(
+        description=f"Seconds after which the serve command reloads the weather sensors (to notice new ones), defaults to {DEFAULT_SERVE_SENSOR_INDEX_TTL}",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_JOB_TIMEOUT": dict(
+        description=f"Seconds a worker may spend on one job of get-weather-forecasts --as-jobs, defaults to {DEFAULT_JOB_TIMEOUT}",
+        level="debug",
+    ),
+    "OPENWEATHERMAP_JOBS_WAIT_TIMEOUT": dict(
+        description=f"Seconds get-weather-forecasts --as-jobs waits for all its jobs to be done, defaults to {DEFAULT_JOBS_WAIT_TIMEOUT}",
+        level="debug",
+    ),
     "OPENWEATHERMAP_FILE_PATH_LOCATION": dict(
         description="Location of JSON files (if you store weather data in this form). Absolute path.",
         level="debug",
@@ -1,27 +1,47 @@
+import json
+from datetime import timedelta
+
 from flask import current_app
 
 from flask.cli import with_appcontext
 import click
 from flexmeasures.data.models.time_series import Sensor
+from flexmeasures.utils.time_utils import get_timezone, server_now
 
 from flexmeasures.data.transactional import task_with_status_report
 from flexmeasures.data.config import db
 
-from .. import flexmeasures_openweathermap_bp
+from .. import (
+    flexmeasures_openweathermap_bp,
+    DEFAULT_COMPACTION_AGE,
+    DEFAULT_COMPACTION_KEEP_HORIZONS,
+    DEFAULT_COMPACTION_BATCH_SIZE,
+    DEFAULT_REGISTRATION_BATCH_SIZE,
+    DEFAULT_LOCATIONS_PER_JOB,
+)
 from .schemas.weather_sensor import WeatherSensorSchema
 from ..utils.modeling import (
     get_or_create_weather_station,
     get_weather_station_by_asset_id,
+    make_weather_sensor,
 )
-from ..utils.locating import get_locations, get_location_by_asset_id
-from ..utils.filing import make_file_path
-from ..utils.owm import (
-    save_forecasts_in_db,
-    save_forecasts_as_json,
-    get_supported_sensor_spec,
+from ..utils.locating import (
+    get_locations,
+    get_locations_by_asset_ids,
+    get_weather_sensors,
+    get_weather_station_locations,
 )
+from ..utils.registering import read_locations_from_csv, register_weather_sensors
+from ..utils.filing import make_file_path
+from ..utils.instrumenting import start_run_metrics, export_run_metrics
+from ..utils.profiling import profiling_options
 from ..sensor_specs import mapping
 
+"""
+FlexMeasures loads this module for every CLI call (and worker start-up), so we keep its imports light.
+Utils which pull in heavy dependencies (e.g. pvlib, requests and humanize via utils.owm) are imported within the commands which need them.
+"""
+
 """
 TODO: allow to also pass an asset ID or name for the weather station (instead of location) to both commands?
       See https://github.com/SeitaBV/flexmeasures-openweathermap/issues/2
@@ -62,6 +82,7 @@ supported_sensors_list = ", ".join(
     default="UTC",
     help="The timezone of the sensor data as string, e.g. 'UTC' (default) or 'Europe/Amsterdam'",
 )
+@profiling_options("register-weather-sensor")
 def add_weather_sensor(**args):
     """
     Add a weather sensor.
@@ -94,14 +115,7 @@ def add_weather_sensor(**args):
             f"[FLEXMEASURES-OWM] A '{args['name']}' weather sensor already exists at this weather station (the station's ID is {weather_station.id})."
         )
         return
-    fm_sensor_specs = get_supported_sensor_spec(args["name"])
-    fm_sensor_specs["generic_asset"] = weather_station
-    fm_sensor_specs["timezone"] = args["timezone"]
-    fm_sensor_specs["name"] = fm_sensor_specs.pop("fm_sensor_name")
-    fm_sensor_specs.pop("owm_sensor_name")
-    sensor = Sensor(**fm_sensor_specs)
-    sensor.attributes = fm_sensor_specs["attributes"]
-
+    sensor = make_weather_sensor(args["name"], weather_station, args["timezone"])
     db.session.add(sensor)
     db.session.commit()
     click.echo(
@@ -112,6 +126,90 @@ def add_weather_sensor(**args):
     )
 
 
+@flexmeasures_openweathermap_bp.cli.command("register-weather-sensors")
+@with_appcontext
+@click.option(
+    "--csv",
+    "csv_path",
+    type=click.Path(exists=True, dir_okay=False),
+    required=False,
+    help="CSV file with the locations of the weather stations (in a 'latitude' and a 'longitude' column).",
+)
+@click.option(
+    "--location",
+    type=str,
+    required=False,
+    help="Location(s) of the weather stations, as for get-weather-forecasts (see the --num_cells and --method parameters for grids)."
+    " If present, --csv will be ignored.",
+)
+@click.option(
+    "--num_cells",
+    type=int,
+    default=1,
+    help="Number of cells on the grid. Only used if a region of interest has been mapped in the location parameter. Defaults to 1.",
+)
+@click.option(
+    "--method",
+    default="hex",
+    type=click.Choice(["hex", "square"]),
+    help="Grid creation method. Only used if a region of interest has been mapped in the location parameter.",
+)
+@click.option(
+    "--name",
+    "names",
+    multiple=True,
+    help=f"Name of a sensor to register at each weather station (can be given several times). Defaults to all supported sensors ({supported_sensors_list})",
+)
+@click.option(
+    "--timezone",
+    default="UTC",
+    help="The timezone of the sensor data as string, e.g. 'UTC' (default) or 'Europe/Amsterdam'",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_REGISTRATION_BATCH_SIZE,
+    help=f"Number of locations (or weather stations) to look up per query. Defaults to {DEFAULT_REGISTRATION_BATCH_SIZE}.",
+)
+@profiling_options("register-weather-sensors")
+def add_weather_sensors(
+    csv_path, location, num_cells, method, names, timezone, batch_size
+):
+    """
+    Add weather sensors at many locations at once, e.g. to cover a region with weather stations.
+    This creates a weather station at each location where none exists yet, and the sensors it does not have yet.
+    Everything is saved in one transaction.
+    """
+    if location is not None:
+        locations = get_locations(location, num_cells, method)
+    elif csv_path is not None:
+        locations = read_locations_from_csv(csv_path)
+    else:
+        raise Exception(
+            "Arguments are missing to register weather sensors. Provide either '--location' or '--csv'."
+        )
+    names = list(names) or [
+        str(sensor_specs["fm_sensor_name"]) for sensor_specs in mapping
+    ]
+
+    schema = WeatherSensorSchema()
+    errors = {}
+    for args in [dict(name=name, timezone=timezone) for name in names] + [
+        dict(name=names[0], latitude=latitude, longitude=longitude)
+        for latitude, longitude in locations
+    ]:
+        for field_name, messages in schema.validate(args).items():
+            errors[f"{field_name} {args[field_name]}"] = messages
+    if errors:
+        click.echo(
+            f"[FLEXMEASURES-OWM] Please correct the following errors:\n{errors}.\n Use the --help flag to learn more."
+        )
+        raise click.Abort
+
+    register_weather_sensors(locations, names, timezone, batch_size)
+    db.session.commit()
+
+
 @flexmeasures_openweathermap_bp.cli.command("get-weather-forecasts")
 @with_appcontext
 @click.option(
@@ -125,15 +223,29 @@ def add_weather_sensor(**args):
 )
 @click.option(
     "--asset-id",
+    "asset_ids",
     type=int,
-    required=False,
-    help="ID of a weather station asset - forecasts will be gotten for its location. If present, --location will be ignored.",
+    multiple=True,
+    help="ID of a weather station asset - forecasts will be gotten for its location (can be given several times). If present, --location will be ignored.",
+)
+@click.option(
+    "--all-stations",
+    is_flag=True,
+    default=False,
+    help="Get forecasts for the locations of all weather stations with weather sensors. If present, --asset-id and --location will be ignored.",
 )
 @click.option(
     "--store-in-db/--store-as-json-files",
     default=True,
     help="Store forecasts in the database, or simply save as json files (defaults to database).",
 )
+@click.option(
+    "--store-as",
+    type=click.Choice(["db", "json", "parquet"]),
+    required=False,
+    help="Store forecasts in the database, as json files or append them to a compressed columnar archive (Parquet files per day, requires pyarrow)."
+    " If present, --store-in-db/--store-as-json-files will be ignored.",
+)
 @click.option(
     "--num_cells",
     type=int,
@@ -150,36 +262,332 @@ def add_weather_sensor(**args):
     "--region",
     type=str,
     default="",
-    help="Name of the region (will create sub-folder if you store json files).",
+    help="Name of the region (will create sub-folder if you store json files or archive them).",
+)
+@click.option(
+    "--max-concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Maximum number of locations for which OpenWeatherMap is called in parallel. Defaults to 1 (one location after another).",
+)
+@click.option(
+    "--as-jobs",
+    is_flag=True,
+    default=False,
+    help="Let FlexMeasures workers of the forecasting queue get and store the forecasts, in jobs for a few locations each, and wait for them.",
+)
+@click.option(
+    "--locations-per-job",
+    type=click.IntRange(min=1),
+    default=DEFAULT_LOCATIONS_PER_JOB,
+    help=f"Number of locations per job (with --as-jobs). Defaults to {DEFAULT_LOCATIONS_PER_JOB}.",
 )
+@profiling_options("get-weather-forecasts")
 @task_with_status_report("get-openweathermap-forecasts")
-def collect_weather_data(location, asset_id, store_in_db, num_cells, method, region):
+def collect_weather_data(
+    location,
+    asset_ids,
+    all_stations,
+    store_in_db,
+    store_as,
+    num_cells,
+    method,
+    region,
+    max_concurrency,
+    as_jobs,
+    locations_per_job,
+):
     """
     Collect weather forecasts from the OpenWeatherMap API.
     This will be done for one or more locations, for which we first identify relevant weather stations.
 
     This function can get weather data for one location or for several locations within
     a geometrical grid (See the --location parameter).
+
+    With --as-jobs, the work is spread over the workers of the forecasting queue (which can run on several machines),
+    and this run succeeds if all jobs succeed.
     """
+    from ..utils.owm import save_forecasts, get_api_key, load_weather_sensor_index
 
-    api_key = str(current_app.config.get("OPENWEATHERMAP_API_KEY", ""))
-    if api_key == "":
-        raise Exception(
-            "[FLEXMEASURES-OWM] Setting OPENWEATHERMAP_API_KEY not available."
-        )
-    if asset_id is not None:
-        locations = [get_location_by_asset_id(asset_id)]
+    sensor_index = None
+    if all_stations:
+        # one query for all weather stations and their sensors, which we also use to look up sensors
+        sensors = get_weather_sensors()
+        locations = get_weather_station_locations(sensors)
+        sensor_index = load_weather_sensor_index(sensors)
+    elif asset_ids:
+        locations = get_locations_by_asset_ids(list(asset_ids))
     elif location is not None:
         locations = get_locations(location, num_cells, method)
     else:
         raise Warning(
-            "[FLEXMEASURES-OWM] Pass either location or asset-id to get weather forecasts."
+            "[FLEXMEASURES-OWM] Pass location, asset-id or all-stations to get weather forecasts."
         )
 
     # Save the results
-    if store_in_db:
-        save_forecasts_in_db(api_key, locations)
-    else:
-        save_forecasts_as_json(
-            api_key, locations, data_path=make_file_path(current_app, region)
+    if store_as is None:
+        store_as = "db" if store_in_db else "json"
+    metrics = start_run_metrics("get-weather-forecasts")
+    try:
+        with metrics.measure("total"):
+            if as_jobs:
+                from ..utils.distributing import save_forecasts_with_jobs
+
+                save_forecasts_with_jobs(
+                    locations,
+                    locations_per_job,
+                    store_as=store_as,
+                    region=region,
+                    max_concurrency=max_concurrency,
+                    sensor_index=sensor_index,
+                )
+            else:
+                save_forecasts(
+                    get_api_key(),
+                    locations,
+                    store_as=store_as,
+                    region=region,
+                    max_concurrency=max_concurrency,
+                    sensor_index=sensor_index,
+                )
+    finally:
+        export_run_metrics(metrics)
+
+
+@flexmeasures_openweathermap_bp.cli.command("serve")
+@with_appcontext
+@click.option(
+    "--region",
+    "regions",
+    type=str,
+    multiple=True,
+    help="Only serve this region of the OPENWEATHERMAP_SERVE_SCHEDULE setting (can be given several times). Defaults to all regions.",
+)
+def serve_command(regions):
+    """
+    Keep collecting weather forecasts, for each region in the OPENWEATHERMAP_SERVE_SCHEDULE setting at its own interval.
+    Unlike calling get-weather-forecasts from cron, this keeps the database connections, the HTTP session,
+    the weather sensors and cached irradiance values around between runs.
+    Stops gracefully (after the current run) on SIGTERM or SIGINT.
+    """
+    from ..utils.owm import get_api_key
+    from ..utils.serving import load_schedule, serve_forecasts
+
+    schedule = load_schedule(
+        current_app.config.get("OPENWEATHERMAP_SERVE_SCHEDULE", []), regions
+    )
+    serve_forecasts(schedule, get_api_key())
+
+
+@flexmeasures_openweathermap_bp.cli.command("ingest-json-archive")
+@with_appcontext
+@click.option(
+    "--path",
+    type=click.Path(exists=True, file_okay=False),
+    required=False,
+    help="Folder with archived JSON files (as stored by get-weather-forecasts --store-as-json-files). Defaults to where these are stored.",
+)
+@click.option(
+    "--region",
+    type=str,
+    default=None,
+    help="Only ingest files from this region (sub-folder). Defaults to all regions.",
+)
+@click.option(
+    "--start",
+    type=click.DateTime(),
+    default=None,
+    help="Only ingest files from runs at or after this time (in server time).",
+)
+@click.option(
+    "--end",
+    type=click.DateTime(),
+    default=None,
+    help="Only ingest files from runs at or before this time (in server time).",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Number of worker processes to parse files with. Defaults to the number of CPUs.",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=500,
+    help="Number of files after which we save (and commit) their forecasts. Defaults to 500.",
+)
+@task_with_status_report("ingest-openweathermap-json-archive")
+def ingest_json_archive_command(path, region, start, end, workers, batch_size):
+    """
+    Save forecasts from archived JSON files into the database.
+    Forecasts are stored for the weather sensors closest to the location of each file,
+    with the time of the run as belief time.
+    """
+    from ..utils.ingesting import ingest_json_archive
+
+    if path is None:
+        path = make_file_path(current_app, "")
+    timezone = get_timezone()
+    metrics = start_run_metrics("ingest-json-archive")
+    try:
+        with metrics.measure("total"):
+            num_files = ingest_json_archive(
+                path,
+                region=region,
+                start=timezone.localize(start) if start is not None else None,
+                end=timezone.localize(end) if end is not None else None,
+                max_workers=workers,
+                batch_size=batch_size,
+            )
+    finally:
+        export_run_metrics(metrics)
+    click.echo(f"[FLEXMEASURES-OWM] Ingested {num_files} archived JSON files.")
+
+
+@flexmeasures_openweathermap_bp.cli.command("compact-forecasts")
+@with_appcontext
+@click.option(
+    "--older-than",
+    type=click.IntRange(min=0),
+    default=DEFAULT_COMPACTION_AGE,
+    help=f"Only compact forecasts for events which lie more than this many days in the past. Defaults to {DEFAULT_COMPACTION_AGE}.",
+)
+@click.option(
+    "--keep-horizon",
+    "keep_horizons",
+    type=click.IntRange(min=1),
+    multiple=True,
+    default=DEFAULT_COMPACTION_KEEP_HORIZONS,
+    help="Besides the latest forecast for each event, keep the latest one made at least this many hours ahead (can be given several times)."
+    f" Defaults to {', '.join(str(h) for h in DEFAULT_COMPACTION_KEEP_HORIZONS)}.",
+)
+@click.option(
+    "--sensor-id",
+    "sensor_ids",
+    type=int,
+    multiple=True,
+    help="Only compact forecasts for this weather sensor (can be given several times). Defaults to all weather sensors.",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=DEFAULT_COMPACTION_BATCH_SIZE,
+    help=f"Number of forecasts to delete per transaction. Defaults to {DEFAULT_COMPACTION_BATCH_SIZE}.",
+)
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="Only report how many forecasts would be deleted.",
+)
+@task_with_status_report("compact-openweathermap-forecasts")
+def compact_forecasts_command(
+    older_than, keep_horizons, sensor_ids, batch_size, dry_run
+):
+    """
+    Delete old forecasts of weather sensors, except the latest one for each event and a few selected horizons (see --keep-horizon).
+    Deletes happen in small batches, each in its own transaction, so this can run while forecasts are being collected.
+    """
+    from ..utils.compacting import compact_forecasts
+
+    sensors = get_weather_sensors()
+    if sensor_ids:
+        sensors = [sensor for sensor in sensors if sensor.id in sensor_ids]
+        if len(sensors) < len(set(sensor_ids)):
+            raise Exception(
+                f"[FLEXMEASURES-OWM] Not all of the sensors {', '.join(str(i) for i in sensor_ids)} are weather sensors."
+            )
+    metrics = start_run_metrics("compact-forecasts")
+    try:
+        with metrics.measure("total"):
+            compact_forecasts(
+                sensors,
+                older_than=server_now() - timedelta(days=older_than),
+                keep_horizons=[timedelta(hours=h) for h in keep_horizons],
+                batch_size=batch_size,
+                dry_run=dry_run,
+            )
+    finally:
+        export_run_metrics(metrics)
+
+
+@flexmeasures_openweathermap_bp.cli.command("benchmark")
+@with_appcontext
+@click.option(
+    "--locations",
+    "num_locations",
+    type=click.IntRange(min=1),
+    multiple=True,
+    default=[1, 100, 1000],
+    help="Number of locations (each with a weather station) to get forecasts for. Can be given multiple times, defaults to 1, 100 and 1000.",
+)
+@click.option(
+    "--max-concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Maximum number of locations for which the stub server is called in parallel. Defaults to 1.",
+)
+@click.option(
+    "--trace-memory/--no-trace-memory",
+    default=False,
+    help="Measure peak memory with tracemalloc (slows the run down). Otherwise, the peak memory of the whole process is reported.",
+)
+@click.option(
+    "--save-baseline",
+    type=click.Path(dir_okay=False, writable=True),
+    required=False,
+    help="Store the results as a baseline in this (JSON) file.",
+)
+@click.option(
+    "--compare-to",
+    type=click.Path(exists=True, dir_okay=False),
+    required=False,
+    help="Compare the results to a baseline stored earlier (see --save-baseline), and fail if they regressed.",
+)
+@click.option(
+    "--max-regression",
+    type=click.FloatRange(min=0),
+    default=0.2,
+    help="How much slower than the baseline a run may be (as a ratio), defaults to 0.2 (20%).",
+)
+def benchmark(
+    num_locations,
+    max_concurrency,
+    trace_memory,
+    save_baseline,
+    compare_to,
+    max_regression,
+):
+    """
+    Benchmark getting forecasts into the database, for growing numbers of locations.
+    Weather stations and sensors are seeded, and forecasts come from a local stub server instead of OpenWeatherMap.
+    Everything is rolled back afterwards.
+    """
+    from ..utils.benchmarking import run_benchmark, compare_to_baseline
+
+    results = []
+    for n in num_locations:
+        click.echo(f"[FLEXMEASURES-OWM] Benchmarking {n} location(s) ...")
+        results.append(run_benchmark(n, max_concurrency, trace_memory))
+    for result in results:
+        click.echo(
+            f"[FLEXMEASURES-OWM] {result['locations']} location(s): {result['wall_time']}s in total"
+            f" ({', '.join(f'{phase}: {duration}s' for phase, duration in result['phases'].items())}),"
+            f" {result['rows_written']} rows written ({result['rows_per_second']} per second),"
+            f" peak memory {result['peak_memory_mb']} MB."
         )
+    if save_baseline is not None:
+        with open(save_baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        click.echo(f"[FLEXMEASURES-OWM] Saved baseline to {save_baseline}.")
+    if compare_to is not None:
+        with open(compare_to, "r") as baseline_file:
+            regressions = compare_to_baseline(
+                results, json.load(baseline_file), max_regression
+            )
+        for regression in regressions:
+            click.echo(regression)
+        if regressions:
+            raise click.Abort
+        click.echo("[FLEXMEASURES-OWM] No regressions compared to the baseline.")
@@ -8,7 +8,7 @@ from marshmallow import (
 
 import pytz
 
-from ...utils.owm import get_supported_sensor_spec, get_supported_sensors_str
+from ...sensor_specs import get_supported_sensor_spec, get_supported_sensors_str
 
 
 class WeatherSensorSchema(Schema):
@@ -0,0 +1,56 @@
+import json
+
+from flexmeasures.data.models.generic_assets import GenericAsset
+from flexmeasures.data.models.time_series import TimedBelief
+
+from ..commands import benchmark
+from ...utils.benchmarking import BENCHMARK_STATION_NAME
+
+
+def test_benchmark(app, fresh_db, tmp_path):
+    """
+    Benchmark a small run, store it as baseline and compare against it.
+    Nothing should be left in the database.
+    """
+    baseline_path = str(tmp_path / "baseline.json")
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        benchmark,
+        ["--locations", "1", "--locations", "4", "--save-baseline", baseline_path],
+    )
+    print(result.output)
+    assert result.exit_code == 0
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    assert [result["locations"] for result in baseline] == [1, 4]
+    # per location, 48 hourly forecasts for 4 sensors and 60 minutely nowcasts for 1 sensor
+    assert baseline[1]["calls"] == 4
+    assert baseline[1]["rows_written"] == 4 * (4 * 48 + 60)
+    assert {
+        "sensor lookup",
+        "fetching",
+        "http",
+        "irradiance",
+        "making beliefs",
+        "saving",
+    } <= set(baseline[1]["phases"])
+
+    result = runner.invoke(
+        benchmark,
+        [
+            "--locations",
+            "1",
+            "--compare-to",
+            baseline_path,
+            "--max-regression",
+            "100",
+        ],
+    )
+    print(result.output)
+    assert "No regressions compared to the baseline" in result.output
+
+    assert (
+        GenericAsset.query.filter(GenericAsset.name == BENCHMARK_STATION_NAME).count()
+        == 0
+    )
+    assert fresh_db.session.query(TimedBelief).count() == 0
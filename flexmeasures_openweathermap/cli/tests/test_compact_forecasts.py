@@ -0,0 +1,88 @@
+from datetime import timedelta
+
+from flexmeasures.data.models.time_series import TimedBelief
+from flexmeasures.utils.time_utils import server_now
+
+from ..commands import compact_forecasts_command
+from ...utils.modeling import get_or_create_owm_data_source
+
+
+def add_forecasts(db, sensor, event_starts):
+    source = get_or_create_owm_data_source()
+    for event_start in event_starts:
+        for horizon in (0, 1, 2, 6, 12, 24, 36):
+            db.session.add(
+                TimedBelief(
+                    sensor=sensor,
+                    source=source,
+                    event_start=event_start,
+                    belief_horizon=timedelta(hours=horizon),
+                    event_value=horizon,
+                )
+            )
+    db.session.commit()
+
+
+def test_compact_forecasts(app, fresh_db, run_as_cli, add_weather_sensors_fresh_db):
+    """
+    Of the forecasts for an old event, only the latest and those for the horizons to keep remain.
+    Forecasts for recent events are left alone.
+    """
+    wind_sensor = add_weather_sensors_fresh_db["wind"]
+    now = server_now().replace(minute=0, second=0, microsecond=0)
+    old_event = now - timedelta(days=10)
+    recent_event = now - timedelta(days=1)
+    add_forecasts(fresh_db, wind_sensor, (old_event, recent_event))
+    wind_sensor_id = wind_sensor.id
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        compact_forecasts_command, ["--older-than", "7", "--batch-size", "2"]
+    )
+    print(result.output)
+    assert (
+        "Reported task compact-openweathermap-forecasts status as True" in result.output
+    )
+    assert "Deleted 3 wind speed forecasts" in result.output
+
+    def remaining_horizons(event_start):
+        return sorted(
+            belief.belief_horizon
+            for belief in fresh_db.session.query(TimedBelief).filter(
+                TimedBelief.sensor_id == wind_sensor_id,
+                TimedBelief.event_start == event_start,
+            )
+        )
+
+    assert remaining_horizons(old_event) == [timedelta(hours=h) for h in (0, 1, 6, 24)]
+    assert len(remaining_horizons(recent_event)) == 7
+
+
+def test_compact_forecasts_dry_run(
+    app, fresh_db, monkeypatch, run_as_cli, add_weather_sensors_fresh_db, tmp_path
+):
+    """A dry run reports what would be deleted, but deletes nothing (and counts no deleted rows)."""
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_METRICS_DIR", str(tmp_path))
+    wind_sensor = add_weather_sensors_fresh_db["wind"]
+    now = server_now().replace(minute=0, second=0, microsecond=0)
+    add_forecasts(fresh_db, wind_sensor, [now - timedelta(days=10)])
+    wind_sensor_id = wind_sensor.id
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        compact_forecasts_command, ["--older-than", "7", "--dry-run"]
+    )
+    print(result.output)
+    assert (
+        "Reported task compact-openweathermap-forecasts status as True" in result.output
+    )
+    assert "Would delete 3 wind speed forecasts" in result.output
+    assert (
+        fresh_db.session.query(TimedBelief)
+        .filter(TimedBelief.sensor_id == wind_sensor_id)
+        .count()
+        == 7
+    )
+    metrics = (tmp_path / "compact-forecasts.prom").read_text()
+    assert 'counter="rows_would_delete"} 3' in metrics
+    assert 'counter="rows_deleted"' not in metrics
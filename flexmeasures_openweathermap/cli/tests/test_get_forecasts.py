@@ -1,10 +1,16 @@
 import logging
+from datetime import timedelta
 
-from flexmeasures.data.models.time_series import TimedBelief
+import pytest
+from fakeredis import FakeStrictRedis
+from rq import Queue
+from flexmeasures.data.models.time_series import Sensor, TimedBelief
 
 from ..commands import collect_weather_data
 from ...utils import owm
-from .utils import mock_owm_response
+from ...utils.archiving import ARCHIVE_FOLDER_NAME, read_archive
+from ...utils.distributing import get_forecasts_job
+from .utils import mock_owm_response, mock_owm_response_with_nowcasts
 
 
 """
@@ -67,3 +73,421 @@ def test_get_weather_forecasts_no_close_sensors(
             "Reported task get-openweathermap-forecasts status as True" in result.output
         )
         assert "no sufficiently close weather sensor found" in caplog.text
+
+
+def test_fetch_forecasts_concurrently(app, monkeypatch):
+    """
+    Fetch forecasts for several locations in parallel, and check they all got called (and are yielded in order).
+    """
+    locations = [(52 + i / 10, 4 + i / 10) for i in range(5)]
+    called_locations = []
+
+    def mock_owm_response_and_record_location(api_key, location):
+        called_locations.append(location)
+        return mock_owm_response(api_key, location)
+
+    monkeypatch.setattr(
+        owm, "call_openweatherapi", mock_owm_response_and_record_location
+    )
+
+    results = list(owm.fetch_forecasts("dummy", locations, max_concurrency=3))
+    assert [location for location, *_ in results] == locations
+    assert sorted(called_locations) == locations
+
+
+def test_get_weather_forecasts_for_grid_coalesces_calls(
+    app, fresh_db, monkeypatch, run_as_cli, add_weather_sensors_fresh_db
+):
+    """
+    All grid points are closest to the same weather station, so we should call OWM only once.
+    """
+    weather_station = add_weather_sensors_fresh_db["wind"].generic_asset
+    called_locations = []
+
+    def mock_owm_response_and_record_location(api_key, location):
+        called_locations.append(location)
+        return mock_owm_response(api_key, location)
+
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_API_KEY", "dummy")
+    monkeypatch.setattr(
+        owm, "call_openweatherapi", mock_owm_response_and_record_location
+    )
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        collect_weather_data,
+        [
+            "--location",
+            f"{weather_station.latitude + 0.5},{weather_station.longitude - 0.5}:{weather_station.latitude - 0.5},{weather_station.longitude + 0.5}",
+            "--num_cells",
+            "4",
+            "--max-concurrency",
+            "3",
+        ],
+    )
+    print(result.output)
+    assert "Reported task get-openweathermap-forecasts status as True" in result.output
+    assert called_locations == [weather_station.location]
+    assert "2 new, 0 saved before, 0 unchanged" in result.output
+
+
+def test_get_weather_forecasts_twice(
+    app, fresh_db, monkeypatch, run_as_cli, add_weather_sensors_fresh_db
+):
+    """
+    The second time we get the same forecasts, they should not be saved again.
+    """
+    wind_sensor = add_weather_sensors_fresh_db["wind"]
+    fresh_db.session.flush()
+    wind_sensor_id = wind_sensor.id
+    weather_station = wind_sensor.generic_asset
+
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_API_KEY", "dummy")
+    monkeypatch.setattr(owm, "call_openweatherapi", mock_owm_response)
+
+    runner = app.test_cli_runner()
+    location = f"{weather_station.latitude},{weather_station.longitude}"
+    result = runner.invoke(collect_weather_data, ["--location", location])
+    assert "Saved wind speed forecasts" in result.output
+    assert "2 new, 0 saved before, 0 unchanged" in result.output
+
+    result = runner.invoke(collect_weather_data, ["--location", location])
+    print(result.output)
+    assert "Reported task get-openweathermap-forecasts status as True" in result.output
+    assert "0 new, 0 saved before, 2 unchanged" in result.output
+    assert (
+        fresh_db.session.query(TimedBelief)
+        .filter(TimedBelief.sensor_id == wind_sensor_id)
+        .count()
+        == 2
+    )
+
+
+def test_get_weather_forecasts_to_archive(
+    app, fresh_db, monkeypatch, run_as_cli, add_weather_sensors_fresh_db, tmp_path
+):
+    """
+    Append forecasts to the columnar archive, and read them back.
+    """
+    pytest.importorskip("pyarrow")
+    weather_station = add_weather_sensors_fresh_db["wind"].generic_asset
+
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_API_KEY", "dummy")
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_FILE_PATH_LOCATION", str(tmp_path))
+    monkeypatch.setattr(owm, "call_openweatherapi", mock_owm_response)
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        collect_weather_data,
+        [
+            "--location",
+            f"{weather_station.latitude},{weather_station.longitude}",
+            "--store-as",
+            "parquet",
+            "--region",
+            "korea",
+        ],
+    )
+    print(result.output)
+    assert "Reported task get-openweathermap-forecasts status as True" in result.output
+    forecasts = read_archive(
+        str(tmp_path / "korea" / ARCHIVE_FOLDER_NAME),
+        locations=[weather_station.location],
+        columns=["temp", "wind_speed"],
+    ).to_pandas()
+    assert forecasts["wind_speed"].tolist() == [100, 90]
+
+
+def test_get_weather_forecasts_exports_metrics(
+    app, fresh_db, monkeypatch, run_as_cli, add_weather_sensors_fresh_db, tmp_path
+):
+    """
+    After a run, its metrics should be written in the Prometheus text format.
+    """
+    weather_station = add_weather_sensors_fresh_db["wind"].generic_asset
+    metrics_file = tmp_path / "get-weather-forecasts.prom"
+
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_API_KEY", "dummy")
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_METRICS_DIR", str(tmp_path))
+    monkeypatch.setattr(owm, "call_openweatherapi", mock_owm_response)
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        collect_weather_data,
+        ["--location", f"{weather_station.latitude},{weather_station.longitude}"],
+    )
+    print(result.output)
+    assert "Reported task get-openweathermap-forecasts status as True" in result.output
+    metrics = metrics_file.read_text()
+    # wind speed and temperature, two forecasts each
+    assert (
+        'flexmeasures_owm_run_count{run="get-weather-forecasts",counter="rows_inserted"} 4'
+        in metrics
+    )
+    for phase in ("sensor lookup", "fetching", "making beliefs", "saving", "total"):
+        assert f'phase="{phase}"' in metrics
+
+
+def test_get_weather_forecasts_with_nowcasts(
+    app, fresh_db, monkeypatch, run_as_cli, add_weather_sensors_fresh_db
+):
+    """
+    If a weather station has a precipitation nowcast sensor, we also ask for minutely data, and save it at 1-minute resolution.
+    """
+    weather_station = add_weather_sensors_fresh_db["wind"].generic_asset
+    nowcast_sensor = Sensor(
+        name="precipitation nowcast",
+        generic_asset=weather_station,
+        event_resolution=timedelta(minutes=1),
+        unit="mm/h",
+    )
+    fresh_db.session.add(nowcast_sensor)
+    fresh_db.session.flush()
+    nowcast_sensor_id = nowcast_sensor.id
+
+    def fail(api_key, location):
+        raise AssertionError("We should have asked for nowcasts.")
+
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_API_KEY", "dummy")
+    monkeypatch.setattr(owm, "call_openweatherapi", fail)
+    monkeypatch.setattr(
+        owm, "call_openweatherapi_with_nowcasts", mock_owm_response_with_nowcasts
+    )
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        collect_weather_data,
+        ["--location", f"{weather_station.latitude},{weather_station.longitude}"],
+    )
+    print(result.output)
+    assert "Reported task get-openweathermap-forecasts status as True" in result.output
+    assert "Saved wind speed forecasts" in result.output
+    beliefs = (
+        fresh_db.session.query(TimedBelief)
+        .filter(TimedBelief.sensor_id == nowcast_sensor_id)
+        .order_by(TimedBelief.event_start)
+        .all()
+    )
+    assert [belief.event_value for belief in beliefs] == [0, 0.5, 1]
+    assert beliefs[1].event_start - beliefs[0].event_start == timedelta(minutes=1)
+
+
+def test_get_weather_forecasts_skips_changes_within_tolerance(
+    app, fresh_db, monkeypatch, run_as_cli, add_weather_sensors_fresh_db
+):
+    """
+    Forecasts which changed by less than the tolerance of their sensor are not saved again.
+    """
+    wind_sensor = add_weather_sensors_fresh_db["wind"]
+    fresh_db.session.flush()
+    wind_sensor_id = wind_sensor.id
+    weather_station = wind_sensor.generic_asset
+
+    def mock_slightly_changed_owm_response(api_key, location):
+        time_of_call, forecasts = mock_owm_response(api_key, location)
+        forecasts[0]["wind_speed"] += 0.1  # within tolerance
+        forecasts[1]["wind_speed"] += 1  # beyond tolerance
+        return time_of_call, forecasts
+
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_API_KEY", "dummy")
+    monkeypatch.setitem(
+        app.config, "OPENWEATHERMAP_CHANGE_TOLERANCES", {"wind speed": 0.5}
+    )
+    monkeypatch.setattr(owm, "call_openweatherapi", mock_owm_response)
+
+    runner = app.test_cli_runner()
+    location = f"{weather_station.latitude},{weather_station.longitude}"
+    result = runner.invoke(collect_weather_data, ["--location", location])
+    assert "2 new, 0 saved before, 0 unchanged" in result.output
+
+    monkeypatch.setattr(owm, "call_openweatherapi", mock_slightly_changed_owm_response)
+    result = runner.invoke(collect_weather_data, ["--location", location])
+    print(result.output)
+    assert "Reported task get-openweathermap-forecasts status as True" in result.output
+    assert "1 new, 0 saved before, 1 unchanged" in result.output
+    assert (
+        fresh_db.session.query(TimedBelief)
+        .filter(TimedBelief.sensor_id == wind_sensor_id)
+        .count()
+        == 3
+    )
+
+
+@pytest.mark.parametrize("use_all_stations", [False, True])
+def test_get_weather_forecasts_for_stations(
+    app,
+    fresh_db,
+    monkeypatch,
+    run_as_cli,
+    add_weather_sensors_fresh_db,
+    use_all_stations,
+):
+    """
+    Get forecasts for weather stations by their asset IDs (repeating one should not lead to an extra call),
+    or for all stations at once.
+    """
+    wind_sensor = add_weather_sensors_fresh_db["wind"]
+    fresh_db.session.flush()
+    wind_sensor_id = wind_sensor.id
+    weather_station = wind_sensor.generic_asset
+    called_locations = []
+
+    def mock_owm_response_recording_location(api_key, location):
+        called_locations.append(location)
+        return mock_owm_response(api_key, location)
+
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_API_KEY", "dummy")
+    monkeypatch.setattr(
+        owm, "call_openweatherapi", mock_owm_response_recording_location
+    )
+
+    runner = app.test_cli_runner()
+    if use_all_stations:
+        cli_input = ["--all-stations"]
+    else:
+        cli_input = ["--asset-id", weather_station.id, "--asset-id", weather_station.id]
+    result = runner.invoke(collect_weather_data, cli_input)
+    print(result.output)
+    assert "Reported task get-openweathermap-forecasts status as True" in result.output
+    assert called_locations == [weather_station.location]
+    assert (
+        fresh_db.session.query(TimedBelief)
+        .filter(TimedBelief.sensor_id == wind_sensor_id)
+        .count()
+        == 2
+    )
+
+
+def test_get_weather_forecasts_for_unknown_station(
+    app, fresh_db, monkeypatch, run_as_cli, add_weather_sensors_fresh_db
+):
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_API_KEY", "dummy")
+    monkeypatch.setattr(owm, "call_openweatherapi", mock_owm_response)
+
+    weather_station = add_weather_sensors_fresh_db["wind"].generic_asset
+    fresh_db.session.flush()
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        collect_weather_data,
+        ["--asset-id", weather_station.id, "--asset-id", weather_station.id + 1000],
+    )
+    assert result.exit_code != 0
+    assert f"{weather_station.id + 1000}" in str(result.exception)
+
+
+@pytest.fixture
+def forecasting_queue(app, monkeypatch):
+    """A forecasting queue on fake Redis, which runs each job right away (as a worker would)."""
+    queue = Queue("forecasting", connection=FakeStrictRedis(), is_async=False)
+    monkeypatch.setitem(app.queues, "forecasting", queue)
+    return queue
+
+
+def test_get_weather_forecasts_as_jobs(
+    app,
+    fresh_db,
+    monkeypatch,
+    run_as_cli,
+    add_weather_sensors_fresh_db,
+    forecasting_queue,
+    tmp_path,
+):
+    """
+    Grid points are coalesced before they are split into jobs, so we get one job for the one weather station.
+    Its counts end up in the metrics of the enqueuing run.
+    """
+    wind_sensor = add_weather_sensors_fresh_db["wind"]
+    fresh_db.session.flush()
+    wind_sensor_id = wind_sensor.id
+    weather_station = wind_sensor.generic_asset
+    metrics_file = tmp_path / "get-weather-forecasts.prom"
+
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_API_KEY", "dummy")
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_METRICS_DIR", str(tmp_path))
+    monkeypatch.setattr(owm, "call_openweatherapi", mock_owm_response)
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        collect_weather_data,
+        [
+            "--location",
+            f"{weather_station.latitude + 0.5},{weather_station.longitude - 0.5}:{weather_station.latitude - 0.5},{weather_station.longitude + 0.5}",
+            "--num_cells",
+            "4",
+            "--as-jobs",
+            "--locations-per-job",
+            "1",
+        ],
+    )
+    print(result.output)
+    assert "Enqueued 1 job(s) on the forecasting queue" in result.output
+    assert "1 of 1 job(s) succeeded" in result.output
+    assert "Reported task get-openweathermap-forecasts status as True" in result.output
+    metrics = metrics_file.read_text()
+    for counter, count in (("jobs", 1), ("jobs_failed", 0), ("rows_inserted", 4)):
+        assert (
+            f'flexmeasures_owm_run_count{{run="get-weather-forecasts",counter="{counter}"}} {count}'
+            in metrics
+        )
+    assert (
+        fresh_db.session.query(TimedBelief)
+        .filter(TimedBelief.sensor_id == wind_sensor_id)
+        .count()
+        == 2
+    )
+
+
+def test_get_forecasts_job_commits(
+    app, fresh_db, monkeypatch, add_weather_sensors_fresh_db
+):
+    """A job commits the forecasts it saved itself, as nobody else does so for jobs."""
+    wind_sensor = add_weather_sensors_fresh_db["wind"]
+    fresh_db.session.commit()
+    wind_sensor_id = wind_sensor.id
+    weather_station = wind_sensor.generic_asset
+
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_API_KEY", "dummy")
+    monkeypatch.setattr(owm, "call_openweatherapi", mock_owm_response)
+
+    counts = get_forecasts_job(
+        locations=[(weather_station.latitude, weather_station.longitude)]
+    )
+    assert counts["rows_inserted"] == 4
+    fresh_db.session.rollback()
+    assert (
+        fresh_db.session.query(TimedBelief)
+        .filter(TimedBelief.sensor_id == wind_sensor_id)
+        .count()
+        == 2
+    )
+
+
+def test_get_weather_forecasts_as_jobs_fails_with_a_job(
+    app,
+    fresh_db,
+    monkeypatch,
+    run_as_cli,
+    add_weather_sensors_fresh_db,
+    forecasting_queue,
+):
+    weather_station = add_weather_sensors_fresh_db["wind"].generic_asset
+
+    def mock_owm_failure(api_key, location):
+        raise Exception("OWM is down")
+
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_API_KEY", "dummy")
+    monkeypatch.setattr(owm, "call_openweatherapi", mock_owm_failure)
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        collect_weather_data,
+        [
+            "--location",
+            f"{weather_station.latitude},{weather_station.longitude}",
+            "--as-jobs",
+        ],
+    )
+    print(result.output)
+    assert "0 of 1 job(s) succeeded" in result.output
+    assert "Reported task get-openweathermap-forecasts status as False" in result.output
+    assert "OWM is down" in str(result.exception)
@@ -0,0 +1,77 @@
+import json
+import subprocess
+import sys
+
+
+"""
+FlexMeasures imports this plugin (and so its CLI commands) on every CLI call and worker start-up.
+These tests guard that this stays cheap, by checking which modules importing the plugin (in a fresh interpreter) loads.
+We do not time the import, as wall-clock checks fail intermittently on loaded CI machines.
+"""
+
+# What FlexMeasures has loaded anyway, before it gets to plugins
+FLEXMEASURES_MODULES = [
+    "flexmeasures.data.models.time_series",
+    "flexmeasures.data.models.generic_assets",
+    "flexmeasures.data.transactional",
+    "flexmeasures.utils.grid_cells",
+]
+# Dependencies which take long to import, and which we only need once a command runs
+HEAVY_DEPENDENCIES = ["pvlib", "humanize", "requests", "pyarrow", "orjson"]
+# Our own modules which pull in heavy dependencies
+LAZILY_LOADED_MODULES = [
+    "flexmeasures_openweathermap.utils.owm",
+    "flexmeasures_openweathermap.utils.radiating",
+    "flexmeasures_openweathermap.utils.requesting",
+    "flexmeasures_openweathermap.utils.planning",
+    "flexmeasures_openweathermap.utils.ingesting",
+    "flexmeasures_openweathermap.utils.benchmarking",
+    "flexmeasures_openweathermap.utils.serving",
+    "flexmeasures_openweathermap.utils.compacting",
+    "flexmeasures_openweathermap.utils.distributing",
+]
+
+IMPORT_PLUGIN = f"""
+import json, sys
+import {", ".join(FLEXMEASURES_MODULES)}
+modules_before = set(sys.modules)
+import flexmeasures_openweathermap
+print(json.dumps(sorted(set(sys.modules) - modules_before)))
+"""
+
+
+def import_plugin() -> list:
+    """Import the plugin in a fresh interpreter, and return which modules this loaded."""
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_PLUGIN],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_importing_plugin_does_not_load_heavy_dependencies():
+    new_modules = import_plugin()
+    assert "flexmeasures_openweathermap.cli.commands" in new_modules
+    assert [
+        module
+        for module in new_modules
+        if module.split(".")[0] in HEAVY_DEPENDENCIES or module in LAZILY_LOADED_MODULES
+    ] == []
+
+
+def test_forecasting_does_not_load_archiving_dependencies():
+    """Runs which store forecasts in the database or as JSON files should not pay for importing pyarrow's Parquet support."""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, flexmeasures_openweathermap.utils.owm;"
+            " print(sorted(m for m in sys.modules if m.startswith(('pyarrow.parquet', 'pyarrow.dataset'))))",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout.strip().splitlines()[-1] == "[]"
@@ -0,0 +1,60 @@
+import json
+import os
+
+from flexmeasures.data.models.time_series import TimedBelief
+
+from ..commands import ingest_json_archive_command
+
+# two hourly forecasts, for 2022-08-01 12:00 and 13:00 UTC
+ARCHIVED_FORECASTS = [
+    {"dt": 1659355200, "temp": 40, "wind_speed": 100},
+    {"dt": 1659358800, "temp": 42, "wind_speed": 90},
+]
+
+
+def write_archived_forecasts(root, region: str, run_folder: str, location) -> str:
+    run_path = os.path.join(root, region, run_folder)
+    os.makedirs(run_path, exist_ok=True)
+    file_path = os.path.join(
+        run_path, "forecast_lat_%s_lng_%s.json" % (location[0], location[1])
+    )
+    with open(file_path, "w") as forecasts_file:
+        json.dump(ARCHIVED_FORECASTS, forecasts_file)
+    return file_path
+
+
+def test_ingest_json_archive(
+    app, fresh_db, run_as_cli, add_weather_sensors_fresh_db, tmp_path
+):
+    """
+    Ingest archived JSON files from two runs and two regions, selecting one region.
+    """
+    wind_sensor = add_weather_sensors_fresh_db["wind"]
+    fresh_db.session.flush()
+    wind_sensor_id = wind_sensor.id
+    location = wind_sensor.generic_asset.location
+
+    write_archived_forecasts(tmp_path, "korea", "2022-08-01T10-00-00", location)
+    write_archived_forecasts(tmp_path, "korea", "2022-08-01T11-00-00", location)
+    write_archived_forecasts(tmp_path, "elsewhere", "2022-08-01T10-00-00", location)
+    (tmp_path / "korea" / "not-a-run").mkdir()
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        ingest_json_archive_command,
+        ["--path", str(tmp_path), "--region", "korea", "--workers", "2"],
+    )
+    print(result.output)
+    assert (
+        "Reported task ingest-openweathermap-json-archive status as True"
+        in result.output
+    )
+    assert "Ingested 2 archived JSON files" in result.output
+    beliefs = (
+        fresh_db.session.query(TimedBelief)
+        .filter(TimedBelief.sensor_id == wind_sensor_id)
+        .all()
+    )
+    # same values in the second run -> unchanged, so only saved once
+    assert len(beliefs) == 2
+    assert sorted(belief.event_value for belief in beliefs) == [90, 100]
@@ -1,7 +1,9 @@
 import pytest
 from flexmeasures import Sensor
+from flexmeasures.data.models.generic_assets import GenericAsset
 
-from ..commands import add_weather_sensor
+from ..commands import add_weather_sensor, add_weather_sensors
+from ...sensor_specs import mapping
 from .utils import cli_params_from_dict
 
 
@@ -45,3 +47,71 @@ def test_register_weather_sensor_twice(app, fresh_db):
     assert "Successfully created weather sensor with ID" in result.output
     result = runner.invoke(add_weather_sensor, cli_params_from_dict(sensor_params))
     assert "already exists" in result.output
+
+
+def test_register_weather_sensor_with_profiling(app, fresh_db, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_FILE_PATH_LOCATION", str(tmp_path))
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        add_weather_sensor,
+        cli_params_from_dict(sensor_params) + ["--profile", "--profile-memory"],
+    )
+    assert "Successfully created weather sensor with ID" in result.output
+    assert len(list(tmp_path.glob("profile-register-weather-sensor-*.pstats"))) == 1
+    assert len(list(tmp_path.glob("memory-register-weather-sensor-*.txt"))) == 1
+
+
+def test_register_weather_sensors_from_csv(app, fresh_db, tmp_path):
+    """Register sensors at a new location and at a location which already has a weather station with a sensor."""
+    runner = app.test_cli_runner()
+    runner.invoke(add_weather_sensor, cli_params_from_dict(sensor_params))
+    csv_file = tmp_path / "stations.csv"
+    csv_file.write_text("name,latitude,longitude\nhere,30,40\nthere,31.5,40.25\n")
+
+    result = runner.invoke(
+        add_weather_sensors,
+        ["--csv", str(csv_file), "--name", "wind speed", "--name", "temperature"],
+    )
+    print(result.output)
+    assert result.exit_code == 0
+    assert "1 new weather station(s), 1 existed already" in result.output
+    assert "3 new weather sensor(s), 1 existed already" in result.output
+    assert GenericAsset.query.count() == 2
+    assert Sensor.query.filter(Sensor.name == "wind speed").count() == 2
+    assert Sensor.query.filter(Sensor.name == "temperature").count() == 2
+
+
+def test_register_weather_sensors_on_grid_twice(app, fresh_db):
+    runner = app.test_cli_runner()
+    cli_input = [
+        "--location",
+        "52.4,4.8:52.3,5.0",
+        "--num_cells",
+        "4",
+        "--batch-size",
+        "2",
+    ]
+    result = runner.invoke(add_weather_sensors, cli_input)
+    print(result.output)
+    num_stations = GenericAsset.query.count()
+    assert num_stations > 1
+    assert Sensor.query.count() == num_stations * len(mapping)
+
+    result = runner.invoke(add_weather_sensors, cli_input)
+    print(result.output)
+    assert f"0 new weather station(s), {num_stations} existed already" in result.output
+    assert "0 new weather sensor(s)" in result.output
+    assert GenericAsset.query.count() == num_stations
+
+
+def test_register_weather_sensors_invalid_data(app, fresh_db, tmp_path):
+    csv_file = tmp_path / "stations.csv"
+    csv_file.write_text("latitude,longitude\n30,40\n93,40\n")
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        add_weather_sensors, ["--csv", str(csv_file), "--name", "windd-speed"]
+    )
+    assert "Aborted" in result.output
+    assert "less than or equal to 90" in result.output
+    assert "not supported by flexmeasures-openweathermap" in result.output
+    assert GenericAsset.query.count() == 0
@@ -25,3 +25,18 @@ def mock_owm_response(api_key, location):
             "wind_speed": 90,
         },
     ]
+
+
+def mock_owm_response_with_nowcasts(api_key, location):
+    time_of_call, forecasts = mock_owm_response(api_key, location)
+    return (
+        time_of_call,
+        forecasts,
+        [
+            {
+                "dt": (time_of_call + timedelta(minutes=m)).timestamp(),
+                "precipitation": 0.5 * m,
+            }
+            for m in range(3)
+        ],
+    )
@@ -1,10 +1,11 @@
+from typing import Optional
 from datetime import timedelta
 
 
 """
 This maps sensor specs which we can use in FlexMeasures to OWM labels.
 Note: Sensor names we use in FM need to be unique per weather station.
-At the moment, we only extract from OWM hourly data.
+We extract from OWM hourly data, and from the minutely precipitation nowcast (only called for if such sensors exist).
 """
 
 
@@ -19,6 +20,7 @@ mapping = [
     dict(
         fm_sensor_name="temperature",
         owm_sensor_name="temp",
+        owm_section="hourly",
         unit="°C",
         event_resolution=timedelta(minutes=60),
         attributes=weather_attributes,
@@ -26,6 +28,7 @@ mapping = [
     dict(
         fm_sensor_name="wind speed",
         owm_sensor_name="wind_speed",
+        owm_section="hourly",
         unit="m/s",
         event_resolution=timedelta(minutes=60),
         attributes=weather_attributes,
@@ -33,6 +36,7 @@ mapping = [
     dict(
         fm_sensor_name="cloud cover",
         owm_sensor_name="clouds",
+        owm_section="hourly",
         unit="%",
         event_resolution=timedelta(minutes=60),
         attributes=weather_attributes,
@@ -40,8 +44,37 @@ mapping = [
     dict(
         fm_sensor_name="irradiance",  # in save_forecasts_to_db, we catch this name and do the actual computation to get to the irradiance
         owm_sensor_name="clouds",
+        owm_section="hourly",
         unit="W/m²",
         event_resolution=timedelta(minutes=60),
         attributes=weather_attributes,
     ),
+    dict(
+        fm_sensor_name="precipitation nowcast",
+        owm_sensor_name="precipitation",
+        owm_section="minutely",  # OWM's nowcast for the next hour
+        unit="mm/h",
+        event_resolution=timedelta(minutes=1),
+        attributes=weather_attributes,
+    ),
 ]
+
+
+def get_supported_sensor_spec(name: str) -> Optional[dict]:
+    """
+    Find the specs from a sensor by name.
+    """
+    for supported_sensor_spec in mapping:
+        if supported_sensor_spec["fm_sensor_name"] == name:
+            return supported_sensor_spec.copy()
+    return None
+
+
+def get_supported_sensors_str() -> str:
+    """A string - list of supported sensors, also revealing their unit"""
+    return ", ".join(
+        [
+            f"{sensor_specs['fm_sensor_name']} ({sensor_specs['unit']})"
+            for sensor_specs in mapping
+        ]
+    )
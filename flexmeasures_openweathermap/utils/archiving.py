@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+from datetime import datetime, timezone
+from functools import reduce
+import operator
+import os
+
+from .decoding import dumps
+from .filing import RUN_FOLDER_FORMAT
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+
+# The archive lives in this folder (under the data path, see make_file_path)
+ARCHIVE_FOLDER_NAME = "archive"
+
+# Numeric values of OWM's hourly forecasts (see https://openweathermap.org/api/one-call-3), by column name.
+# Nested values get flattened, the weather conditions are archived as a JSON string.
+ARCHIVED_VALUES: Dict[str, Tuple[str, ...]] = {
+    "temp": ("temp",),
+    "feels_like": ("feels_like",),
+    "pressure": ("pressure",),
+    "humidity": ("humidity",),
+    "dew_point": ("dew_point",),
+    "uvi": ("uvi",),
+    "clouds": ("clouds",),
+    "visibility": ("visibility",),
+    "wind_speed": ("wind_speed",),
+    "wind_deg": ("wind_deg",),
+    "wind_gust": ("wind_gust",),
+    "pop": ("pop",),
+    "rain_1h": ("rain", "1h"),
+    "snow_1h": ("snow", "1h"),
+}
+
+
+def import_pyarrow():
+    """
+    Import pyarrow (with the submodules we use) only once we archive, as it takes long to import.
+    Archiving in Parquet files is optional, so we explain what to do if pyarrow is not installed.
+    """
+    try:
+        import pyarrow
+        import pyarrow.dataset  # noqa: F401
+        import pyarrow.fs  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise Exception(
+            "[FLEXMEASURES-OWM] Archiving forecasts in Parquet files requires pyarrow (pip install pyarrow)."
+        )
+    return pyarrow
+
+
+def check_pyarrow_is_installed():
+    import_pyarrow()
+
+
+def get_nested_value(forecast: dict, keys: Tuple[str, ...]) -> Optional[float]:
+    value: Any = forecast
+    for key in keys:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def forecasts_to_table(
+    fetched: List[Tuple[Tuple[float, float], datetime, List[Dict]]]
+) -> "pa.Table":
+    """
+    Put the forecasts of a run (per location: the location, time of the call and the forecasts) into one table,
+    with a row per location and forecast, sorted by location and event start.
+    Values missing from a forecast become nulls.
+    """
+    pa = import_pyarrow()
+    columns: Dict[str, list] = {
+        "latitude": [],
+        "longitude": [],
+        "belief_time": [],
+        "event_start": [],
+        **{column: [] for column in ARCHIVED_VALUES},
+        "weather": [],
+    }
+    for location, belief_time, forecasts in fetched:
+        for forecast in forecasts:
+            columns["latitude"].append(location[0])
+            columns["longitude"].append(location[1])
+            columns["belief_time"].append(belief_time.astimezone(timezone.utc))
+            columns["event_start"].append(
+                datetime.fromtimestamp(forecast["dt"], tz=timezone.utc)
+            )
+            for column, keys in ARCHIVED_VALUES.items():
+                columns[column].append(get_nested_value(forecast, keys))
+            columns["weather"].append(
+                dumps(forecast["weather"]) if "weather" in forecast else None
+            )
+    table = pa.table(columns, schema=get_archive_schema())
+    return table.sort_by(
+        [
+            ("latitude", "ascending"),
+            ("longitude", "ascending"),
+            ("event_start", "ascending"),
+        ]
+    )
+
+
+def get_archive_schema() -> "pa.Schema":
+    pa = import_pyarrow()
+    return pa.schema(
+        [
+            ("latitude", pa.float64()),
+            ("longitude", pa.float64()),
+            ("belief_time", pa.timestamp("s", tz="UTC")),
+            ("event_start", pa.timestamp("s", tz="UTC")),
+            *[(column, pa.float64()) for column in ARCHIVED_VALUES],
+            ("weather", pa.string()),
+        ]
+    )
+
+
+def append_to_archive(
+    archive_path: str,
+    run_time: datetime,
+    fetched: List[Tuple[Tuple[float, float], datetime, List[Dict]]],
+) -> str:
+    """
+    Append the forecasts of one run to the archive, as one compressed Parquet file (for all locations).
+    Files are partitioned per day (folders named like "date=2022-08-01", in UTC), so readers can skip whole days.
+    Existing files are never touched, and a new file only shows up (under its final name) once it has been fully written.
+    Returns the path of the new file.
+    """
+    pa = import_pyarrow()
+    table = forecasts_to_table(fetched)
+    run_time = run_time.astimezone(timezone.utc)
+    partition_path = os.path.join(archive_path, f"date={run_time:%Y-%m-%d}")
+    os.makedirs(partition_path, exist_ok=True)
+    file_name = f"run-{run_time.strftime(RUN_FOLDER_FORMAT)}.parquet"
+    file_path = os.path.join(partition_path, file_name)
+    # files starting with a dot are ignored by readers (see read_archive)
+    tmp_file_path = os.path.join(partition_path, f".{file_name}.tmp")
+    pa.parquet.write_table(table, tmp_file_path, compression="zstd")
+    os.replace(tmp_file_path, file_path)
+    return file_path
+
+
+def read_archive(
+    archive_path: str,
+    locations: Optional[List[Tuple[float, float]]] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    columns: Optional[List[str]] = None,
+    tolerance: float = 1e-6,
+) -> "pa.Table":
+    """
+    Read forecasts from the archive, optionally only for some locations (within some tolerance, in degrees),
+    from runs within [start, end] (by belief time) and only some columns.
+    Files are memory-mapped, and only days, row groups and columns which pass the filters are actually read.
+    Use .to_pandas() on the result to get a DataFrame.
+    """
+    pa = import_pyarrow()
+    ds = pa.dataset
+    dataset = ds.dataset(
+        archive_path,
+        schema=get_archive_schema().append(pa.field("date", pa.string())),
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema([("date", pa.string())]), flavor="hive"),
+        filesystem=pa.fs.LocalFileSystem(use_mmap=True),
+    )
+    filters = []
+    if start is not None:
+        start = start.astimezone(timezone.utc)
+        filters.append(ds.field("date") >= f"{start:%Y-%m-%d}")
+        filters.append(
+            ds.field("belief_time") >= pa.scalar(start, pa.timestamp("s", tz="UTC"))
+        )
+    if end is not None:
+        end = end.astimezone(timezone.utc)
+        filters.append(ds.field("date") <= f"{end:%Y-%m-%d}")
+        filters.append(
+            ds.field("belief_time") <= pa.scalar(end, pa.timestamp("s", tz="UTC"))
+        )
+    if locations:
+        location_filters = [
+            (ds.field("latitude") >= latitude - tolerance)
+            & (ds.field("latitude") <= latitude + tolerance)
+            & (ds.field("longitude") >= longitude - tolerance)
+            & (ds.field("longitude") <= longitude + tolerance)
+            for latitude, longitude in locations
+        ]
+        filters.append(reduce(operator.or_, location_filters))
+    return dataset.to_table(
+        columns=columns or get_archive_schema().names,
+        filter=reduce(operator.and_, filters) if filters else None,
+    )
@@ -0,0 +1,259 @@
+from __future__ import annotations
+
+from typing import Iterator, List, Optional, Tuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import math
+import resource
+import threading
+import time
+import tracemalloc
+
+from flask import current_app
+from flexmeasures.data import db
+from flexmeasures.data.models.generic_assets import GenericAsset
+from flexmeasures.data.models.time_series import Sensor
+
+from ..sensor_specs import mapping
+from . import owm
+from .instrumenting import end_run_metrics, start_run_metrics
+from .decoding import dumps
+from .modeling import get_or_create_weather_station_type
+
+
+# Synthetic weather stations are put on a grid in the South Pacific, far from any real ones
+BENCHMARK_GRID_ORIGIN = (-60.0, -150.0)
+BENCHMARK_GRID_SPACING = 0.1  # degrees
+BENCHMARK_STATION_NAME = "weather station (created by FM-OWM benchmark)"
+
+
+def make_synthetic_response(
+    location: Tuple[float, float],
+    now: datetime,
+    hours: int = 48,
+    with_nowcasts: bool = True,
+) -> dict:
+    """An OWM one-call response with hourly forecasts (and minutely nowcasts), with plausible (and deterministic) values for this location."""
+    current_hour = now.replace(minute=0, second=0, microsecond=0)
+    phase = (location[0] + location[1]) / 10
+    hourly = []
+    for h in range(hours):
+        event_start = current_hour + timedelta(hours=h)
+        daily_cycle = math.sin(2 * math.pi * event_start.hour / 24 + phase)
+        hourly.append(
+            {
+                "dt": int(event_start.timestamp()),
+                "temp": round(15 + 8 * daily_cycle, 2),
+                "wind_speed": round(5 + 3 * math.cos(h / 5 + phase), 2),
+                "clouds": int(50 + 50 * math.sin(h / 7 + phase)),
+                "weather": [{"id": 803, "main": "Clouds"}],
+            }
+        )
+    response = {
+        "lat": location[0],
+        "lon": location[1],
+        "timezone": "UTC",
+        "current": {"dt": int(now.timestamp())},
+        "hourly": hourly,
+    }
+    if with_nowcasts:
+        current_minute = now.replace(second=0, microsecond=0)
+        response["minutely"] = [
+            {
+                "dt": int((current_minute + timedelta(minutes=m)).timestamp()),
+                "precipitation": round(max(0.0, 2 * math.sin(m / 10 + phase)), 2),
+            }
+            for m in range(60)
+        ]
+    return response
+
+
+class StubOWMServer:
+    """
+    A local HTTP server which answers one-calls like OpenWeatherMap does, with synthetic forecasts (see make_synthetic_response).
+    Use as a context manager, and point OPENWEATHERMAP_API_URL to its url.
+    """
+
+    def __init__(self, hours: int = 48):
+        self.hours = hours
+        self.num_calls = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                params = parse_qs(urlparse(self.path).query)
+                location = (float(params["lat"][0]), float(params["lon"][0]))
+                body = dumps(
+                    make_synthetic_response(
+                        location,
+                        datetime.now(timezone.utc),
+                        stub.hours,
+                        with_nowcasts="minutely"
+                        not in params.get("exclude", [""])[0].split(","),
+                    )
+                ).encode()
+                with stub._lock:
+                    stub.num_calls += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # keep the benchmark output readable
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self) -> StubOWMServer:
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def seed_weather_stations(num_locations: int) -> List[Tuple[float, float]]:
+    """Add weather stations on a grid, each with all supported sensors. Returns their locations. Does not commit."""
+    weather_station_type = get_or_create_weather_station_type()
+    side = math.ceil(math.sqrt(num_locations))
+    locations = []
+    for i in range(num_locations):
+        location = (
+            round(BENCHMARK_GRID_ORIGIN[0] + (i // side) * BENCHMARK_GRID_SPACING, 6),
+            round(BENCHMARK_GRID_ORIGIN[1] + (i % side) * BENCHMARK_GRID_SPACING, 6),
+        )
+        weather_station = GenericAsset(
+            name=BENCHMARK_STATION_NAME,
+            generic_asset_type=weather_station_type,
+            latitude=location[0],
+            longitude=location[1],
+        )
+        db.session.add(weather_station)
+        for sensor_specs in mapping:
+            db.session.add(
+                Sensor(
+                    name=str(sensor_specs["fm_sensor_name"]),
+                    generic_asset=weather_station,
+                    unit=sensor_specs["unit"],
+                    event_resolution=sensor_specs["event_resolution"],
+                    attributes=sensor_specs["attributes"],
+                )
+            )
+        locations.append(location)
+    db.session.flush()
+    return locations
+
+
+# App extensions which the benchmark sets up afresh (from the stub settings), and which we restore afterwards
+STUBBED_EXTENSIONS = (
+    "flexmeasures-openweathermap-client",
+    "flexmeasures-openweathermap-clear-sky-cache",
+)
+
+
+@contextmanager
+def stub_settings(api_url: str) -> Iterator[None]:
+    """
+    Temporarily call our stub server, with one API key, without call budget and response cache (and with a fresh client for these settings).
+    We also start with an empty clear-sky cache (not read from or written to its file), so each benchmark run computes what a cold run would.
+    """
+    app = current_app._get_current_object()
+    overrides = dict(
+        OPENWEATHERMAP_API_URL=api_url,
+        OPENWEATHERMAP_API_KEY="benchmark",
+        OPENWEATHERMAP_CALL_BUDGET_FILE=None,
+        OPENWEATHERMAP_RESPONSE_CACHE_TTL=0,
+        OPENWEATHERMAP_CLEAR_SKY_CACHE_FILE=None,
+    )
+    missing = object()
+    original_settings = {key: app.config.get(key, missing) for key in overrides}
+    original_extensions = {
+        name: app.extensions.pop(name, None) for name in STUBBED_EXTENSIONS
+    }
+    app.config.update(overrides)
+    try:
+        yield
+    finally:
+        for key, value in original_settings.items():
+            if value is missing:
+                app.config.pop(key, None)
+            else:
+                app.config[key] = value
+        for name, extension in original_extensions.items():
+            app.extensions.pop(name, None)
+            if extension is not None:
+                app.extensions[name] = extension
+
+
+def run_benchmark(
+    num_locations: int, max_concurrency: int = 1, trace_memory: bool = False
+) -> dict:
+    """
+    Seed weather stations and get forecasts for all of them from a local stub server, into the database.
+    Measures wall time, time per phase (see RunMetrics), rows written per second and peak memory.
+    Everything is rolled back afterwards, so this leaves no trace in the database.
+    """
+    peak_memory: Optional[int] = None
+    metrics = start_run_metrics(f"benchmark-{num_locations}")
+    try:
+        locations = seed_weather_stations(num_locations)
+        with StubOWMServer() as server, stub_settings(server.url):
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            owm.save_forecasts_in_db("benchmark", locations, max_concurrency)
+            wall_time = time.perf_counter() - start
+            if trace_memory:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            num_calls = server.num_calls
+    finally:
+        end_run_metrics(metrics)
+        db.session.rollback()
+    if peak_memory is None:
+        # without tracing, the best we know is the peak memory of the whole process so far (in KiB on Linux)
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    rows_written = metrics.counts.get("rows_inserted", 0)
+    return dict(
+        locations=num_locations,
+        calls=num_calls,
+        wall_time=round(wall_time, 3),
+        phases={
+            phase: round(duration, 3) for phase, duration in metrics.durations.items()
+        },
+        rows_written=rows_written,
+        rows_per_second=round(rows_written / wall_time, 1) if wall_time else None,
+        peak_memory_mb=round(peak_memory / 2**20, 1),
+        memory_traced=trace_memory,
+    )
+
+
+def compare_to_baseline(
+    results: List[dict], baseline: List[dict], max_regression: float
+) -> List[str]:
+    """
+    Compare benchmark results to a stored baseline (for the same numbers of locations).
+    Returns a message for each result whose wall time regressed by more than max_regression (e.g. 0.2 for 20%).
+    """
+    baseline_by_size = {result["locations"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        baseline_result = baseline_by_size.get(result["locations"])
+        if baseline_result is None:
+            continue
+        allowed_time = baseline_result["wall_time"] * (1 + max_regression)
+        if result["wall_time"] > allowed_time:
+            regressions.append(
+                f"[FLEXMEASURES-OWM] For {result['locations']} location(s), the run took {result['wall_time']}s, but the baseline is {baseline_result['wall_time']}s (allowed up to {allowed_time:.3f}s)."
+            )
+    return regressions
@@ -0,0 +1,359 @@
+from __future__ import annotations
+
+from typing import Dict, List, Optional, Sequence, Union
+from contextlib import closing
+from dataclasses import dataclass
+import hashlib
+import sqlite3
+import threading
+import time
+
+import click
+from flask import Flask, current_app
+
+from flexmeasures_openweathermap import (
+    DEFAULT_CALLS_PER_MINUTE,
+    DEFAULT_CALLS_PER_DAY,
+    DEFAULT_API_KEY_SUSPENSION,
+)
+
+
+PERIODS = {"minute": 60, "day": 24 * 60 * 60}  # in seconds
+NO_BUDGET_REPORT = "[FLEXMEASURES-OWM] Calls to OpenWeatherMap are not limited."
+
+
+class CallBudgetExceeded(Exception):
+    """There are not enough calls left in our budget for the OpenWeatherMap API."""
+
+
+class CallBudget:
+    """
+    Buckets for calls to the OpenWeatherMap API, one per minute and one per day.
+    The minute bucket holds at most its limit of calls and refills continuously (e.g. 60 calls per minute is one call every second).
+    The day bucket counts calls per UTC day, like OWM does, so it is full again at UTC midnight (and does not refill before).
+    The buckets are persisted in a local SQLite file, so that overlapping runs (also in other processes) share one budget.
+    A limit of None means we do not limit calls over that period.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        name: str = "default",
+        calls_per_minute: Optional[int] = DEFAULT_CALLS_PER_MINUTE,
+        calls_per_day: Optional[int] = DEFAULT_CALLS_PER_DAY,
+    ):
+        self.path = path
+        self.name = name
+        self.limits: Dict[str, int] = {
+            period: limit
+            for period, limit in (("minute", calls_per_minute), ("day", calls_per_day))
+            if limit is not None
+        }
+        try:
+            with closing(self._connect()) as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+                )
+        except sqlite3.Error as exc:
+            raise Exception(
+                f"[FLEXMEASURES-OWM] Cannot keep the call budget in {path} (see the OPENWEATHERMAP_CALL_BUDGET_FILE setting): {exc}"
+            ) from exc
+
+    def _connect(self) -> sqlite3.Connection:
+        # We manage transactions ourselves (see _refill), so other processes wait for our lock
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _refill(self, conn: sqlite3.Connection) -> Dict[str, float]:
+        """Within an open transaction, load the buckets and add the tokens which accrued since they were last updated."""
+        now = time.time()
+        tokens = {}
+        for period, limit in self.limits.items():
+            row = conn.execute(
+                "SELECT tokens, updated_at FROM buckets WHERE name = ?",
+                (f"{self.name}:{period}",),
+            ).fetchone()
+            if row is None:
+                tokens[period] = float(limit)
+            elif period == "day":
+                is_same_utc_day = utc_day(row[1]) == utc_day(now)
+                tokens[period] = row[0] if is_same_utc_day else float(limit)
+            else:
+                accrued = (now - row[1]) * limit / PERIODS[period]
+                tokens[period] = min(float(limit), row[0] + accrued)
+        return tokens
+
+    def _store(self, conn: sqlite3.Connection, tokens: Dict[str, float]):
+        now = time.time()
+        for period, period_tokens in tokens.items():
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                (f"{self.name}:{period}", period_tokens, now),
+            )
+
+    def remaining(self) -> Dict[str, float]:
+        """Calls left per period (only for the periods we limit)."""
+        with closing(self._connect()) as conn:
+            return self._refill(conn)
+
+    def check(self, num_calls: int):
+        """Refuse (raise CallBudgetExceeded) if the calls we plan to make do not fit into today's budget."""
+        remaining = self.remaining()
+        if "day" in remaining and remaining["day"] < num_calls:
+            raise CallBudgetExceeded(
+                f"[FLEXMEASURES-OWM] We planned {num_calls} calls to OpenWeatherMap, but only {int(remaining['day'])} are left in our daily budget of {self.limits['day']}."
+            )
+
+    def acquire(self):
+        """
+        Take one call from the budget.
+        If the per-minute budget is used up, we wait (which spreads calls over time).
+        If the daily budget is used up, we raise CallBudgetExceeded.
+        """
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self) -> float:
+        """
+        Take one call from the budget, if we can do so right away (then we return 0).
+        If the per-minute budget is used up, return how many seconds to wait before trying again.
+        If the daily budget is used up, raise CallBudgetExceeded.
+        """
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                tokens = self._refill(conn)
+                if tokens.get("day", 1) < 1:
+                    raise CallBudgetExceeded(
+                        f"[FLEXMEASURES-OWM] The daily budget of {self.limits['day']} calls to OpenWeatherMap is used up (until midnight UTC)."
+                    )
+                if tokens.get("minute", 1) >= 1:
+                    self._store(conn, {period: t - 1 for period, t in tokens.items()})
+                    conn.execute("COMMIT")
+                    return 0
+                conn.execute("ROLLBACK")
+            except Exception:
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+        return (1 - tokens["minute"]) * PERIODS["minute"] / self.limits["minute"]
+
+    def report(self) -> str:
+        """Describe how many calls are left."""
+        remaining = self.remaining()
+        if not remaining:
+            return NO_BUDGET_REPORT
+        return "[FLEXMEASURES-OWM] Calls left in our budget: " + ", ".join(
+            f"{int(remaining[period])} of {limit} per {period}"
+            for period, limit in self.limits.items()
+        )
+
+
+def utc_day(timestamp: float) -> int:
+    """The number of the UTC day (since the epoch) of this time.time() timestamp."""
+    return int(timestamp // PERIODS["day"])
+
+
+@dataclass
+class PooledKey:
+    """An API key in a pool, with its own call budget (if we keep budgets, see get_call_budget)."""
+
+    value: str
+    budget: Optional[CallBudget]
+    key_name: str = ""
+    suspended_until: float = 0.0  # time.time() after which we use this key again
+
+    @property
+    def name(self) -> str:
+        return self.budget.name if self.budget is not None else self.key_name
+
+
+class APIKeyPool:
+    """
+    Several API keys (e.g. of several accounts), over which we distribute our calls.
+    Each key has its own call budget (see CallBudget), and we take turns between the keys which have calls left.
+    A key which OWM rejected (e.g. with status 401 or 429) is suspended for a while (see suspend).
+    Suspensions are kept in memory, so they only apply to this process.
+    """
+
+    def __init__(
+        self, keys: List[PooledKey], suspension: float = DEFAULT_API_KEY_SUSPENSION
+    ):
+        self.keys = keys
+        self.suspension = suspension
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> PooledKey:
+        """
+        Take one call from the budget of the next key which has calls left (and is not suspended), and return that key.
+        If all keys have to wait (for their per-minute budget or their suspension to end), we wait for the first one to be ready.
+        If the daily budgets of all keys are used up, we raise CallBudgetExceeded.
+        """
+        while True:
+            with self._lock:
+                start = self._next
+                self._next = (self._next + 1) % len(self.keys)
+            now = time.time()
+            waits = []
+            for i in range(len(self.keys)):
+                key = self.keys[(start + i) % len(self.keys)]
+                if key.suspended_until > now:
+                    waits.append(key.suspended_until - now)
+                    continue
+                if key.budget is None:
+                    return key
+                try:
+                    wait = key.budget.try_acquire()
+                except CallBudgetExceeded:
+                    continue
+                if wait == 0:
+                    return key
+                waits.append(wait)
+            if not waits:
+                raise CallBudgetExceeded(
+                    f"[FLEXMEASURES-OWM] The daily budgets of all {len(self.keys)} API keys for OpenWeatherMap are used up."
+                )
+            time.sleep(min(waits))
+
+    def suspend(self, key: PooledKey, seconds: Optional[float] = None):
+        """Do not use this key for a while (by default, for the suspension time of this pool)."""
+        key.suspended_until = time.time() + (
+            seconds if seconds is not None else self.suspension
+        )
+
+    def has_available_key(self) -> bool:
+        """Whether any key is not suspended (though it might have to wait for its budget)."""
+        now = time.time()
+        return any(key.suspended_until <= now for key in self.keys)
+
+    def remaining(self) -> Dict[str, float]:
+        """Calls left per period, summed over all keys (only for periods which all keys limit)."""
+        remaining = [
+            key.budget.remaining() if key.budget is not None else {}
+            for key in self.keys
+        ]
+        return {
+            period: sum(key_remaining[period] for key_remaining in remaining)
+            for period in PERIODS
+            if all(period in key_remaining for key_remaining in remaining)
+        }
+
+    def check(self, num_calls: int):
+        """Refuse (raise CallBudgetExceeded) if the calls we plan to make do not fit into today's budgets of all keys together."""
+        remaining = self.remaining()
+        if "day" in remaining and remaining["day"] < num_calls:
+            raise CallBudgetExceeded(
+                f"[FLEXMEASURES-OWM] We planned {num_calls} calls to OpenWeatherMap, but only {int(remaining['day'])} are left in the daily budgets of our {len(self.keys)} API keys."
+            )
+
+    def report(self) -> str:
+        """Describe how many calls are left, per key."""
+        return "\n".join(
+            (
+                key.budget.report() if key.budget is not None else NO_BUDGET_REPORT
+            ).replace(
+                "[FLEXMEASURES-OWM] ", f"[FLEXMEASURES-OWM] API key {key.name}: ", 1
+            )
+            for key in self.keys
+        )
+
+
+def get_call_budget_file(app: Flask) -> Optional[str]:
+    """The file to keep call budgets in. We only keep budgets if this is set, as it needs to be a writable place which all runs share."""
+    return app.config.get("OPENWEATHERMAP_CALL_BUDGET_FILE")
+
+
+def get_call_budget(app: Optional[Flask] = None) -> Optional[CallBudget]:
+    """Get the call budget as configured for this app (None if we do not keep one)."""
+    if app is None:
+        app = current_app._get_current_object()
+    path = get_call_budget_file(app)
+    if path is None:
+        return None
+    return CallBudget(
+        path,
+        calls_per_minute=app.config.get(
+            "OPENWEATHERMAP_CALLS_PER_MINUTE", DEFAULT_CALLS_PER_MINUTE
+        ),
+        calls_per_day=app.config.get(
+            "OPENWEATHERMAP_CALLS_PER_DAY", DEFAULT_CALLS_PER_DAY
+        ),
+    )
+
+
+def parse_api_keys(setting: Union[str, Sequence[Union[str, dict]], None]) -> List[dict]:
+    """
+    Read the OPENWEATHERMAP_API_KEY setting, which is one key, or a list of keys.
+    In a list, each key is a string or a dict with the key (as "key") and optionally its own
+    "calls_per_minute" and "calls_per_day" (otherwise, the general limits apply) and a "name" for its budget.
+    Keys without a name are named after a hash of the key, so the key itself does not show up in budget files and logs.
+    """
+    if setting is None or isinstance(setting, str):
+        return [dict(key=setting)] if setting else []
+    api_keys = []
+    for api_key in setting:
+        api_key = dict(key=api_key) if isinstance(api_key, str) else dict(api_key)
+        if not api_key.get("key"):
+            raise Exception(
+                "[FLEXMEASURES-OWM] Each API key in the OPENWEATHERMAP_API_KEY setting needs a value (as 'key')."
+            )
+        api_key.setdefault(
+            "name", "key-" + hashlib.sha256(api_key["key"].encode()).hexdigest()[:8]
+        )
+        api_keys.append(api_key)
+    return api_keys
+
+
+def get_api_key_pool(app: Optional[Flask] = None) -> Optional[APIKeyPool]:
+    """Get a pool of API keys, if the OPENWEATHERMAP_API_KEY setting is a list of keys (otherwise, we use one key with the general call budget)."""
+    if app is None:
+        app = current_app._get_current_object()
+    setting = app.config.get("OPENWEATHERMAP_API_KEY")
+    if not isinstance(setting, (list, tuple)):
+        return None
+    path = get_call_budget_file(app)
+    return APIKeyPool(
+        [
+            PooledKey(
+                api_key["key"],
+                CallBudget(
+                    path,
+                    name=api_key["name"],
+                    calls_per_minute=api_key.get(
+                        "calls_per_minute",
+                        app.config.get(
+                            "OPENWEATHERMAP_CALLS_PER_MINUTE", DEFAULT_CALLS_PER_MINUTE
+                        ),
+                    ),
+                    calls_per_day=api_key.get(
+                        "calls_per_day",
+                        app.config.get(
+                            "OPENWEATHERMAP_CALLS_PER_DAY", DEFAULT_CALLS_PER_DAY
+                        ),
+                    ),
+                )
+                if path is not None
+                else None,
+                key_name=api_key["name"],
+            )
+            for api_key in parse_api_keys(setting)
+        ],
+        suspension=app.config.get(
+            "OPENWEATHERMAP_API_KEY_SUSPENSION", DEFAULT_API_KEY_SUSPENSION
+        ),
+    )
+
+
+def check_call_budget(num_calls: int):
+    """Before a run, report how many calls are left and refuse the run if it does not fit into the budget (of all API keys)."""
+    from .requesting import get_owm_client  # which uses our budgets
+
+    budget = get_owm_client().key_pool or get_call_budget()
+    if budget is None:
+        click.echo(NO_BUDGET_REPORT)
+        return
+    click.echo(budget.report())
+    budget.check(num_calls)
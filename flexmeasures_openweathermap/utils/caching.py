@@ -0,0 +1,218 @@
+from __future__ import annotations
+
+from typing import Any, Dict, Hashable, List, Optional, Tuple, Union
+from collections import OrderedDict
+from contextlib import closing
+from datetime import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from flask import Flask, current_app, has_app_context
+
+from flexmeasures_openweathermap import (
+    DEFAULT_CLEAR_SKY_CACHE_SIZE,
+    DEFAULT_CLEAR_SKY_CACHE_TTL,
+    DEFAULT_RESPONSE_CACHE_TTL,
+    DEFAULT_RESPONSE_CACHE_PRECISION,
+    DEFAULT_RESPONSE_CACHE_FILE_NAME,
+)
+from .filing import make_file_path
+
+
+class TTLCache:
+    """
+    A least-recently-used cache, whose entries also expire after some time (ttl, in seconds).
+    If a path is given, the cache is loaded from that file on creation and can be written back to it with save().
+    The file holds JSON (not pickle, so reading it cannot run code), so persisted keys and values should be JSON values,
+    where keys may also be tuples of them.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, path: Optional[str] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self._data: OrderedDict[Hashable, Tuple[Any, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = (value, time.time() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def load(self):
+        """
+        Load (unexpired) entries from our file, keeping the most recently used ones if there are too many.
+        A file we cannot read counts as an empty cache (it is overwritten on the next save).
+        """
+        try:
+            with open(self.path) as cache_file:
+                entries = [
+                    (tuple(key) if isinstance(key, list) else key, value, expires_at)
+                    for key, value, expires_at in json.load(cache_file)
+                ]
+        except (OSError, ValueError, TypeError) as exc:
+            if has_app_context():
+                current_app.logger.warning(
+                    f"[FLEXMEASURES-OWM] Could not read the cache file {self.path}, starting with an empty cache: {exc}"
+                )
+            entries = []
+        now = time.time()
+        with self._lock:
+            self._data = OrderedDict(
+                (key, (value, expires_at))
+                for key, value, expires_at in entries
+                if expires_at >= now
+            )
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def save(self):
+        """Write the cache to our file (if we have one). We replace the file in one step, so readers never see half of it."""
+        if self.path is None:
+            return
+        with self._lock:
+            entries = [
+                [key, value, expires_at]
+                for key, (value, expires_at) in self._data.items()
+            ]
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as cache_file:
+            json.dump(entries, cache_file)
+        os.replace(tmp_path, self.path)
+
+
+def get_clear_sky_cache(app: Optional[Flask] = None) -> Optional[TTLCache]:
+    """Get the cache for clear-sky irradiance of this app, creating it on first use. None if the cache is switched off (size 0)."""
+    if app is None:
+        app = current_app._get_current_object()
+    if "flexmeasures-openweathermap-clear-sky-cache" not in app.extensions:
+        maxsize = app.config.get(
+            "OPENWEATHERMAP_CLEAR_SKY_CACHE_SIZE", DEFAULT_CLEAR_SKY_CACHE_SIZE
+        )
+        app.extensions["flexmeasures-openweathermap-clear-sky-cache"] = (
+            TTLCache(
+                maxsize=maxsize,
+                ttl=app.config.get(
+                    "OPENWEATHERMAP_CLEAR_SKY_CACHE_TTL", DEFAULT_CLEAR_SKY_CACHE_TTL
+                ),
+                path=app.config.get("OPENWEATHERMAP_CLEAR_SKY_CACHE_FILE"),
+            )
+            if maxsize
+            else None
+        )
+    return app.extensions["flexmeasures-openweathermap-clear-sky-cache"]
+
+
+def save_clear_sky_cache(app: Optional[Flask] = None):
+    """Persist the clear-sky cache of this app, if it is switched on (and has a file)."""
+    cache = get_clear_sky_cache(app)
+    if cache is not None:
+        cache.save()
+
+
+# the hourly forecasts, or (if we asked for nowcasts, too) a dict with the "hourly" and "minutely" sections
+CachedResponse = Union[List[Dict], Dict[str, List[Dict]]]
+
+
+class ResponseCache:
+    """
+    Cache for responses from OpenWeatherMap, keyed by location (rounded to some decimals).
+    Entries live in a SQLite file, so several processes (e.g. overlapping runs for different regions) can share them.
+    Entries older than ttl seconds are not served.
+    """
+
+    def __init__(self, path: str, ttl: float, precision: int):
+        self.path = path
+        self.ttl = ttl
+        self.precision = precision
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (latitude REAL, longitude REAL, fetched_at REAL NOT NULL, "
+                "time_of_call TEXT NOT NULL, forecasts TEXT NOT NULL, PRIMARY KEY (latitude, longitude))"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _key(self, location: Tuple[float, float]) -> Tuple[float, float]:
+        return round(location[0], self.precision), round(location[1], self.precision)
+
+    def get(
+        self, location: Tuple[float, float]
+    ) -> Optional[Tuple[datetime, CachedResponse]]:
+        """The time we called OWM and the forecasts it gave us, if we have a fresh response for this location."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT time_of_call, forecasts FROM responses WHERE latitude = ? AND longitude = ? AND fetched_at >= ?",
+                (*self._key(location), time.time() - self.ttl),
+            ).fetchone()
+        if row is None:
+            return None
+        return datetime.fromisoformat(row[0]), json.loads(row[1])
+
+    def set(
+        self,
+        location: Tuple[float, float],
+        time_of_call: datetime,
+        forecasts: CachedResponse,
+    ):
+        """Store a response, and clean up expired ones."""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (latitude, longitude, fetched_at, time_of_call, forecasts) VALUES (?, ?, ?, ?, ?)",
+                (
+                    *self._key(location),
+                    now,
+                    time_of_call.isoformat(),
+                    json.dumps(forecasts),
+                ),
+            )
+            conn.execute(
+                "DELETE FROM responses WHERE fetched_at < ?", (now - self.ttl,)
+            )
+
+
+def get_response_cache(app: Optional[Flask] = None) -> Optional[ResponseCache]:
+    """Get the response cache as configured for this app. None if it is switched off (TTL of 0)."""
+    if app is None:
+        app = current_app._get_current_object()
+    ttl = app.config.get(
+        "OPENWEATHERMAP_RESPONSE_CACHE_TTL", DEFAULT_RESPONSE_CACHE_TTL
+    )
+    if not ttl:
+        return None
+    path = app.config.get("OPENWEATHERMAP_RESPONSE_CACHE_FILE")
+    if path is None:
+        path = os.path.join(
+            make_file_path(app, region=""), DEFAULT_RESPONSE_CACHE_FILE_NAME
+        )
+    return ResponseCache(
+        path,
+        ttl=ttl,
+        precision=app.config.get(
+            "OPENWEATHERMAP_RESPONSE_CACHE_PRECISION", DEFAULT_RESPONSE_CACHE_PRECISION
+        ),
+    )
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+from typing import Dict, Iterator, List, Sequence, Tuple
+from datetime import datetime, timedelta
+
+import click
+import pandas as pd
+from sqlalchemy import delete, func, tuple_
+from flexmeasures.data import db
+from flexmeasures.data.models.time_series import Sensor, TimedBelief
+
+from .instrumenting import get_run_metrics
+from .modeling import (
+    get_or_create_owm_data_source,
+    get_or_create_owm_data_source_for_derived_data,
+)
+from .storing import BELIEF_KEY
+
+
+# The columns which identify a stored belief (the primary key of the timed_belief table)
+BELIEF_PRIMARY_KEY = BELIEF_KEY + ["belief_horizon"]
+
+
+def select_beliefs_to_keep(
+    beliefs: pd.DataFrame, keep_horizons: Sequence[timedelta]
+) -> pd.Series:
+    """
+    Mark which beliefs to keep (per sensor, event, source and cumulative probability):
+
+    - the latest belief (the one with the shortest horizon), and
+    - for each horizon to keep, the latest belief which was formed at least that long ahead.
+
+    For example, with keep_horizons 1h, 6h and 24h, we keep at most four beliefs about each event.
+    """
+    keep = pd.Series(False, index=beliefs.index)
+    if beliefs.empty:
+        return keep
+    keep[beliefs.groupby(BELIEF_KEY)["belief_horizon"].idxmin()] = True
+    for keep_horizon in keep_horizons:
+        ahead = beliefs[beliefs["belief_horizon"] >= keep_horizon]
+        keep[ahead.groupby(BELIEF_KEY)["belief_horizon"].idxmin()] = True
+    return keep
+
+
+def iterate_windows(
+    start: datetime, end: datetime, window: timedelta
+) -> Iterator[Tuple[datetime, datetime]]:
+    """Split [start, end) into consecutive windows, the last of which may be shorter."""
+    while start < end:
+        yield start, min(start + window, end)
+        start += window
+
+
+def compact_forecasts(
+    sensors: List[Sensor],
+    older_than: datetime,
+    keep_horizons: Sequence[timedelta],
+    batch_size: int,
+    window: timedelta = timedelta(days=1),
+    dry_run: bool = False,
+) -> Dict[Sensor, Dict[str, int]]:
+    """
+    Delete the beliefs by OWM (and those we derived from OWM data) about events before older_than, except the ones to keep (see select_beliefs_to_keep).
+    We work through one window of events per sensor at a time (so memory use stays bounded),
+    and delete in batches, each in its own transaction, so that the table is never locked for long.
+    Returns, per sensor, how many beliefs were kept and deleted (or would be deleted, for a dry run).
+    A dry run changes nothing in the database (not even the data sources we may create to look up the forecasts).
+    """
+    metrics = get_run_metrics()
+    source_ids = [
+        get_or_create_owm_data_source().id,
+        get_or_create_owm_data_source_for_derived_data().id,
+    ]
+    if not dry_run:
+        db.session.commit()  # in case we just created a data source
+    sensors_by_id = {sensor.id: sensor for sensor in sensors}
+    oldest_events = dict(
+        db.session.query(TimedBelief.sensor_id, func.min(TimedBelief.event_start))
+        .filter(
+            TimedBelief.sensor_id.in_(list(sensors_by_id)),
+            TimedBelief.source_id.in_(source_ids),
+            TimedBelief.event_start < older_than,
+        )
+        .group_by(TimedBelief.sensor_id)
+        .all()
+    )
+    counts = {
+        sensors_by_id[sensor_id]: dict(kept=0, deleted=0) for sensor_id in oldest_events
+    }
+    for sensor_id, oldest_event in oldest_events.items():
+        sensor = sensors_by_id[sensor_id]
+        for start, end in iterate_windows(oldest_event, older_than, window):
+            with metrics.measure("selecting"):
+                beliefs = pd.DataFrame(
+                    db.session.query(
+                        *[getattr(TimedBelief, column) for column in BELIEF_PRIMARY_KEY]
+                    )
+                    .filter(
+                        TimedBelief.sensor_id == sensor_id,
+                        TimedBelief.source_id.in_(source_ids),
+                        TimedBelief.event_start >= start,
+                        TimedBelief.event_start < end,
+                    )
+                    .all(),
+                    columns=BELIEF_PRIMARY_KEY,
+                )
+                keep = select_beliefs_to_keep(beliefs, keep_horizons)
+            counts[sensor]["kept"] += int(keep.sum())
+            counts[sensor]["deleted"] += int((~keep).sum())
+            if not dry_run:
+                with metrics.measure("deleting"):
+                    delete_beliefs(beliefs[~keep], batch_size)
+            else:
+                db.session.rollback()  # end the (read-only) transaction of this window
+        metrics.increment(
+            "rows_would_delete" if dry_run else "rows_deleted",
+            counts[sensor]["deleted"],
+        )
+        click.echo(
+            f"[FLEXMEASURES-OWM] {'Would delete' if dry_run else 'Deleted'} {counts[sensor]['deleted']} {sensor.name} forecasts (sensor {sensor.id}), kept {counts[sensor]['kept']}."
+        )
+    if dry_run:
+        db.session.rollback()
+    return counts
+
+
+def delete_beliefs(beliefs: pd.DataFrame, batch_size: int):
+    """Delete these beliefs (identified by their primary key), committing after each batch."""
+    key = [getattr(TimedBelief.__table__.c, column) for column in BELIEF_PRIMARY_KEY]
+    rows = [
+        (
+            int(row.sensor_id),
+            row.event_start.to_pydatetime(),
+            int(row.source_id),
+            float(row.cumulative_probability),
+            row.belief_horizon.to_pytimedelta(),
+        )
+        for row in beliefs.itertuples(index=False)
+    ]
+    for i in range(0, len(rows), batch_size):
+        db.session.execute(
+            delete(TimedBelief.__table__).where(
+                tuple_(*key).in_(rows[i : i + batch_size])
+            )
+        )
+        db.session.commit()
+    db.session.commit()  # also ends the transaction of our query if there was nothing to delete
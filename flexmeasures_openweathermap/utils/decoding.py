@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+from typing import Any, Dict, List
+from datetime import datetime
+import json
+
+import numpy as np
+import pandas as pd
+from timely_beliefs import BeliefsDataFrame
+from flexmeasures import Sensor, Source
+from flexmeasures.utils.time_utils import get_timezone
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore  # we fall back to the (slower) json module
+
+
+def loads(content: bytes | str) -> Any:
+    """Parse JSON (e.g. an OWM response), with orjson if it is installed."""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def dumps(obj: Any) -> str:
+    """Serialize to compact JSON, with orjson if it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def decode_forecasts(forecasts: List[Dict], labels: List[str]) -> pd.DataFrame:
+    """
+    Turn a list of OWM forecasts (e.g. the hourly ones) into a frame with one column per OWM label,
+    indexed by event start in server time. Values missing from the response become NaN.
+    """
+    return columns_to_frame(extract_columns(forecasts, labels))
+
+
+def extract_columns(forecasts: List[Dict], labels: List[str]) -> Dict[str, np.ndarray]:
+    """
+    Collect the values of each OWM label (plus the "dt" timestamps) from a list of OWM forecasts into arrays, in one pass per label.
+    This does not need an app context, so it can also run in worker processes.
+    """
+    return {
+        label: np.fromiter(
+            (fc.get(label, np.nan) for fc in forecasts),
+            dtype=float,
+            count=len(forecasts),
+        )
+        for label in dict.fromkeys(["dt"] + labels)
+    }
+
+
+def columns_to_frame(columns: Dict[str, np.ndarray]) -> pd.DataFrame:
+    """Index the columns from extract_columns by event start, in server time."""
+    columns = columns.copy()
+    event_starts = pd.to_datetime(columns.pop("dt"), unit="s", utc=True).tz_convert(
+        get_timezone()
+    )
+    return pd.DataFrame(
+        columns, index=pd.DatetimeIndex(event_starts, name="event_start")
+    )
+
+
+def make_beliefs(
+    values: pd.Series, sensor: Sensor, source: Source, belief_time: datetime
+) -> BeliefsDataFrame:
+    """Build a BeliefsDataFrame directly from a series of values indexed by event start."""
+    return BeliefsDataFrame(
+        pd.DataFrame(
+            {"event_start": values.index, "event_value": values.to_numpy()},
+        ),
+        sensor=sensor,
+        source=source,
+        belief_time=belief_time,
+    )
@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+from typing import Callable, Dict, List, Optional, Tuple
+import time
+
+import click
+from flask import current_app
+from rq.job import Job, JobStatus
+from flexmeasures.data import db
+
+from flexmeasures_openweathermap import (
+    DEFAULT_JOB_TIMEOUT,
+    DEFAULT_JOBS_WAIT_TIMEOUT,
+)
+from .instrumenting import (
+    RunMetrics,
+    start_run_metrics,
+    export_run_metrics,
+    get_run_metrics,
+)
+from .locating import WeatherSensorIndex
+from .owm import save_forecasts, get_api_key, load_weather_sensor_index
+from .planning import compile_ingestion_plan
+
+
+# FlexMeasures sets up this queue (and workers for it), see app.queues
+FORECASTING_QUEUE = "forecasting"
+FAILED_JOB_STATUSES = (JobStatus.FAILED, JobStatus.STOPPED, JobStatus.CANCELED)
+
+
+def get_forecasts_job(
+    locations: List[Tuple[float, float]],
+    store_as: str = "db",
+    region: str = "",
+    max_concurrency: int = 1,
+) -> Dict[str, int]:
+    """
+    Get and store forecasts for some locations, as a job (run by a FlexMeasures worker, within its app context).
+    The worker uses its own API key(s) and call budget, so these are not stored with the job.
+    Nobody else commits for a job, so we commit what we saved (or roll back if the job fails).
+    Returns the counts of what happened (see RunMetrics), for the enqueuing run to add up.
+    """
+    metrics = start_run_metrics("get-weather-forecasts-job")
+    try:
+        with metrics.measure("total"):
+            save_forecasts(
+                get_api_key(),
+                locations,
+                store_as=store_as,
+                region=region,
+                max_concurrency=max_concurrency,
+            )
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        export_run_metrics(metrics)
+    return metrics.as_dict()["counts"]
+
+
+def coalesce_locations_for_jobs(
+    locations: List[Tuple[float, float]],
+    sensor_index: Optional[WeatherSensorIndex] = None,
+) -> List[Tuple[float, float]]:
+    """
+    Find the locations to call OWM for (see IngestionPlan.coalesce) before splitting them into jobs,
+    so that grid points which share a weather station in different jobs do not lead to several calls for it.
+    """
+    if sensor_index is None:
+        sensor_index = load_weather_sensor_index()
+    return compile_ingestion_plan(locations, sensor_index).coalesce()
+
+
+def enqueue_forecast_jobs(
+    locations: List[Tuple[float, float]],
+    locations_per_job: int,
+    store_as: str = "db",
+    region: str = "",
+    max_concurrency: int = 1,
+) -> List[Job]:
+    """Split the locations into chunks and enqueue a job for each on the forecasting queue."""
+    queue = current_app.queues[FORECASTING_QUEUE]
+    job_timeout = current_app.config.get(
+        "OPENWEATHERMAP_JOB_TIMEOUT", DEFAULT_JOB_TIMEOUT
+    )
+    jobs = [
+        queue.enqueue(
+            get_forecasts_job,
+            kwargs=dict(
+                locations=locations[i : i + locations_per_job],
+                store_as=store_as,
+                region=region,
+                max_concurrency=max_concurrency,
+            ),
+            job_timeout=job_timeout,
+        )
+        for i in range(0, len(locations), locations_per_job)
+    ]
+    click.echo(
+        f"[FLEXMEASURES-OWM] Enqueued {len(jobs)} job(s) on the {FORECASTING_QUEUE} queue, for {len(locations)} location(s)."
+    )
+    return jobs
+
+
+def get_exc_string(job: Job) -> str:
+    """The traceback of a failed job (rq >= 1.12 keeps it in the job's results, older versions in exc_info)."""
+    latest_result = getattr(job, "latest_result", None)
+    if latest_result is not None:
+        result = latest_result()
+        if result is not None and result.exc_string:
+            return result.exc_string
+    return getattr(job, "exc_info", None) or "no error info"
+
+
+def wait_for_jobs(
+    jobs: List[Job],
+    timeout: float,
+    metrics: Optional[RunMetrics] = None,
+    poll_interval: float = 1.0,
+    clock: Callable[[], float] = time.monotonic,
+    sleep: Callable[[float], None] = time.sleep,
+) -> Dict[str, int]:
+    """
+    Wait until all jobs are done, then add up their counts (see get_forecasts_job) into the metrics of the current run (or the given metrics).
+    Raises if any job failed or if they took longer than the timeout, so that the run is reported as failed.
+    """
+    if metrics is None:
+        metrics = get_run_metrics()
+    deadline = clock() + timeout
+    pending, failed = list(jobs), []
+    counts: Dict[str, int] = {}
+    while pending:
+        still_pending = []
+        for job in pending:
+            status = job.get_status(refresh=True)
+            if status == JobStatus.FINISHED:
+                for counter, n in (job.result or {}).items():
+                    counts[counter] = counts.get(counter, 0) + n
+            elif status in FAILED_JOB_STATUSES:
+                failed.append(job)
+            else:
+                still_pending.append(job)
+        pending = still_pending
+        if pending:
+            if clock() >= deadline:
+                raise Exception(
+                    f"[FLEXMEASURES-OWM] {len(pending)} of {len(jobs)} job(s) were not done after {timeout} seconds (are workers running for the {FORECASTING_QUEUE} queue?)."
+                )
+            sleep(poll_interval)
+    for counter, n in counts.items():
+        metrics.increment(counter, n)
+    metrics.increment("jobs", len(jobs))
+    metrics.increment("jobs_failed", len(failed))
+    click.echo(
+        f"[FLEXMEASURES-OWM] {len(jobs) - len(failed)} of {len(jobs)} job(s) succeeded."
+    )
+    if counts:
+        click.echo(
+            f"[FLEXMEASURES-OWM] Together, they counted {', '.join(f'{n} {counter}' for counter, n in sorted(counts.items()))}."
+        )
+    if failed:
+        raise Exception(
+            f"[FLEXMEASURES-OWM] {len(failed)} of {len(jobs)} job(s) failed: "
+            + "; ".join(
+                f"{job.id} ({get_exc_string(job).strip().splitlines()[-1]})"
+                for job in failed
+            )
+        )
+    return counts
+
+
+def save_forecasts_with_jobs(
+    locations: List[Tuple[float, float]],
+    locations_per_job: int,
+    store_as: str = "db",
+    region: str = "",
+    max_concurrency: int = 1,
+    sensor_index: Optional[WeatherSensorIndex] = None,
+) -> Dict[str, int]:
+    """
+    Let workers get and store the forecasts (several workers, on several machines, can take on jobs in parallel), and wait for them.
+    When storing in the database, we first coalesce locations (see coalesce_locations_for_jobs).
+    """
+    # before jobs start their own (in case they run in this process)
+    metrics = get_run_metrics()
+    if store_as == "db":
+        locations = coalesce_locations_for_jobs(locations, sensor_index)
+        db.session.commit()  # so the workers find the data sources we may have just created
+    jobs = enqueue_forecast_jobs(
+        locations,
+        locations_per_job,
+        store_as=store_as,
+        region=region,
+        max_concurrency=max_concurrency,
+    )
+    return wait_for_jobs(
+        jobs,
+        timeout=current_app.config.get(
+            "OPENWEATHERMAP_JOBS_WAIT_TIMEOUT", DEFAULT_JOBS_WAIT_TIMEOUT
+        ),
+        metrics=metrics,
+    )
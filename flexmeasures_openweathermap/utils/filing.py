@@ -6,6 +6,10 @@ from flask import Flask, current_app
 from flexmeasures_openweathermap import DEFAULT_FILE_PATH_LOCATION
 
 
+# JSON files from one run are saved in a folder named after the time of the run
+RUN_FOLDER_FORMAT = "%Y-%m-%dT%H-%M-%S"
+
+
 def make_file_path(app: Flask, region: str) -> str:
     """Ensure and return path for weather data"""
     file_path = current_app.config.get(
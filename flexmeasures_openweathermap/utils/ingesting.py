@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+import os
+import re
+
+import click
+from flask import current_app
+import numpy as np
+from timely_beliefs import BeliefsDataFrame
+from flexmeasures.data import db
+from flexmeasures.data.models.time_series import Sensor
+from flexmeasures.utils.time_utils import get_timezone
+
+from flexmeasures_openweathermap import DEFAULT_MAXIMAL_DEGREE_LOCATION_DISTANCE
+from .instrumenting import get_run_metrics
+from .decoding import extract_columns, columns_to_frame, loads
+from .filing import RUN_FOLDER_FORMAT
+from .locating import WeatherSensorIndex
+from .owm import report_saved_beliefs
+from .planning import compile_ingestion_plan
+from .storing import save_beliefs_in_bulk
+
+
+# as written by save_forecasts_as_json
+FORECAST_FILE_PATTERN = re.compile(
+    r"^forecast_lat_(?P<latitude>-?\d+(\.\d+)?)_lng_(?P<longitude>-?\d+(\.\d+)?)\.json$"
+)
+
+
+class ArchivedForecastFile(NamedTuple):
+    path: str
+    region: str
+    belief_time: datetime
+    location: Tuple[float, float]
+
+
+def find_archived_forecast_files(
+    root: str,
+    region: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> List[ArchivedForecastFile]:
+    """
+    Walk the directory tree under root, looking for JSON files from save_forecasts_as_json.
+    These live in a folder per run (named after the time of the run, which becomes the belief time),
+    which might be in a subfolder per region.
+    Optionally, only select files from one region and/or from runs within [start, end].
+    """
+    archived_files = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        try:
+            run_time = datetime.strptime(os.path.basename(dir_path), RUN_FOLDER_FORMAT)
+        except ValueError:
+            continue
+        dir_names.clear()  # run folders have no subfolders we'd need
+        file_region = os.path.relpath(os.path.dirname(dir_path), root)
+        if file_region == ".":
+            file_region = ""
+        if region is not None and file_region != region:
+            continue
+        belief_time = get_timezone().localize(run_time)
+        if (start is not None and belief_time < start) or (
+            end is not None and belief_time > end
+        ):
+            continue
+        for file_name in sorted(file_names):
+            match = FORECAST_FILE_PATTERN.match(file_name)
+            if match is None:
+                continue
+            archived_files.append(
+                ArchivedForecastFile(
+                    path=os.path.join(dir_path, file_name),
+                    region=file_region,
+                    belief_time=belief_time,
+                    location=(
+                        float(match.group("latitude")),
+                        float(match.group("longitude")),
+                    ),
+                )
+            )
+    return sorted(archived_files, key=lambda f: (f.belief_time, f.path))
+
+
+def read_archived_forecasts(path: str, labels: List[str]) -> Dict[str, np.ndarray]:
+    """Parse one archived JSON file into columns (see extract_columns). Meant to run in worker processes."""
+    with open(path, "rb") as forecasts_file:
+        return extract_columns(loads(forecasts_file.read()), labels)
+
+
+def save_beliefs_per_run(
+    bdfs_per_run: Dict[datetime, List[BeliefsDataFrame]]
+) -> Dict[Sensor, Dict[str, int]]:
+    """
+    Save the beliefs of each run (by belief time) in turn, in order of belief time,
+    so that the unchanged check of a later run compares to what earlier runs saved (see save_beliefs_in_bulk).
+    Returns the counts of all runs, added up per sensor.
+    """
+    counts: Dict[Sensor, Dict[str, int]] = {}
+    for belief_time in sorted(bdfs_per_run):
+        for sensor, sensor_counts in save_beliefs_in_bulk(
+            bdfs_per_run[belief_time]
+        ).items():
+            total_counts = counts.setdefault(
+                sensor, dict(inserted=0, skipped=0, unchanged=0)
+            )
+            for outcome, count in sensor_counts.items():
+                total_counts[outcome] += count
+    return counts
+
+
+def ingest_json_archive(
+    root: str,
+    region: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    max_workers: Optional[int] = None,
+    batch_size: int = 500,
+) -> int:
+    """
+    Save forecasts from archived JSON files as beliefs, using the same sensor resolution as when we call OWM directly.
+    Files are parsed in parallel worker processes, and beliefs are bulk-saved (and committed) per batch of files.
+    Within a batch, each run is saved in turn (see save_beliefs_per_run), so that values which later runs repeat count as unchanged.
+    Returns the number of files ingested.
+    """
+    metrics = get_run_metrics()
+    with metrics.measure("finding files"):
+        archived_files = find_archived_forecast_files(root, region, start, end)
+    click.echo(f"[FLEXMEASURES-OWM] Found {len(archived_files)} archived JSON files.")
+    with metrics.measure("sensor lookup"):
+        sensor_index = WeatherSensorIndex.load(
+            current_app.config.get(
+                "OPENWEATHERMAP_MAXIMAL_DEGREE_LOCATION_DISTANCE",
+                DEFAULT_MAXIMAL_DEGREE_LOCATION_DISTANCE,
+            )
+        )
+        plan = compile_ingestion_plan(
+            list(dict.fromkeys(f.location for f in archived_files)), sensor_index
+        )
+    # for locations without weather sensors, there is nothing to save
+    archived_files = [f for f in archived_files if plan.ingestions.get(f.location)]
+    # archived files only hold hourly forecasts
+    read = partial(read_archived_forecasts, labels=plan.owm_labels["hourly"])
+    paths = [f.path for f in archived_files]
+    metrics.increment("files", len(paths))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        bdfs_per_run: Dict[datetime, List[BeliefsDataFrame]] = {}
+        for i, (archived_file, columns) in enumerate(
+            zip(
+                archived_files,
+                metrics.measure_iteration(
+                    executor.map(read, paths, chunksize=16), "reading files"
+                ),
+            ),
+            start=1,
+        ):
+            with metrics.measure("making beliefs"):
+                bdfs_per_run.setdefault(archived_file.belief_time, []).extend(
+                    plan.make_beliefs_from_frames(
+                        archived_file.location,
+                        archived_file.belief_time,
+                        {"hourly": columns_to_frame(columns)},
+                    )
+                )
+            if i % batch_size == 0 or i == len(archived_files):
+                click.echo(
+                    f"[FLEXMEASURES-OWM] Saving forecasts from {i} of {len(archived_files)} files ..."
+                )
+                with metrics.measure("saving"):
+                    saved = save_beliefs_per_run(bdfs_per_run)
+                    db.session.commit()
+                report_saved_beliefs(saved)
+                bdfs_per_run = {}
+    return len(archived_files)
@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+from typing import Dict, Iterable, Iterator, Optional, TypeVar
+from contextlib import contextmanager
+import json
+import os
+import re
+import threading
+import time
+
+from flask import Flask, current_app, has_app_context
+
+
+T = TypeVar("T")
+
+METRIC_PREFIX = "flexmeasures_owm"
+RUN_METRICS_EXTENSION = "flexmeasures-openweathermap-run-metrics"
+
+
+class RunMetrics:
+    """
+    Durations per phase and counts of what happened during one run (e.g. of get-weather-forecasts).
+    Durations of the same phase add up (e.g. all HTTP calls), so phases which run in parallel threads can sum up to more than the wall time.
+    Safe to use from several threads.
+    """
+
+    def __init__(self, run: str):
+        self.run = run
+        self.started_at = time.time()
+        self.durations: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add_duration(self, phase: str, seconds: float):
+        with self._lock:
+            self.durations[phase] = self.durations.get(phase, 0.0) + seconds
+
+    def increment(self, counter: str, n: int = 1):
+        with self._lock:
+            self.counts[counter] = self.counts.get(counter, 0) + n
+
+    @contextmanager
+    def measure(self, phase: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_duration(phase, time.perf_counter() - start)
+
+    def measure_iteration(self, items: Iterable[T], phase: str) -> Iterator[T]:
+        """Iterate, measuring the time spent waiting for each next item (e.g. when the work happens while iterating)."""
+        items = iter(items)
+        while True:
+            with self.measure(phase):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return dict(
+                run=self.run,
+                started_at=self.started_at,
+                durations={
+                    phase: round(seconds, 6)
+                    for phase, seconds in self.durations.items()
+                },
+                counts=dict(self.counts),
+            )
+
+    def to_prometheus(self) -> str:
+        """Describe the metrics in the Prometheus text format (e.g. for the textfile collector of the node exporter)."""
+        metrics = self.as_dict()
+        run_label = escape_label_value(self.run)
+        lines = [
+            f"# HELP {METRIC_PREFIX}_phase_duration_seconds Time spent per phase in the last run.",
+            f"# TYPE {METRIC_PREFIX}_phase_duration_seconds gauge",
+            *[
+                f'{METRIC_PREFIX}_phase_duration_seconds{{run="{run_label}",phase="{escape_label_value(phase)}"}} {seconds}'
+                for phase, seconds in metrics["durations"].items()
+            ],
+            f"# HELP {METRIC_PREFIX}_run_count What happened (and how often) in the last run, e.g. API calls, retries and rows written.",
+            f"# TYPE {METRIC_PREFIX}_run_count gauge",
+            *[
+                f'{METRIC_PREFIX}_run_count{{run="{run_label}",counter="{escape_label_value(counter)}"}} {count}'
+                for counter, count in metrics["counts"].items()
+            ],
+            f"# HELP {METRIC_PREFIX}_last_run_timestamp_seconds When the last run started.",
+            f"# TYPE {METRIC_PREFIX}_last_run_timestamp_seconds gauge",
+            f'{METRIC_PREFIX}_last_run_timestamp_seconds{{run="{run_label}"}} {metrics["started_at"]}',
+        ]
+        return "\n".join(lines) + "\n"
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def start_run_metrics(run: str, app: Optional[Flask] = None) -> RunMetrics:
+    """
+    Start collecting metrics for a new run of this app (see get_run_metrics), until the run ends (see end_run_metrics).
+    Runs can be nested (e.g. jobs which run in the process which enqueued them), the innermost run collects.
+    """
+    if app is None:
+        app = current_app._get_current_object()
+    metrics = RunMetrics(run)
+    app.extensions.setdefault(RUN_METRICS_EXTENSION, []).append(metrics)
+    return metrics
+
+
+def end_run_metrics(metrics: RunMetrics, app: Optional[Flask] = None):
+    """Detach the metrics of a run which ended, so nothing adds to them any more (an enclosing run, if any, collects again)."""
+    if app is None:
+        app = current_app._get_current_object()
+    runs = app.extensions.get(RUN_METRICS_EXTENSION, [])
+    if metrics in runs:
+        runs.remove(metrics)
+
+
+def get_run_metrics() -> RunMetrics:
+    """
+    Get the metrics of the current run, which the plugin's functions add to.
+    Outside of a run (see start_run_metrics), we hand out throwaway metrics, so callers need not check.
+    """
+    if has_app_context():
+        runs = current_app.extensions.get(RUN_METRICS_EXTENSION)
+        if runs:
+            return runs[-1]
+    return RunMetrics("none")
+
+
+def get_metrics_file_path(run: str, metrics_dir: str) -> str:
+    """One file per run name (e.g. per region served), so that runs do not overwrite each other's metrics."""
+    return os.path.join(metrics_dir, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', run)}.prom")
+
+
+def export_run_metrics(metrics: RunMetrics, app: Optional[Flask] = None):
+    """
+    End the run (see end_run_metrics), then log its metrics as one structured (JSON) line, and, if OPENWEATHERMAP_METRICS_DIR is set, write them in the Prometheus text format to <run>.prom in that directory.
+    The file is replaced atomically, so a scraper never reads a half-written file.
+    """
+    if app is None:
+        app = current_app._get_current_object()
+    end_run_metrics(metrics, app)
+    app.logger.info(json.dumps(dict(event="flexmeasures-owm-run", **metrics.as_dict())))
+    metrics_dir = app.config.get("OPENWEATHERMAP_METRICS_DIR")
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        metrics_file = get_metrics_file_path(metrics.run, metrics_dir)
+        tmp_file = f"{metrics_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(metrics.to_prometheus())
+        os.replace(tmp_file, metrics_file)
@@ -1,13 +1,16 @@
 from __future__ import annotations
 
-from typing import Tuple, List, Optional
+from typing import Tuple, List, Dict
+from collections import defaultdict
+import math
 
 import click
 from flask import current_app
+from sqlalchemy.orm import contains_eager
 
 from flexmeasures.utils.grid_cells import LatLngGrid, get_cell_nums
 from flexmeasures import Sensor
-from flexmeasures.data.models.generic_assets import GenericAsset
+from flexmeasures.data.models.generic_assets import GenericAsset, GenericAssetType
 from flexmeasures.utils import flexmeasures_inflection
 
 from .. import WEATHER_STATION_TYPE_NAME
@@ -76,6 +79,23 @@ def get_locations(
     return locations
 
 
+def coalesce_locations(
+    locations: List[Tuple[float, float]], resolution: float
+) -> List[Tuple[float, float]]:
+    """
+    Snap locations to a grid with the given resolution (in degrees), e.g. the resolution of the weather model behind OWM,
+    and drop the locations which end up in the same place.
+    """
+    snapped = (
+        (
+            round(round(location[0] / resolution) * resolution, 6),
+            round(round(location[1] / resolution) * resolution, 6),
+        )
+        for location in locations
+    )
+    return list(dict.fromkeys(snapped))
+
+
 def find_weather_sensor_by_location(
     location: Tuple[float, float],
     max_degree_difference_for_nearest_weather_sensor: int,
@@ -84,45 +104,202 @@ def find_weather_sensor_by_location(
     """
     Try to find a weather sensor of fitting type close by.
     Return None if the nearest weather sensor is further away than some minimum degrees or if no sensor was found at all.
+    This loads all weather sensors (see WeatherSensorIndex), so to look up many locations, load one index and use its find method.
     """
-    weather_sensor: Optional[Sensor] = Sensor.find_closest(
-        generic_asset_type_name=WEATHER_STATION_TYPE_NAME,
-        sensor_name=sensor_name,
-        lat=location[0],
-        lng=location[1],
-        n=1,
+    return WeatherSensorIndex.load(
+        max_degree_difference_for_nearest_weather_sensor
+    ).find(location, sensor_name)
+
+
+def is_within_degrees(
+    location: Tuple[float, float],
+    other_location: Tuple[float, float],
+    max_degree_difference: float,
+) -> bool:
+    """Check that two locations differ at most max_degree_difference in latitude as well as in longitude."""
+    return (
+        abs(location[0] - other_location[0]) <= max_degree_difference
+        and abs(location[1] - other_location[1]) <= max_degree_difference
     )
-    if weather_sensor is None:
-        current_app.logger.warning(
-            "[FLEXMEASURES-OWM] No weather sensor set up yet for measuring %s. Try the register-weather-sensor CLI task."
-            % sensor_name
+
+
+def great_circle_distance(
+    location: Tuple[float, float], other_location: Tuple[float, float]
+) -> float:
+    """Distance between two locations on earth, in km (haversine formula)."""
+    lat1, lng1, lat2, lng2 = map(math.radians, (*location, *other_location))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * 6371 * math.asin(math.sqrt(a))
+
+
+def warn_about_distant_weather_sensor(
+    location: Tuple[float, float],
+    closest_location: Tuple[float, float],
+    max_degree_difference_for_nearest_weather_sensor: float,
+    sensor_name: str,
+):
+    current_app.logger.warning(
+        f"[FLEXMEASURES-OWM] We found a weather station, but no sufficiently close weather sensor found (within {max_degree_difference_for_nearest_weather_sensor} {flexmeasures_inflection.pluralize('degree', max_degree_difference_for_nearest_weather_sensor)} distance) for measuring {sensor_name}! We're looking for: {location}, closest available: ({closest_location})"
+    )
+
+
+def get_weather_sensors() -> List[Sensor]:
+    """All sensors on weather stations, together with their weather station, in one query."""
+    return (
+        Sensor.query.join(GenericAsset, Sensor.generic_asset_id == GenericAsset.id)
+        .join(
+            GenericAssetType,
+            GenericAsset.generic_asset_type_id == GenericAssetType.id,
         )
-        return None
-    weather_station: GenericAsset = weather_sensor.generic_asset
-    if abs(
-        location[0] - weather_station.location[0]
-    ) > max_degree_difference_for_nearest_weather_sensor or abs(
-        location[1] - weather_station.location[1]
-        > max_degree_difference_for_nearest_weather_sensor
+        .filter(GenericAssetType.name == WEATHER_STATION_TYPE_NAME)
+        .options(contains_eager(Sensor.generic_asset))
+        .all()
+    )
+
+
+class WeatherSensorIndex:
+    """
+    In-memory index of all weather sensors (on weather station assets), so we can find the closest one without querying the database.
+    Sensors are bucketed by name and by grid cell, where cells are as large as the maximal degree difference we allow.
+    A lookup then only needs to look at the sensors in the neighbouring cells.
+    """
+
+    def __init__(
+        self,
+        sensors: List[Sensor],
+        max_degree_difference_for_nearest_weather_sensor: float,
     ):
-        current_app.logger.warning(
-            f"[FLEXMEASURES-OWM] We found a weather station, but no sufficiently close weather sensor found (within {max_degree_difference_for_nearest_weather_sensor} {flexmeasures_inflection.pluralize('degree', max_degree_difference_for_nearest_weather_sensor)} distance) for measuring {sensor_name}! We're looking for: {location}, closest available: ({weather_station.location})"
+        self.max_degree_difference = max_degree_difference_for_nearest_weather_sensor
+        self.cell_size = max(self.max_degree_difference, 0.01)
+        self.sensors_by_name: Dict[str, List[Sensor]] = defaultdict(list)
+        self.buckets: Dict[str, Dict[Tuple[int, int], List[Sensor]]] = defaultdict(
+            lambda: defaultdict(list)
+        )
+        for sensor in sensors:
+            station = sensor.generic_asset
+            if station.latitude is None or station.longitude is None:
+                continue
+            self.sensors_by_name[sensor.name].append(sensor)
+            self.buckets[sensor.name][self._cell(station.location)].append(sensor)
+
+    @classmethod
+    def load(
+        cls, max_degree_difference_for_nearest_weather_sensor: float
+    ) -> "WeatherSensorIndex":
+        """Load all weather sensors, together with their weather station, in one query."""
+        return cls(
+            get_weather_sensors(), max_degree_difference_for_nearest_weather_sensor
+        )
+
+    def _cell(self, location: Tuple[float, float]) -> Tuple[int, int]:
+        return (
+            math.floor(location[0] / self.cell_size),
+            math.floor(location[1] / self.cell_size),
+        )
+
+    def find(self, location: Tuple[float, float], sensor_name: str) -> Sensor | None:
+        """
+        Find the closest weather sensor with this name, within the maximal degree difference.
+        Return None (and log why) if there is none.
+        """
+        buckets = self.buckets.get(sensor_name, {})
+        min_cell = self._cell(
+            (
+                location[0] - self.max_degree_difference,
+                location[1] - self.max_degree_difference,
+            )
+        )
+        max_cell = self._cell(
+            (
+                location[0] + self.max_degree_difference,
+                location[1] + self.max_degree_difference,
+            )
+        )
+        candidates = [
+            sensor
+            for lat_cell in range(min_cell[0], max_cell[0] + 1)
+            for lng_cell in range(min_cell[1], max_cell[1] + 1)
+            for sensor in buckets.get((lat_cell, lng_cell), [])
+            if is_within_degrees(
+                location, sensor.generic_asset.location, self.max_degree_difference
+            )
+        ]
+        if candidates:
+            return min(
+                candidates,
+                key=lambda sensor: great_circle_distance(
+                    location, sensor.generic_asset.location
+                ),
+            )
+        if not self.sensors_by_name.get(sensor_name):
+            current_app.logger.warning(
+                "[FLEXMEASURES-OWM] No weather sensor set up yet for measuring %s. Try the register-weather-sensor CLI task."
+                % sensor_name
+            )
+            return None
+        closest_sensor = min(
+            self.sensors_by_name[sensor_name],
+            key=lambda sensor: great_circle_distance(
+                location, sensor.generic_asset.location
+            ),
+        )
+        warn_about_distant_weather_sensor(
+            location,
+            closest_sensor.generic_asset.location,
+            self.max_degree_difference,
+            sensor_name,
         )
         return None
-    return weather_sensor
 
 
 def get_location_by_asset_id(asset_id: int) -> Tuple[float, float]:
     """Get location for forecasting by passing an asset id"""
-    asset = GenericAsset.query.filter(
-        GenericAsset.generic_asset_type_id == asset_id
-    ).one_or_none()
-    if asset.generic_asset_type.name != WEATHER_STATION_TYPE_NAME:
-        raise Exception(
-            f"Asset {asset} does not seem to be a weather station we should use ― we expect an asset with type '{WEATHER_STATION_TYPE_NAME}'."
+    return get_locations_by_asset_ids([asset_id])[0]
+
+
+def get_locations_by_asset_ids(asset_ids: List[int]) -> List[Tuple[float, float]]:
+    """Get the locations of these weather stations (in the given order), with one query."""
+    assets = (
+        GenericAsset.query.join(
+            GenericAssetType,
+            GenericAsset.generic_asset_type_id == GenericAssetType.id,
         )
-    if asset is None:
+        .filter(GenericAsset.id.in_(asset_ids))
+        .options(contains_eager(GenericAsset.generic_asset_type))
+        .all()
+    )
+    assets_by_id = {asset.id: asset for asset in assets}
+    missing_ids = [asset_id for asset_id in asset_ids if asset_id not in assets_by_id]
+    if missing_ids:
         raise Exception(
-            "[FLEXMEASURES-OWM] No asset found for the given asset id %s." % asset_id
+            "[FLEXMEASURES-OWM] No asset found for the given asset id(s) %s."
+            % ", ".join(str(asset_id) for asset_id in missing_ids)
         )
-    return (asset.latitude, asset.longitude)
+    for asset in assets:
+        if asset.generic_asset_type.name != WEATHER_STATION_TYPE_NAME:
+            raise Exception(
+                f"[FLEXMEASURES-OWM] Asset {asset} does not seem to be a weather station we should use ― we expect an asset with type '{WEATHER_STATION_TYPE_NAME}'."
+            )
+        if asset.latitude is None or asset.longitude is None:
+            raise Exception(
+                f"[FLEXMEASURES-OWM] Weather station {asset} is missing location information [Latitude, Longitude]."
+            )
+    return [
+        (assets_by_id[asset_id].latitude, assets_by_id[asset_id].longitude)
+        for asset_id in dict.fromkeys(asset_ids)
+    ]
+
+
+def get_weather_station_locations(sensors: List[Sensor]) -> List[Tuple[float, float]]:
+    """Get the locations of the weather stations of these sensors (see get_weather_sensors), each once. Stations without a location are skipped."""
+    return list(
+        dict.fromkeys(
+            (sensor.generic_asset.latitude, sensor.generic_asset.longitude)
+            for sensor in sensors
+            if sensor.generic_asset.latitude is not None
+            and sensor.generic_asset.longitude is not None
+        )
+    )
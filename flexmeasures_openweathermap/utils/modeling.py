@@ -2,6 +2,7 @@ from packaging import version
 
 from flask import current_app
 from flexmeasures.data.models.generic_assets import GenericAsset, GenericAssetType
+from flexmeasures.data.models.time_series import Sensor
 from flexmeasures import Source, __version__ as flexmeasures_version
 from flexmeasures.data import db
 from flexmeasures.data.services.data_sources import get_or_create_source
@@ -9,6 +10,7 @@ from flexmeasures.data.services.data_sources import get_or_create_source
 from flexmeasures_openweathermap import DEFAULT_DATA_SOURCE_NAME
 from flexmeasures_openweathermap import WEATHER_STATION_TYPE_NAME
 from flexmeasures_openweathermap import DEFAULT_WEATHER_STATION_NAME
+from ..sensor_specs import get_supported_sensor_spec, get_supported_sensors_str
 
 
 if version.parse(flexmeasures_version) < version.parse("0.13"):
@@ -55,27 +57,53 @@ def get_or_create_weather_station_type() -> GenericAssetType:
 
 def get_or_create_weather_station(latitude: float, longitude: float) -> GenericAsset:
     """Make sure a weather station exists at this location."""
-    station_name = current_app.config.get(
-        "WEATHER_STATION_NAME", DEFAULT_WEATHER_STATION_NAME
-    )
     weather_station = GenericAsset.query.filter(
         GenericAsset.latitude == latitude, GenericAsset.longitude == longitude
     ).one_or_none()
     if weather_station is None:
-        weather_station_type = get_or_create_weather_station_type()
-        weather_station = GenericAsset(
-            name=station_name,
-            generic_asset_type=weather_station_type,
-            latitude=latitude,
-            longitude=longitude,
+        weather_station = make_weather_station(
+            latitude, longitude, get_or_create_weather_station_type()
         )
         db.session.add(weather_station)
     return weather_station
 
 
+def make_weather_station(
+    latitude: float, longitude: float, weather_station_type: GenericAssetType
+) -> GenericAsset:
+    """Make a new weather station at this location (without adding it to the session)."""
+    return GenericAsset(
+        name=current_app.config.get(
+            "WEATHER_STATION_NAME", DEFAULT_WEATHER_STATION_NAME
+        ),
+        generic_asset_type=weather_station_type,
+        latitude=latitude,
+        longitude=longitude,
+    )
+
+
+def make_weather_sensor(
+    name: str, weather_station: GenericAsset, timezone: str
+) -> Sensor:
+    """Make a new weather sensor from its supported specs (without adding it to the session)."""
+    fm_sensor_specs = get_supported_sensor_spec(name)
+    if fm_sensor_specs is None:
+        raise Exception(
+            f"[FLEXMEASURES-OWM] Weather sensor '{name}' is not supported (supported are: {get_supported_sensors_str()})."
+        )
+    fm_sensor_specs["generic_asset"] = weather_station
+    fm_sensor_specs["timezone"] = timezone
+    fm_sensor_specs["name"] = fm_sensor_specs.pop("fm_sensor_name")
+    fm_sensor_specs.pop("owm_sensor_name")
+    fm_sensor_specs.pop("owm_section")
+    sensor = Sensor(**fm_sensor_specs)
+    sensor.attributes = fm_sensor_specs["attributes"]
+    return sensor
+
+
 def get_weather_station_by_asset_id(asset_id: int) -> GenericAsset:
     weather_station = GenericAsset.query.filter(
-        GenericAsset.generic_asset_type_id == asset_id
+        GenericAsset.id == asset_id
     ).one_or_none()
     if weather_station is None:
         raise Exception(
@@ -1,50 +1,45 @@
 from __future__ import annotations
 
-from typing import Tuple, List, Dict, Optional
+from typing import Tuple, List, Dict, Iterator, Optional
 import os
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import json
 
 import click
 from flask import current_app
-import requests
-from humanize import naturaldelta
 from timely_beliefs import BeliefsDataFrame
 from flexmeasures.utils.time_utils import as_server_time, get_timezone, server_now
-from flexmeasures.data.models.time_series import Sensor, TimedBelief
-from flexmeasures.data.utils import save_to_db
-
-from flexmeasures_openweathermap import DEFAULT_MAXIMAL_DEGREE_LOCATION_DISTANCE
-from .locating import find_weather_sensor_by_location
-from ..sensor_specs import mapping
-from .modeling import (
-    get_or_create_owm_data_source,
-    get_or_create_owm_data_source_for_derived_data,
+from flexmeasures.data.models.time_series import Sensor
+
+from flexmeasures_openweathermap import (
+    DEFAULT_API_URL,
+    DEFAULT_MAXIMAL_DEGREE_LOCATION_DISTANCE,
+)
+from .locating import WeatherSensorIndex, coalesce_locations
+from .budgeting import check_call_budget, parse_api_keys
+from ..sensor_specs import (  # noqa: F401 (get_supported_* used to live here)
+    mapping,
+    get_supported_sensor_spec,
+    get_supported_sensors_str,
+)
+from .requesting import get_owm_client
+from .caching import save_clear_sky_cache, get_response_cache, ResponseCache
+from .storing import save_beliefs_in_bulk
+from .planning import compile_ingestion_plan
+from .filing import make_file_path, RUN_FOLDER_FORMAT
+from .instrumenting import get_run_metrics
+from .decoding import loads
+from .archiving import (
+    ARCHIVE_FOLDER_NAME,
+    append_to_archive,
+    check_pyarrow_is_installed,
 )
-from .radiating import compute_irradiance
 
 
 API_VERSION = "3.0"
-
-
-def get_supported_sensor_spec(name: str) -> Optional[dict]:
-    """
-    Find the specs from a sensor by name.
-    """
-    for supported_sensor_spec in mapping:
-        if supported_sensor_spec["fm_sensor_name"] == name:
-            return supported_sensor_spec.copy()
-    return None
-
-
-def get_supported_sensors_str() -> str:
-    """A string - list of supported sensors, also revealing their unit"""
-    return ", ".join(
-        [
-            f"{sensor_specs['fm_sensor_name']} ({sensor_specs['unit']})"
-            for sensor_specs in mapping
-        ]
-    )
+# The sections of a one-call response (besides the current weather)
+ONECALL_SECTIONS = ["minutely", "hourly", "daily", "alerts"]
 
 
 def call_openweatherapi(
@@ -54,172 +49,243 @@ def call_openweatherapi(
     Make a single "one-call" to the Open Weather API and return the API timestamp as well as the 48 hourly forecasts.
     See https://openweathermap.org/api/one-call-3 for docs.
     Note that the first forecast is about the current hour.
+    The call is made with the (pooled and retrying) client from get_owm_client, which raises OpenWeatherMapError if it fails.
     """
+    time_of_api_call, data = call_onecall_api(api_key, location, sections=["hourly"])
+    return time_of_api_call, data["hourly"]
+
+
+def call_openweatherapi_with_nowcasts(
+    api_key: str, location: Tuple[float, float]
+) -> Tuple[datetime, List[Dict], List[Dict]]:
+    """
+    Like call_openweatherapi, but in the same call also get the minutely nowcast (precipitation for the next 60 minutes).
+    OWM does not have a nowcast for all locations, in which case that list is empty.
+    """
+    time_of_api_call, data = call_onecall_api(
+        api_key, location, sections=["hourly", "minutely"]
+    )
+    return time_of_api_call, data["hourly"], data.get("minutely", [])
+
+
+def call_onecall_api(
+    api_key: str, location: Tuple[float, float], sections: List[str]
+) -> Tuple[datetime, Dict]:
+    """Make a single "one-call", only asking for the given sections of the response, and return the API timestamp and the response."""
     check_openweathermap_version(API_VERSION)
-    query_str = f"lat={location[0]}&lon={location[1]}&units=metric&exclude=minutely,daily,alerts&appid={api_key}"
-    res = requests.get(
-        f"http://api.openweathermap.org/data/{API_VERSION}/onecall?{query_str}"
+    api_url = current_app.config.get("OPENWEATHERMAP_API_URL", DEFAULT_API_URL)
+    res = get_owm_client().get(
+        f"{api_url}/{API_VERSION}/onecall",
+        params=dict(
+            lat=location[0],
+            lon=location[1],
+            units="metric",
+            exclude=",".join(
+                section for section in ONECALL_SECTIONS if section not in sections
+            ),
+            appid=api_key,
+        ),
     )
-    assert (
-        res.status_code == 200
-    ), f"OpenWeatherMap returned status code {res.status_code}: {res.text}"
-    data = res.json()
+    data = loads(res.content)
     time_of_api_call = as_server_time(
         datetime.fromtimestamp(data["current"]["dt"], tz=get_timezone())
     ).replace(second=0, microsecond=0)
-    return time_of_api_call, data["hourly"]
+    return time_of_api_call, data
+
+
+def fetch_forecasts(
+    api_key: str,
+    locations: List[Tuple[float, float]],
+    max_concurrency: int = 1,
+    with_nowcasts: bool = False,
+) -> Iterator[Tuple[Tuple[float, float], datetime, List[Dict], List[Dict]]]:
+    """
+    Call the OpenWeatherMap API for each location, using up to max_concurrency parallel calls.
+    Yields the location, the server time at which we called, the (hourly) forecasts and the (minutely) nowcasts,
+    in the order of the given locations. Nowcasts are only asked for if with_nowcasts is True (otherwise, they are empty).
+    Only the API calls happen in worker threads, so callers can safely use the database session while iterating.
+    Fresh responses from the response cache (if switched on) are served instead of calling the API.
+    In that case, the time at which we called is the time of the cached call.
+    """
+    app = current_app._get_current_object()
+    response_cache = get_response_cache(app)
+    metrics = get_run_metrics()
+
+    def fetch(
+        location: Tuple[float, float]
+    ) -> Tuple[Tuple[float, float], datetime, List[Dict], List[Dict]]:
+        if response_cache is not None:
+            cached_response = get_cached_response(
+                response_cache, location, with_nowcasts
+            )
+            if cached_response is not None:
+                metrics.increment("response_cache_hits")
+                return location, *cached_response
+        with app.app_context():
+            now = server_now()
+            if with_nowcasts:
+                (
+                    owm_time_of_api_call,
+                    forecasts,
+                    nowcasts,
+                ) = call_openweatherapi_with_nowcasts(api_key, location)
+            else:
+                owm_time_of_api_call, forecasts = call_openweatherapi(api_key, location)
+                nowcasts = []
+            diff_fm_owm = now - owm_time_of_api_call
+            if abs(diff_fm_owm) > timedelta(minutes=10):
+                from humanize import naturaldelta
+
+                click.echo(
+                    f"[FLEXMEASURES-OWM] Warning: difference between this server and OWM is {naturaldelta(diff_fm_owm)}"
+                )
+        if response_cache is not None:
+            response_cache.set(
+                location,
+                now,
+                dict(hourly=forecasts, minutely=nowcasts)
+                if with_nowcasts
+                else forecasts,
+            )
+        return location, now, forecasts, nowcasts
+
+    if max_concurrency <= 1 or len(locations) <= 1:
+        for location in locations:
+            yield fetch(location)
+        return
+    with ThreadPoolExecutor(
+        max_workers=min(max_concurrency, len(locations)),
+        thread_name_prefix="owm-fetch",
+    ) as executor:
+        yield from executor.map(fetch, locations)
+
+
+def get_cached_response(
+    response_cache: ResponseCache, location: Tuple[float, float], with_nowcasts: bool
+) -> Optional[Tuple[datetime, List[Dict], List[Dict]]]:
+    """
+    Get the time of the call, forecasts and nowcasts from the response cache.
+    Responses with nowcasts are cached as a dict with both sections, others as the list of hourly forecasts.
+    If we need nowcasts, a cached response without them does not count.
+    """
+    cached_response = response_cache.get(location)
+    if cached_response is None:
+        return None
+    time_of_call, response = cached_response
+    if isinstance(response, dict):
+        return time_of_call, response["hourly"], response["minutely"]
+    if with_nowcasts:
+        return None
+    return time_of_call, response, []
 
 
 def save_forecasts_in_db(
     api_key: str,
     locations: List[Tuple[float, float]],
+    max_concurrency: int = 1,
+    sensor_index: Optional[WeatherSensorIndex] = None,
 ):
     """Process the response from OpenWeatherMap API into timed beliefs.
-    Collects all forecasts for all locations and all sensors at all locations, then bulk-saves them.
+    Collects all forecasts for all locations and all sensors at all locations, then bulk-saves them (see save_beliefs_in_bulk).
+    If any of the sensors is filled from the minutely nowcast, we also ask OWM for that (in the same calls).
+    API calls for several locations can be made in parallel (see fetch_forecasts), while the forecasts are processed here.
+    Pass a sensor index to re-use one which is already loaded (e.g. by a long-running process), otherwise we load one.
     """
     click.echo("[FLEXMEASURES-OWM] Getting weather forecasts:")
     click.echo("[FLEXMEASURES-OWM] Latitude, Longitude")
     click.echo("[FLEXMEASURES-OWM] -----------------------")
-    max_degree_difference_for_nearest_weather_sensor = current_app.config.get(
-        "OPENWEATHERMAP_MAXIMAL_DEGREE_LOCATION_DISTANCE",
-        DEFAULT_MAXIMAL_DEGREE_LOCATION_DISTANCE,
+    metrics = get_run_metrics()
+    metrics.increment("locations", len(locations))
+    with metrics.measure("sensor lookup"):
+        if sensor_index is None:
+            sensor_index = load_weather_sensor_index()
+        plan = compile_ingestion_plan(locations, sensor_index)
+        locations_to_call = plan.coalesce()
+    click.echo(
+        f"[FLEXMEASURES-OWM] Calling OpenWeatherMap for {len(locations_to_call)} location(s), covering the weather sensors of all {len(locations)} location(s)."
     )
-    for location in locations:
+    check_call_budget(num_calls=len(locations_to_call))
+    db_forecasts: List[BeliefsDataFrame] = []  # collect beliefs for all sensors
+    for location, now, forecasts, nowcasts in metrics.measure_iteration(
+        fetch_forecasts(
+            api_key,
+            locations_to_call,
+            max_concurrency,
+            with_nowcasts=plan.needs_nowcasts,
+        ),
+        "fetching",
+    ):
         click.echo("[FLEXMEASURES] %s, %s" % location)
-        weather_sensors: Dict[
-            str, Sensor
-        ] = {}  # keep track of the sensors to save lookups
-        db_forecasts: Dict[Sensor, List[TimedBelief]] = {}  # collect beliefs per sensor
-
-        now = server_now()
-        owm_time_of_api_call, forecasts = call_openweatherapi(api_key, location)
-        diff_fm_owm = now - owm_time_of_api_call
-        if abs(diff_fm_owm) > timedelta(minutes=10):
-            click.echo(
-                f"[FLEXMEASURES-OWM] Warning: difference between this server and OWM is {naturaldelta(diff_fm_owm)}"
-            )
         click.echo(
             f"[FLEXMEASURES-OWM] Called OpenWeatherMap API successfully at {now}."
         )
+        # this includes the forecast for the current hour (horizon 0)
+        with metrics.measure("making beliefs"):
+            db_forecasts.extend(plan.make_beliefs(location, now, forecasts, nowcasts))
+    save_clear_sky_cache()
+    click.echo(
+        f"[FLEXMEASURES-OWM] Saving forecasts for {len(set(bdf.sensor for bdf in db_forecasts))} sensor(s) ..."
+    )
+    with metrics.measure("saving"):
+        saved = save_beliefs_in_bulk(db_forecasts)
+    report_saved_beliefs(saved)
 
-        # loop through forecasts, including the one of current hour (horizon 0)
-        for fc in forecasts:
-            fc_datetime = as_server_time(
-                datetime.fromtimestamp(fc["dt"], get_timezone())
-            )
-            click.echo(f"[FLEXMEASURES-OWM] Processing forecast for {fc_datetime} ...")
-            data_source = get_or_create_owm_data_source()
-            for sensor_specs in mapping:
-                sensor_name = str(sensor_specs["fm_sensor_name"])
-                owm_response_label = sensor_specs["owm_sensor_name"]
-                if owm_response_label in fc:
-                    weather_sensor = get_weather_sensor(
-                        sensor_specs,
-                        location,
-                        weather_sensors,
-                        max_degree_difference_for_nearest_weather_sensor,
-                    )
-                    if weather_sensor is not None:
-                        click.echo(
-                            f"Found pre-configured weather sensor {weather_sensor.name} ..."
-                        )
-                        if weather_sensor not in db_forecasts.keys():
-                            db_forecasts[weather_sensor] = []
-
-                        fc_value = fc[owm_response_label]
-
-                        # the irradiance is not available in OWM -> we compute it ourselves
-                        if sensor_name == "irradiance":
-                            fc_value = compute_irradiance(
-                                location[0],
-                                location[1],
-                                fc_datetime,
-                                # OWM sends cloud cover in percent, we need a ratio
-                                fc_value / 100.0,
-                            )
-                            data_source = (
-                                get_or_create_owm_data_source_for_derived_data()
-                            )
-
-                        db_forecasts[weather_sensor].append(
-                            TimedBelief(
-                                event_start=fc_datetime,
-                                belief_time=now,
-                                event_value=fc_value,
-                                sensor=weather_sensor,
-                                source=data_source,
-                            )
-                        )
-                else:
-                    # we will not fail here, but issue a warning
-                    msg = "No label '%s' in response data for time %s" % (
-                        owm_response_label,
-                        fc_datetime,
-                    )
-                    click.echo("[FLEXMEASURES-OWM] %s" % msg)
-                    current_app.logger.warning(msg)
-    for sensor in db_forecasts.keys():
-        click.echo(f"[FLEXMEASURES-OWM] Saving {sensor.name} forecasts ...")
-        if len(db_forecasts[sensor]) == 0:
-            # This is probably a serious problem
-            raise Exception(
-                "Nothing to put in the database was produced. That does not seem right..."
-            )
-        status = save_to_db(BeliefsDataFrame(db_forecasts[sensor]))
-        if status == "success_but_nothing_new":
-            current_app.logger.info(
-                "[FLEXMEASURES-OWM] Done. These beliefs had already been saved before."
-            )
-        elif status == "success_with_unchanged_beliefs_skipped":
-            current_app.logger.info(
-                "[FLEXMEASURES-OWM] Done. Some beliefs had already been saved before."
-            )
+
+def load_weather_sensor_index(
+    sensors: Optional[List[Sensor]] = None,
+) -> WeatherSensorIndex:
+    """Index all weather sensors, to look up the closest one within OPENWEATHERMAP_MAXIMAL_DEGREE_LOCATION_DISTANCE.
+    Pass the sensors if you already loaded them (see get_weather_sensors), otherwise we load them.
+    """
+    max_degree_difference_for_nearest_weather_sensor = current_app.config.get(
+        "OPENWEATHERMAP_MAXIMAL_DEGREE_LOCATION_DISTANCE",
+        DEFAULT_MAXIMAL_DEGREE_LOCATION_DISTANCE,
+    )
+    if sensors is None:
+        return WeatherSensorIndex.load(max_degree_difference_for_nearest_weather_sensor)
+    return WeatherSensorIndex(sensors, max_degree_difference_for_nearest_weather_sensor)
 
 
-def get_weather_sensor(
-    sensor_specs: dict,
-    location: Tuple[float, float],
-    weather_sensors: Dict[str, Sensor],
-    max_degree_difference_for_nearest_weather_sensor: int,
-) -> Sensor | None:
-    """Get the weather sensor for this own response label and location, if we haven't retrieved it already."""
-    sensor_name = str(sensor_specs["fm_sensor_name"])
-    if sensor_name in weather_sensors:
-        weather_sensor = weather_sensors[sensor_name]
-    else:
-        weather_sensor = find_weather_sensor_by_location(
-            location,
-            max_degree_difference_for_nearest_weather_sensor,
-            sensor_name=sensor_name,
-        )
-        weather_sensors[sensor_name] = weather_sensor
-    if (
-        weather_sensor is not None
-        and weather_sensor.event_resolution != sensor_specs["event_resolution"]
-    ):
-        raise Exception(
-            f"[FLEXMEASURES-OWM] The weather sensor found for {sensor_name} has an unfitting event resolution (should be {sensor_specs['event_resolution']}, but is {weather_sensor.event_resolution}."
+def report_saved_beliefs(counts: Dict[Sensor, Dict[str, int]]):
+    """Tell per sensor how many beliefs were new, which ones we had saved before and which ones did not change.
+    The totals also go into the metrics of the run (as rows_inserted, rows_skipped and rows_unchanged).
+    """
+    metrics = get_run_metrics()
+    for sensor, sensor_counts in counts.items():
+        for outcome, count in sensor_counts.items():
+            metrics.increment(f"rows_{outcome}", count)
+        click.echo(
+            f"[FLEXMEASURES-OWM] Saved {sensor.name} forecasts (sensor {sensor.id}): {sensor_counts['inserted']} new, {sensor_counts['skipped']} saved before, {sensor_counts['unchanged']} unchanged."
         )
-    return weather_sensor
+        if sensor_counts["inserted"] == 0:
+            current_app.logger.info(
+                f"[FLEXMEASURES-OWM] These {sensor.name} beliefs had already been saved before."
+            )
 
 
 def save_forecasts_as_json(
-    api_key: str, locations: List[Tuple[float, float]], data_path: str
+    api_key: str,
+    locations: List[Tuple[float, float]],
+    data_path: str,
+    max_concurrency: int = 1,
 ):
-    """Get forecasts, then store each as a raw JSON file, for later processing."""
+    """Get forecasts, then store each as a raw JSON file, for later processing.
+    If OPENWEATHERMAP_GRID_RESOLUTION is set, locations are snapped to that grid first, so we call OWM only once per grid cell.
+    """
     click.echo("[FLEXMEASURES-OWM] Getting weather forecasts:")
     click.echo("[FLEXMEASURES-OWM] Latitude, Longitude")
     click.echo("[FLEXMEASURES-OWM] ----------------------")
-    for location in locations:
+    grid_resolution = current_app.config.get("OPENWEATHERMAP_GRID_RESOLUTION")
+    if grid_resolution:
+        locations = coalesce_locations(locations, grid_resolution)
+    check_call_budget(num_calls=len(locations))
+    metrics = get_run_metrics()
+    metrics.increment("locations", len(locations))
+    for location, now, forecasts, _ in metrics.measure_iteration(
+        fetch_forecasts(api_key, locations, max_concurrency), "fetching"
+    ):
         click.echo("[FLEXMEASURES-OWM] %s, %s" % location)
-        now = server_now()
-        owm_time_of_api_call, forecasts = call_openweatherapi(api_key, location)
-        diff_fm_owm = now - owm_time_of_api_call
-        if abs(diff_fm_owm) > timedelta(minutes=10):
-            click.echo(
-                f"[FLEXMEASURES-OWM] Warning: difference between this server and OWM is {naturaldelta(diff_fm_owm)}"
-            )
-        now_str = now.strftime("%Y-%m-%dT%H-%M-%S")
+        now_str = now.strftime(RUN_FOLDER_FORMAT)
         path_to_files = os.path.join(data_path, now_str)
         if not os.path.exists(path_to_files):
             click.echo(f"[FLEXMEASURES-OWM] Making directory: {path_to_files} ...")
@@ -229,10 +295,91 @@ def save_forecasts_as_json(
             str(location[0]),
             str(location[1]),
         )
-        with open(forecasts_file, "w") as outfile:
+        with metrics.measure("writing files"), open(forecasts_file, "w") as outfile:
             json.dump(forecasts, outfile)
 
 
+def save_forecasts_in_archive(
+    api_key: str,
+    locations: List[Tuple[float, float]],
+    data_path: str,
+    max_concurrency: int = 1,
+):
+    """Get forecasts, then append them to a columnar archive (one Parquet file per run, see append_to_archive), for later processing.
+    Like for JSON files, locations are snapped to a grid first if OPENWEATHERMAP_GRID_RESOLUTION is set.
+    """
+    check_pyarrow_is_installed()
+    click.echo("[FLEXMEASURES-OWM] Getting weather forecasts:")
+    click.echo("[FLEXMEASURES-OWM] Latitude, Longitude")
+    click.echo("[FLEXMEASURES-OWM] ----------------------")
+    grid_resolution = current_app.config.get("OPENWEATHERMAP_GRID_RESOLUTION")
+    if grid_resolution:
+        locations = coalesce_locations(locations, grid_resolution)
+    check_call_budget(num_calls=len(locations))
+    metrics = get_run_metrics()
+    metrics.increment("locations", len(locations))
+    run_time = server_now()
+    fetched = []
+    for location, now, forecasts, _ in metrics.measure_iteration(
+        fetch_forecasts(api_key, locations, max_concurrency), "fetching"
+    ):
+        click.echo("[FLEXMEASURES-OWM] %s, %s" % location)
+        fetched.append((location, now, forecasts))
+    with metrics.measure("writing files"):
+        archive_file = append_to_archive(
+            os.path.join(data_path, ARCHIVE_FOLDER_NAME), run_time, fetched
+        )
+    click.echo(f"[FLEXMEASURES-OWM] Archived forecasts in {archive_file}.")
+
+
+def save_forecasts(
+    api_key: str,
+    locations: List[Tuple[float, float]],
+    store_as: str = "db",
+    region: str = "",
+    max_concurrency: int = 1,
+    sensor_index: Optional[WeatherSensorIndex] = None,
+):
+    """Get forecasts and store them as asked: in the database ("db"), as JSON files ("json") or in the columnar archive ("parquet").
+    Files go into the subfolder for the region.
+    """
+    if store_as == "db":
+        save_forecasts_in_db(
+            api_key,
+            locations,
+            max_concurrency=max_concurrency,
+            sensor_index=sensor_index,
+        )
+    elif store_as == "parquet":
+        save_forecasts_in_archive(
+            api_key,
+            locations,
+            data_path=make_file_path(current_app, region),
+            max_concurrency=max_concurrency,
+        )
+    elif store_as == "json":
+        save_forecasts_as_json(
+            api_key,
+            locations,
+            data_path=make_file_path(current_app, region),
+            max_concurrency=max_concurrency,
+        )
+    else:
+        raise Exception(
+            f"[FLEXMEASURES-OWM] Cannot store forecasts as '{store_as}' (choose from db, json or parquet)."
+        )
+
+
+def get_api_key() -> str:
+    """The API key to call OWM with. For a list of keys, this is the first one (but the client takes turns between them, see APIKeyPool)."""
+    api_keys = parse_api_keys(current_app.config.get("OPENWEATHERMAP_API_KEY"))
+    if not api_keys:
+        raise Exception(
+            "[FLEXMEASURES-OWM] Setting OPENWEATHERMAP_API_KEY not available."
+        )
+    return str(api_keys[0]["key"])
+
+
 def check_openweathermap_version(api_version: str):
     supported_versions = ["2.5", "3.0"]
     if api_version not in supported_versions:
@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+from typing import Callable, Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import click
+from flask import current_app
+import pandas as pd
+from timely_beliefs import BeliefsDataFrame
+from flexmeasures import Sensor, Source
+
+from flexmeasures_openweathermap import DEFAULT_CLEAR_SKY_CACHE_PRECISION
+from ..sensor_specs import mapping
+from .caching import get_clear_sky_cache
+from .decoding import decode_forecasts, make_beliefs
+from .instrumenting import get_run_metrics
+from .locating import WeatherSensorIndex
+from .modeling import (
+    get_or_create_owm_data_source,
+    get_or_create_owm_data_source_for_derived_data,
+)
+from .radiating import compute_irradiances
+
+
+# An extractor turns the values of an OWM label (indexed by event start) into the values for a sensor at some location
+Extractor = Callable[[Tuple[float, float], pd.Series], pd.Series]
+
+
+def extract_values(location: Tuple[float, float], values: pd.Series) -> pd.Series:
+    """Most OWM values can be used as they are."""
+    return values
+
+
+def compute_irradiances_for_location(
+    location: Tuple[float, float], cloud_cover: pd.Series
+) -> pd.Series:
+    """Compute the irradiance for all forecasts of one location in one go, from their cloud cover (in percent, indexed by event start).
+    Clear-sky irradiance comes from the cache where possible, so per call we mostly only adjust for cloud cover.
+    """
+    with get_run_metrics().measure("irradiance"):
+        values = compute_irradiances(
+            [location[0]] * len(cloud_cover),
+            [location[1]] * len(cloud_cover),
+            cloud_cover.index,
+            # OWM sends cloud cover in percent, we need a ratio
+            cloud_cover.to_numpy() / 100.0,
+            cache=get_clear_sky_cache(),
+            precision=current_app.config.get(
+                "OPENWEATHERMAP_CLEAR_SKY_CACHE_PRECISION",
+                DEFAULT_CLEAR_SKY_CACHE_PRECISION,
+            ),
+        )
+    return pd.Series(values, index=cloud_cover.index)
+
+
+# Sensors whose values we derive ourselves, by their name in FM (see sensor_specs)
+DERIVED_DATA_EXTRACTORS: Dict[str, Extractor] = {
+    # the irradiance is not available in OWM -> we compute it ourselves
+    "irradiance": compute_irradiances_for_location,
+}
+
+
+@dataclass
+class SensorIngestion:
+    """How to get the values for one sensor from the OWM response."""
+
+    sensor: Sensor
+    owm_label: str
+    source: Source
+    extract: Extractor
+    owm_section: str = "hourly"  # which part of the OWM response holds its values
+
+
+@dataclass
+class IngestionPlan:
+    """
+    What to do with the OWM response for each location, worked out once per run:
+    the sensors to fill, with their data source and how to extract their values.
+    Applying the plan to a response is then purely transforming data.
+    """
+
+    owm_labels: Dict[str, List[str]]  # per section of the OWM response
+    ingestions: Dict[Tuple[float, float], List[SensorIngestion]] = field(
+        default_factory=dict
+    )
+
+    @property
+    def needs_nowcasts(self) -> bool:
+        """Whether any sensor gets its values from the minutely nowcast (otherwise, we need not ask OWM for it)."""
+        return any(
+            ingestion.owm_section == "minutely"
+            for ingestions in self.ingestions.values()
+            for ingestion in ingestions
+        )
+
+    def make_beliefs(
+        self,
+        location: Tuple[float, float],
+        belief_time: datetime,
+        forecasts: List[Dict],
+        nowcasts: Optional[List[Dict]] = None,
+    ) -> List[BeliefsDataFrame]:
+        """Turn the (hourly) forecasts and (minutely) nowcasts for this location into beliefs for each of its sensors."""
+        fc_frames = {
+            "hourly": decode_forecasts(forecasts, self.owm_labels.get("hourly", []))
+        }
+        if nowcasts:
+            fc_frames["minutely"] = decode_forecasts(
+                nowcasts, self.owm_labels.get("minutely", [])
+            )
+        return self.make_beliefs_from_frames(location, belief_time, fc_frames)
+
+    def make_beliefs_from_frames(
+        self,
+        location: Tuple[float, float],
+        belief_time: datetime,
+        fc_frames: Dict[str, pd.DataFrame],
+    ) -> List[BeliefsDataFrame]:
+        """Like make_beliefs, for forecasts which have already been decoded (see decode_forecasts), per section of the OWM response.
+        Sensors whose section is missing are skipped (e.g. OWM has no nowcast for some locations).
+        """
+        for owm_section, fc_frame in fc_frames.items():
+            for owm_label in self.owm_labels.get(owm_section, []):
+                warn_about_missing_labels(
+                    owm_label,
+                    fc_frame.index[fc_frame[owm_label].isna()],
+                )
+        bdfs = []
+        for ingestion in self.ingestions.get(location, []):
+            fc_frame = fc_frames.get(ingestion.owm_section)
+            if fc_frame is None:
+                continue
+            fc_values = fc_frame[ingestion.owm_label].dropna()
+            if fc_values.empty:
+                continue
+            bdfs.append(
+                make_beliefs(
+                    ingestion.extract(location, fc_values),
+                    ingestion.sensor,
+                    ingestion.source,
+                    belief_time=belief_time,
+                )
+            )
+        return bdfs
+
+    def coalesce(self) -> List[Tuple[float, float]]:
+        """
+        Group locations which would fill the same sensors (e.g. grid points which are all closest to the same weather station),
+        so that we call OWM only once per group. If all sensors of a group are on one weather station, we call for its location.
+        Locations without any sensors are dropped, as there would be nothing to save for them.
+        Returns the locations to call OWM for.
+        """
+        groups: Dict[frozenset, List[Tuple[float, float]]] = {}
+        for location, ingestions in self.ingestions.items():
+            if ingestions:
+                sensors = frozenset(ingestion.sensor for ingestion in ingestions)
+                groups.setdefault(sensors, []).append(location)
+        coalesced: Dict[Tuple[float, float], List[SensorIngestion]] = {}
+        for group_locations in groups.values():
+            ingestions = self.ingestions[group_locations[0]]
+            stations = {ingestion.sensor.generic_asset for ingestion in ingestions}
+            if len(stations) == 1:
+                location = tuple(stations.pop().location)
+            else:
+                location = group_locations[0]
+            known_sensors = [
+                ingestion.sensor for ingestion in coalesced.get(location, [])
+            ]
+            coalesced.setdefault(location, []).extend(
+                ingestion
+                for ingestion in ingestions
+                if ingestion.sensor not in known_sensors
+            )
+        self.ingestions = coalesced
+        return list(coalesced)
+
+
+def compile_ingestion_plan(
+    locations: List[Tuple[float, float]], sensor_index: WeatherSensorIndex
+) -> IngestionPlan:
+    """Resolve data sources once, find the sensors for each location and pick how to extract their values."""
+    data_source = get_or_create_owm_data_source()
+    derived_data_source = get_or_create_owm_data_source_for_derived_data()
+    owm_labels: Dict[str, List[str]] = {}
+    for sensor_specs in mapping:
+        section_labels = owm_labels.setdefault(str(sensor_specs["owm_section"]), [])
+        if sensor_specs["owm_sensor_name"] not in section_labels:
+            section_labels.append(str(sensor_specs["owm_sensor_name"]))
+    plan = IngestionPlan(owm_labels=owm_labels)
+    for location in locations:
+        ingestions = []
+        for sensor_specs in mapping:
+            weather_sensor = get_weather_sensor(sensor_specs, location, sensor_index)
+            if weather_sensor is None:
+                continue
+            sensor_name = str(sensor_specs["fm_sensor_name"])
+            is_derived = sensor_name in DERIVED_DATA_EXTRACTORS
+            ingestions.append(
+                SensorIngestion(
+                    sensor=weather_sensor,
+                    owm_label=str(sensor_specs["owm_sensor_name"]),
+                    source=derived_data_source if is_derived else data_source,
+                    extract=DERIVED_DATA_EXTRACTORS.get(sensor_name, extract_values),
+                    owm_section=str(sensor_specs["owm_section"]),
+                )
+            )
+        plan.ingestions[location] = ingestions
+        if ingestions:
+            click.echo(
+                f"[FLEXMEASURES-OWM] Found pre-configured weather sensors for {location}: {', '.join(ingestion.sensor.name for ingestion in ingestions)}"
+            )
+    return plan
+
+
+def get_weather_sensor(
+    sensor_specs: dict,
+    location: Tuple[float, float],
+    sensor_index: WeatherSensorIndex,
+) -> Sensor | None:
+    """Get the weather sensor for this sensor spec and location, and check that it fits."""
+    sensor_name = str(sensor_specs["fm_sensor_name"])
+    weather_sensor = sensor_index.find(location, sensor_name)
+    if (
+        weather_sensor is not None
+        and weather_sensor.event_resolution != sensor_specs["event_resolution"]
+    ):
+        raise Exception(
+            f"[FLEXMEASURES-OWM] The weather sensor found for {sensor_name} has an unfitting event resolution (should be {sensor_specs['event_resolution']}, but is {weather_sensor.event_resolution}."
+        )
+    return weather_sensor
+
+
+def warn_about_missing_labels(owm_response_label: str, fc_datetimes: pd.Index):
+    for fc_datetime in fc_datetimes:
+        # we will not fail here, but issue a warning
+        msg = "No label '%s' in response data for time %s" % (
+            owm_response_label,
+            fc_datetime,
+        )
+        click.echo("[FLEXMEASURES-OWM] %s" % msg)
+        current_app.logger.warning(msg)
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+from typing import Callable, Iterator
+from contextlib import contextmanager
+from functools import wraps
+import cProfile
+import linecache
+import os
+import tracemalloc
+
+import click
+from flask import current_app
+from flexmeasures.utils.time_utils import server_now
+
+from .filing import make_file_path, RUN_FOLDER_FORMAT
+
+
+MEMORY_REPORT_TOP = 25  # allocation sites to report
+MEMORY_TRACE_FRAMES = 10  # frames to keep per allocation
+
+
+@contextmanager
+def profiling(
+    name: str, profile: bool = False, profile_memory: bool = False
+) -> Iterator[None]:
+    """
+    Profile what happens within this context, into files next to the JSON data (see make_file_path):
+
+    - profile: a cProfile file (profile-<name>-<time>.pstats), to inspect with e.g. pstats or snakeviz.
+    - profile_memory: a tracemalloc report of the top allocation sites and the peak (memory-<name>-<time>.txt).
+    """
+    if not profile and not profile_memory:
+        yield
+        return
+    data_path = make_file_path(current_app, "")
+    run_time = server_now().strftime(RUN_FOLDER_FORMAT)
+    profile_file = os.path.join(data_path, f"profile-{name}-{run_time}.pstats")
+    memory_file = os.path.join(data_path, f"memory-{name}-{run_time}.txt")
+    profiler = cProfile.Profile() if profile else None
+    if profile_memory:
+        tracemalloc.start(MEMORY_TRACE_FRAMES)
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+            click.echo(f"[FLEXMEASURES-OWM] Saved profile to {profile_file}")
+        if profile_memory:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            with open(memory_file, "w") as report_file:
+                report_file.write(make_memory_report(snapshot, peak))
+            click.echo(f"[FLEXMEASURES-OWM] Saved memory report to {memory_file}")
+
+
+def make_memory_report(
+    snapshot: tracemalloc.Snapshot, peak: int, top: int = MEMORY_REPORT_TOP
+) -> str:
+    """Describe the peak of traced memory and the allocation sites which still held the most memory at the end."""
+    snapshot = snapshot.filter_traces(
+        [
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ]
+    )
+    stats = snapshot.statistics("lineno")
+    lines = [
+        f"Peak traced memory: {peak / 2**20:.1f} MiB",
+        f"Traced memory at the end: {sum(stat.size for stat in stats) / 2**20:.1f} MiB",
+        "",
+        f"Top {top} allocation sites (at the end):",
+    ]
+    for i, stat in enumerate(stats[:top], start=1):
+        frame = stat.traceback[0]
+        lines.append(
+            f"#{i}: {frame.filename}:{frame.lineno}: {stat.size / 2**10:.1f} KiB in {stat.count} blocks"
+        )
+        code = linecache.getline(frame.filename, frame.lineno).strip()
+        if code:
+            lines.append(f"    {code}")
+    return "\n".join(lines) + "\n"
+
+
+def profiling_options(name: str) -> Callable:
+    """Add the --profile and --profile-memory options to a CLI command, which then runs within the profiling context."""
+
+    def decorator(func: Callable) -> Callable:
+        @click.option(
+            "--profile",
+            is_flag=True,
+            default=False,
+            help="Profile this command with cProfile, into a .pstats file next to the JSON data.",
+        )
+        @click.option(
+            "--profile-memory",
+            is_flag=True,
+            default=False,
+            help="Trace memory allocations of this command with tracemalloc, into a report next to the JSON data.",
+        )
+        @wraps(func)
+        def wrapper(*args, profile: bool, profile_memory: bool, **kwargs):
+            with profiling(name, profile, profile_memory):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
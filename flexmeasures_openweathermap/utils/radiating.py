@@ -1,7 +1,11 @@
+from typing import Optional, Sequence, Union
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
-from pvlib.location import Location
+
+from flexmeasures_openweathermap import DEFAULT_CLEAR_SKY_CACHE_PRECISION
+from .caching import TTLCache
 
 
 def compute_irradiance(
@@ -14,16 +18,114 @@ def compute_irradiance(
         and Diffuse Horizontal Irradiance (DHI).
     2)  adjust the GHI for cloud coverage
     """
-    site = Location(latitude, longitude, tz=dt.tzinfo)
-    solpos = site.get_solarposition(pd.DatetimeIndex([dt]))
-    ghi_clear = site.get_clearsky(pd.DatetimeIndex([dt]), solar_position=solpos).loc[
-        dt
-    ]["ghi"]
-    return ghi_clear_to_ghi(ghi_clear, cloud_coverage)
+    return float(
+        compute_irradiances([latitude], [longitude], [dt], [cloud_coverage])[0]
+    )
+
+
+def compute_irradiances(
+    latitudes: Sequence[float],
+    longitudes: Sequence[float],
+    datetimes: Sequence[datetime],
+    cloud_coverages: Sequence[float],
+    cache: Optional[TTLCache] = None,
+    precision: int = DEFAULT_CLEAR_SKY_CACHE_PRECISION,
+) -> np.ndarray:
+    """Compute the irradiance received on many locations at many times (see compute_irradiance), in one go.
+    All arguments should have the same length, each position describing one location and time.
+    Clear-sky GHI is computed in one pvlib pass per distinct location (pvlib looks up site data like turbidity per location),
+    and the cloud coverage adjustment is vectorized over all values.
+    If a cache is given, clear-sky GHI is looked up there first (see cached_clear_sky_ghis).
+    """
+    if cache is None:
+        ghi_clear = compute_clear_sky_ghis(latitudes, longitudes, datetimes)
+    else:
+        ghi_clear = cached_clear_sky_ghis(
+            latitudes, longitudes, datetimes, cache, precision
+        )
+    return np.asarray(
+        ghi_clear_to_ghi(ghi_clear, np.asarray(cloud_coverages, dtype=float))
+    )
+
+
+def compute_clear_sky_ghis(
+    latitudes: Sequence[float],
+    longitudes: Sequence[float],
+    datetimes: Sequence[datetime],
+) -> np.ndarray:
+    """Compute clear-sky GHI for many locations and times, with one pvlib pass per distinct location."""
+    # pvlib takes long to import, so only when we need it
+    from pvlib.location import Location
+
+    points = pd.DataFrame(
+        dict(
+            latitude=np.asarray(latitudes, dtype=float),
+            longitude=np.asarray(longitudes, dtype=float),
+            dt=pd.to_datetime(list(datetimes), utc=True),
+        )
+    )
+    ghi_clear = np.empty(len(points))
+    for (latitude, longitude), site_points in points.groupby(
+        ["latitude", "longitude"], sort=False
+    ):
+        site = Location(latitude, longitude, tz="UTC")
+        times = pd.DatetimeIndex(site_points["dt"])
+        solpos = site.get_solarposition(times)
+        ghi_clear[site_points.index] = site.get_clearsky(times, solar_position=solpos)[
+            "ghi"
+        ].to_numpy()
+    return ghi_clear
+
+
+def cached_clear_sky_ghis(
+    latitudes: Sequence[float],
+    longitudes: Sequence[float],
+    datetimes: Sequence[datetime],
+    cache: TTLCache,
+    precision: int = DEFAULT_CLEAR_SKY_CACHE_PRECISION,
+) -> np.ndarray:
+    """Look up clear-sky GHI in the cache, which is keyed by location (rounded to some decimals) and UTC hour (as seconds since the epoch).
+    Values we do not have yet are computed in one batch (for the rounded location and the start of the hour) and cached.
+    """
+    hours = pd.to_datetime(list(datetimes), utc=True).floor("h")
+    keys = [
+        (
+            round(float(latitude), precision),
+            round(float(longitude), precision),
+            int(hour.timestamp()),
+        )
+        for latitude, longitude, hour in zip(latitudes, longitudes, hours)
+    ]
+    ghi_clear = np.array([cache.get(key, np.nan) for key in keys], dtype=float)
+    missing_keys = list(
+        dict.fromkeys(key for key, ghi in zip(keys, ghi_clear) if np.isnan(ghi))
+    )
+    if missing_keys:
+        computed = dict(
+            zip(
+                missing_keys,
+                compute_clear_sky_ghis(
+                    [key[0] for key in missing_keys],
+                    [key[1] for key in missing_keys],
+                    pd.to_datetime(
+                        [key[2] for key in missing_keys], unit="s", utc=True
+                    ),
+                ).tolist(),
+            )
+        )
+        for key, ghi in computed.items():
+            cache.set(key, ghi)
+        for i, key in enumerate(keys):
+            if key in computed:
+                ghi_clear[i] = computed[key]
+    return ghi_clear
 
 
-def ghi_clear_to_ghi(ghi_clear: float, cloud_coverage: float) -> float:
+def ghi_clear_to_ghi(
+    ghi_clear: Union[float, np.ndarray], cloud_coverage: Union[float, np.ndarray]
+) -> Union[float, np.ndarray]:
     """Compute global horizontal irradiance (GHI) from clear-sky GHI, given a cloud coverage between 0 and 1.
+    Works on single values as well as on NumPy arrays.
 
     References
     ----------
@@ -32,6 +134,6 @@ def ghi_clear_to_ghi(ghi_clear: float, cloud_coverage: float) -> float:
     approach based upon the national forecast database. Solar Energy
     81, 809–812.
     """
-    if cloud_coverage < 0 or cloud_coverage > 1:
+    if np.any((np.asarray(cloud_coverage) < 0) | (np.asarray(cloud_coverage) > 1)):
         raise ValueError("cloud_coverage should lie in the interval [0, 1]")
     return (1 - 0.87 * cloud_coverage**1.9) * ghi_clear
@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+from typing import Dict, Iterator, List, Sequence, Set, Tuple
+import csv
+
+import click
+from sqlalchemy import tuple_
+from flexmeasures import Sensor
+from flexmeasures.data import db
+from flexmeasures.data.models.generic_assets import GenericAsset, GenericAssetType
+
+from flexmeasures_openweathermap import WEATHER_STATION_TYPE_NAME
+from .modeling import (
+    get_or_create_weather_station_type,
+    make_weather_station,
+    make_weather_sensor,
+)
+
+
+def read_locations_from_csv(path: str) -> List[Tuple[float, float]]:
+    """Read locations from a CSV file with (at least) a 'latitude' and a 'longitude' column."""
+    with open(path, newline="") as csv_file:
+        reader = csv.DictReader(csv_file)
+        missing_columns = {"latitude", "longitude"} - set(reader.fieldnames or [])
+        if missing_columns:
+            raise Exception(
+                f"[FLEXMEASURES-OWM] {path} is missing the column(s) {', '.join(sorted(missing_columns))}."
+            )
+        locations = []
+        for row in reader:
+            try:
+                locations.append((float(row["latitude"]), float(row["longitude"])))
+            except (TypeError, ValueError):
+                raise Exception(
+                    f"[FLEXMEASURES-OWM] Line {reader.line_num} of {path} does not hold a valid location: {row['latitude']},{row['longitude']}."
+                )
+    return locations
+
+
+def iterate_batches(items: Sequence, batch_size: int) -> Iterator[Sequence]:
+    """Split items into consecutive batches, the last of which may be smaller."""
+    for i in range(0, len(items), batch_size):
+        yield items[i : i + batch_size]
+
+
+def find_weather_stations(
+    locations: Sequence[Tuple[float, float]], batch_size: int
+) -> Dict[Tuple[float, float], GenericAsset]:
+    """Find the existing weather stations at these (exact) locations, with one query per batch of locations."""
+    weather_stations: Dict[Tuple[float, float], GenericAsset] = {}
+    for batch in iterate_batches(locations, batch_size):
+        for weather_station in (
+            GenericAsset.query.join(
+                GenericAssetType,
+                GenericAsset.generic_asset_type_id == GenericAssetType.id,
+            )
+            .filter(
+                GenericAssetType.name == WEATHER_STATION_TYPE_NAME,
+                tuple_(GenericAsset.latitude, GenericAsset.longitude).in_(batch),
+            )
+            .all()
+        ):
+            weather_stations.setdefault(
+                (weather_station.latitude, weather_station.longitude), weather_station
+            )
+    return weather_stations
+
+
+def find_weather_sensor_names(
+    weather_stations: Sequence[GenericAsset], batch_size: int
+) -> Set[Tuple[int, str]]:
+    """Find which sensors these weather stations already have (as pairs of station ID and sensor name), with one query per batch of stations."""
+    existing = set()
+    for batch in iterate_batches(
+        [weather_station.id for weather_station in weather_stations], batch_size
+    ):
+        existing.update(
+            db.session.query(Sensor.generic_asset_id, Sensor.name)
+            .filter(Sensor.generic_asset_id.in_(batch))
+            .all()
+        )
+    return existing
+
+
+def register_weather_sensors(
+    locations: Sequence[Tuple[float, float]],
+    sensor_names: Sequence[str],
+    timezone: str,
+    batch_size: int,
+) -> Dict[str, int]:
+    """
+    Make sure there is a weather station with these sensors at each location.
+    Existing stations and sensors are looked up in batches, and everything new is added to the session
+    (so the caller can commit all of it in one transaction).
+    Returns how many stations and sensors were created, and how many existed already.
+    """
+    locations = list(dict.fromkeys(locations))
+    weather_stations = find_weather_stations(locations, batch_size)
+    existing_sensors = find_weather_sensor_names(
+        list(weather_stations.values()), batch_size
+    )
+    counts = dict(
+        stations_created=0,
+        stations_existing=len(weather_stations),
+        sensors_created=0,
+        sensors_existing=0,
+    )
+
+    new_weather_stations = []
+    weather_station_type = None
+    for location in locations:
+        if location not in weather_stations:
+            if weather_station_type is None:
+                weather_station_type = get_or_create_weather_station_type()
+            weather_stations[location] = make_weather_station(
+                *location, weather_station_type
+            )
+            new_weather_stations.append(weather_stations[location])
+    db.session.add_all(new_weather_stations)
+    counts["stations_created"] = len(new_weather_stations)
+
+    new_sensors = []
+    for location in locations:
+        weather_station = weather_stations[location]
+        for name in sensor_names:
+            if (weather_station.id, name) in existing_sensors:
+                counts["sensors_existing"] += 1
+                continue
+            new_sensors.append(make_weather_sensor(name, weather_station, timezone))
+    db.session.add_all(new_sensors)
+    counts["sensors_created"] = len(new_sensors)
+
+    click.echo(
+        f"[FLEXMEASURES-OWM] {counts['stations_created']} new weather station(s), {counts['stations_existing']} existed already."
+    )
+    click.echo(
+        f"[FLEXMEASURES-OWM] {counts['sensors_created']} new weather sensor(s), {counts['sensors_existing']} existed already."
+    )
+    return counts
@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+from typing import Optional
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
+import re
+import threading
+import time
+
+from flask import Flask, current_app
+import requests
+from requests.adapters import HTTPAdapter
+
+from flexmeasures_openweathermap import (
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_READ_TIMEOUT,
+    DEFAULT_MAX_RETRIES,
+    DEFAULT_BACKOFF_FACTOR,
+    DEFAULT_MAX_BACKOFF,
+    DEFAULT_CONNECTION_POOL_SIZE,
+)
+from .budgeting import (
+    APIKeyPool,
+    CallBudget,
+    PooledKey,
+    get_api_key_pool,
+    get_call_budget,
+)
+from .instrumenting import get_run_metrics
+
+
+# These are worth trying again (too many requests or temporary server trouble)
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# With a pool of API keys, we suspend a key after these (unauthorized or too many requests) and try another one
+SUSPEND_KEY_STATUS_CODES = (401, 429)
+
+# The API key is passed in the query string, so it shows up in URLs (e.g. in the messages of connection errors)
+API_KEY_IN_URL = re.compile(r"(appid=)[^&\s'\"]+")
+
+_client_lock = threading.Lock()
+
+
+class OpenWeatherMapError(Exception):
+    """OpenWeatherMap did not give us a successful response (possibly even after retrying)."""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class OWMClient:
+    """
+    HTTP client for the OpenWeatherMap API, meant to be re-used for many calls.
+    The underlying session keeps connections alive (pooled per host), so we do not pay a new TCP/TLS handshake per call.
+    Failed calls (connection problems, timeouts and the status codes in RETRY_STATUS_CODES) are retried
+    with exponential backoff and full jitter, unless OWM tells us how long to wait (the Retry-After header).
+    If a call budget is given, each attempt is taken from it (OWM counts failed calls, too).
+    If a pool of API keys is given, each attempt is made with a key from the pool (and taken from its budget) instead of with the given key.
+    A key which OWM rejects is then suspended, and we try again right away, with another key.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        read_timeout: float = DEFAULT_READ_TIMEOUT,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+        max_backoff: float = DEFAULT_MAX_BACKOFF,
+        pool_size: int = DEFAULT_CONNECTION_POOL_SIZE,
+        budget: Optional[CallBudget] = None,
+        key_pool: Optional[APIKeyPool] = None,
+    ):
+        self.budget = budget
+        self.key_pool = key_pool
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        # We do the retrying ourselves, so that we can add jitter and honour Retry-After
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, url: str, params: dict) -> requests.Response:
+        """GET the url, retrying if that makes sense. Raises OpenWeatherMapError if we did not succeed."""
+        metrics = get_run_metrics()
+        attempt = 0
+        while True:
+            is_last_attempt = attempt >= self.max_retries
+            with metrics.measure("waiting for budget"):
+                pooled_key = self.acquire_budget()
+            if pooled_key is not None:
+                params = {**params, "appid": pooled_key.value}
+            metrics.increment("api_calls")
+            try:
+                with metrics.measure("http"):
+                    res = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                if is_last_attempt:
+                    raise OpenWeatherMapError(
+                        f"[FLEXMEASURES-OWM] Could not reach OpenWeatherMap after {attempt + 1} attempt(s): {redact_api_key(str(exc))}"
+                    ) from exc
+                wait = self.compute_backoff(attempt)
+            else:
+                if res.status_code == 200:
+                    return res
+                if (
+                    pooled_key is not None
+                    and self.key_pool is not None
+                    and res.status_code in SUSPEND_KEY_STATUS_CODES
+                ):
+                    self.suspend_key(pooled_key, res)
+                    if not is_last_attempt and self.key_pool.has_available_key():
+                        metrics.increment("api_retries")
+                        attempt += 1
+                        continue
+                if res.status_code not in RETRY_STATUS_CODES or is_last_attempt:
+                    raise OpenWeatherMapError(
+                        f"[FLEXMEASURES-OWM] OpenWeatherMap returned status code {res.status_code}: {redact_api_key(res.text)}",
+                        status_code=res.status_code,
+                    )
+                wait = self.compute_backoff(
+                    attempt, retry_after=res.headers.get("Retry-After")
+                )
+            current_app.logger.info(
+                f"[FLEXMEASURES-OWM] Call to OpenWeatherMap failed (attempt {attempt + 1}), trying again in {wait:.1f} seconds ..."
+            )
+            metrics.increment("api_retries")
+            with metrics.measure("backoff"):
+                time.sleep(wait)
+            attempt += 1
+
+    def acquire_budget(self) -> Optional[PooledKey]:
+        """Take this call from our budget (waiting if need be). With a pool of API keys, return the key to use."""
+        if self.key_pool is not None:
+            return self.key_pool.acquire()
+        if self.budget is not None:
+            self.budget.acquire()
+        return None
+
+    def suspend_key(self, pooled_key: PooledKey, res: requests.Response):
+        """Stop using this key for a while, as long as OWM tells us (Retry-After) or otherwise as long as the pool does."""
+        assert self.key_pool is not None, "pooled keys come from our key pool"
+        retry_after = res.headers.get("Retry-After")
+        self.key_pool.suspend(
+            pooled_key,
+            parse_retry_after(retry_after) if retry_after is not None else None,
+        )
+        get_run_metrics().increment("api_key_suspensions")
+        current_app.logger.warning(
+            f"[FLEXMEASURES-OWM] OpenWeatherMap rejected API key {pooled_key.name} (status code {res.status_code}), suspending it ..."
+        )
+
+    def compute_backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Seconds to wait before the next attempt.
+        We honour the Retry-After header (in seconds or as HTTP date), up to max_backoff, otherwise we use exponential backoff with full jitter.
+        """
+        if retry_after is not None:
+            seconds = parse_retry_after(retry_after)
+            if seconds is not None:
+                return min(seconds, self.max_backoff)
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff_factor * 2**attempt)
+        )
+
+
+def redact_api_key(text: str) -> str:
+    """Leave out the API key from a text which may contain the URL we called."""
+    return API_KEY_IN_URL.sub(r"\1<redacted>", text)
+
+
+def parse_retry_after(retry_after: str) -> Optional[float]:
+    """Parse the value of a Retry-After header into seconds (None if we cannot make sense of it)."""
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def get_owm_client(app: Optional[Flask] = None) -> OWMClient:
+    """Get the OWM client for this app, creating it (from the app's settings) on first use."""
+    if app is None:
+        app = current_app._get_current_object()
+    with _client_lock:
+        client = app.extensions.get("flexmeasures-openweathermap-client")
+        if client is None:
+            client = OWMClient(
+                connect_timeout=app.config.get(
+                    "OPENWEATHERMAP_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT
+                ),
+                read_timeout=app.config.get(
+                    "OPENWEATHERMAP_READ_TIMEOUT", DEFAULT_READ_TIMEOUT
+                ),
+                max_retries=app.config.get(
+                    "OPENWEATHERMAP_MAX_RETRIES", DEFAULT_MAX_RETRIES
+                ),
+                backoff_factor=app.config.get(
+                    "OPENWEATHERMAP_BACKOFF_FACTOR", DEFAULT_BACKOFF_FACTOR
+                ),
+                max_backoff=app.config.get(
+                    "OPENWEATHERMAP_MAX_BACKOFF", DEFAULT_MAX_BACKOFF
+                ),
+                pool_size=app.config.get(
+                    "OPENWEATHERMAP_CONNECTION_POOL_SIZE",
+                    DEFAULT_CONNECTION_POOL_SIZE,
+                ),
+                budget=get_call_budget(app),
+                key_pool=get_api_key_pool(app),
+            )
+            app.extensions["flexmeasures-openweathermap-client"] = client
+    return client
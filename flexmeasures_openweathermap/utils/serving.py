@@ -0,0 +1,263 @@
+from __future__ import annotations
+
+from typing import Callable, Iterable, List, Optional, Tuple
+from dataclasses import dataclass, field, fields
+import math
+import signal
+import threading
+import time
+
+import click
+from flask import current_app
+from flexmeasures.data import db
+from flexmeasures.data.transactional import task_with_status_report
+
+from flexmeasures_openweathermap import (
+    DEFAULT_SERVE_INTERVAL,
+    DEFAULT_SERVE_SENSOR_INDEX_TTL,
+)
+from .caching import save_clear_sky_cache
+from .instrumenting import start_run_metrics, export_run_metrics
+from .locating import WeatherSensorIndex, get_locations, get_location_by_asset_id
+from .owm import save_forecasts, load_weather_sensor_index
+
+
+STORE_AS_OPTIONS = ("db", "json", "parquet")
+
+
+@dataclass
+class ScheduledRegion:
+    """A region to get forecasts for every so often (one entry of the OPENWEATHERMAP_SERVE_SCHEDULE setting)."""
+
+    region: str
+    location: Optional[str] = None
+    asset_id: Optional[int] = None
+    num_cells: int = 1
+    method: str = "hex"
+    interval: float = DEFAULT_SERVE_INTERVAL  # seconds
+    store_as: str = "db"
+    max_concurrency: int = 1
+    locations: List[Tuple[float, float]] = field(default_factory=list, repr=False)
+    next_run_at: float = field(default=0.0, repr=False)  # on the clock of the daemon
+
+    def resolve_locations(self) -> List[Tuple[float, float]]:
+        """Find out which locations this region consists of (once, as these do not change while we serve)."""
+        if not self.locations:
+            if self.asset_id is not None:
+                self.locations = [get_location_by_asset_id(self.asset_id)]
+            elif self.location is not None:
+                self.locations = get_locations(
+                    self.location, self.num_cells, self.method
+                )
+            else:
+                raise Exception(
+                    f"[FLEXMEASURES-OWM] Region {self.region} needs a location or an asset_id."
+                )
+        return self.locations
+
+
+def load_schedule(
+    schedule_config: List[dict], regions: Iterable[str] = ()
+) -> List[ScheduledRegion]:
+    """
+    Read the OPENWEATHERMAP_SERVE_SCHEDULE setting, e.g.
+
+        [dict(region="amsterdam", location="52.4,4.8:52.3,5.0", num_cells=4, interval=900)]
+
+    Only keep the given regions, if any.
+    """
+    known_keys = {f.name for f in fields(ScheduledRegion)} - {
+        "locations",
+        "next_run_at",
+    }
+    schedule = []
+    for entry in schedule_config:
+        unknown_keys = set(entry) - known_keys
+        if unknown_keys:
+            raise Exception(
+                f"[FLEXMEASURES-OWM] Unknown key(s) {', '.join(sorted(unknown_keys))} in OPENWEATHERMAP_SERVE_SCHEDULE (known keys: {', '.join(sorted(known_keys))})."
+            )
+        if "region" not in entry:
+            raise Exception(
+                "[FLEXMEASURES-OWM] Each region in OPENWEATHERMAP_SERVE_SCHEDULE needs a name (as 'region')."
+            )
+        scheduled = ScheduledRegion(**entry)
+        if scheduled.location is None and scheduled.asset_id is None:
+            raise Exception(
+                f"[FLEXMEASURES-OWM] Region {scheduled.region} in OPENWEATHERMAP_SERVE_SCHEDULE needs a location or an asset_id."
+            )
+        if scheduled.store_as not in STORE_AS_OPTIONS:
+            raise Exception(
+                f"[FLEXMEASURES-OWM] Region {scheduled.region} in OPENWEATHERMAP_SERVE_SCHEDULE cannot be stored as '{scheduled.store_as}' (choose from {', '.join(STORE_AS_OPTIONS)})."
+            )
+        if scheduled.interval <= 0:
+            raise Exception(
+                f"[FLEXMEASURES-OWM] Region {scheduled.region} in OPENWEATHERMAP_SERVE_SCHEDULE needs a positive interval."
+            )
+        schedule.append(scheduled)
+    regions = set(regions)
+    if regions:
+        unknown_regions = regions - {scheduled.region for scheduled in schedule}
+        if unknown_regions:
+            raise Exception(
+                f"[FLEXMEASURES-OWM] Region(s) {', '.join(sorted(unknown_regions))} not found in OPENWEATHERMAP_SERVE_SCHEDULE."
+            )
+        schedule = [scheduled for scheduled in schedule if scheduled.region in regions]
+    if not schedule:
+        raise Exception(
+            "[FLEXMEASURES-OWM] Nothing to serve, please set up regions in OPENWEATHERMAP_SERVE_SCHEDULE."
+        )
+    return schedule
+
+
+def next_run_time(last_run_at: float, interval: float, now: float) -> float:
+    """
+    When to run next, keeping to the rhythm of the interval.
+    If a run took longer than the interval, we skip the runs we missed (rather than running them back to back).
+    """
+    if now < last_run_at + interval:
+        return last_run_at + interval
+    return last_run_at + (math.floor((now - last_run_at) / interval) + 1) * interval
+
+
+class SensorIndexCache:
+    """Keeps the weather sensor index loaded between runs, and reloads it after some time (to notice new sensors)."""
+
+    def __init__(
+        self,
+        ttl: float,
+        load: Callable[[], WeatherSensorIndex] = load_weather_sensor_index,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl = ttl
+        self.load = load
+        self.clock = clock
+        self.index: Optional[WeatherSensorIndex] = None
+        self.loaded_at = 0.0
+
+    def get(self) -> WeatherSensorIndex:
+        if self.index is None or self.clock() - self.loaded_at >= self.ttl:
+            self.index = self.load()
+            self.loaded_at = self.clock()
+        return self.index
+
+
+class ForecastDaemon:
+    """
+    Runs each scheduled region when it is due, until it is told to stop (see handle_signal).
+    Regions run one after another, so the calls of one region do not compete with those of another for the call budget.
+    """
+
+    def __init__(
+        self,
+        schedule: List[ScheduledRegion],
+        run_region: Callable[[ScheduledRegion], None],
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.schedule = schedule
+        self.run_region = run_region
+        self.clock = clock
+        self.stop_event = threading.Event()
+        now = self.clock()
+        for scheduled in self.schedule:
+            scheduled.next_run_at = now  # start with a run for each region
+
+    def install_signal_handlers(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.handle_signal)
+
+    def handle_signal(self, signum: int, frame=None):
+        """Stop after the current run. If we are asked a second time, stop right away."""
+        if self.stop_event.is_set():
+            raise KeyboardInterrupt
+        click.echo(
+            f"[FLEXMEASURES-OWM] Received {signal.Signals(signum).name}, stopping after the current run (send it again to stop right away) ..."
+        )
+        self.stop_event.set()
+
+    def run_due(self) -> int:
+        """Run all regions which are due. Returns how many ran."""
+        num_runs = 0
+        for scheduled in self.schedule:
+            if self.stop_event.is_set():
+                break
+            if scheduled.next_run_at > self.clock():
+                continue
+            try:
+                self.run_region(scheduled)
+            except Exception as e:
+                click.echo(
+                    f"[FLEXMEASURES-OWM] Getting forecasts for region {scheduled.region} failed: {e}"
+                )
+            num_runs += 1
+            scheduled.next_run_at = next_run_time(
+                scheduled.next_run_at, scheduled.interval, self.clock()
+            )
+        return num_runs
+
+    def seconds_until_next_run(self) -> float:
+        return max(
+            0.0,
+            min(scheduled.next_run_at for scheduled in self.schedule) - self.clock(),
+        )
+
+    def serve(self):
+        while not self.stop_event.is_set():
+            self.run_due()
+            self.stop_event.wait(self.seconds_until_next_run())
+
+
+def run_scheduled_region(
+    scheduled: ScheduledRegion, api_key: str, sensor_index_cache: SensorIndexCache
+):
+    """Get forecasts for one region, with its own metrics and task status (like get-weather-forecasts does)."""
+
+    def get_forecasts():
+        metrics = start_run_metrics(f"serve-{scheduled.region}")
+        try:
+            with metrics.measure("total"):
+                save_forecasts(
+                    api_key,
+                    scheduled.resolve_locations(),
+                    store_as=scheduled.store_as,
+                    region=scheduled.region,
+                    max_concurrency=scheduled.max_concurrency,
+                    sensor_index=sensor_index_cache.get()
+                    if scheduled.store_as == "db"
+                    else None,
+                )
+        finally:
+            export_run_metrics(metrics)
+
+    # keep the cached weather sensors loaded when this run is committed, so the next run can use them as they are
+    db.session().expire_on_commit = False
+    task_with_status_report("get-openweathermap-forecasts")(get_forecasts)()
+
+
+def serve_forecasts(schedule: List[ScheduledRegion], api_key: str):
+    """
+    Keep getting forecasts for the scheduled regions, until we receive SIGTERM or SIGINT.
+    Everything which is expensive to set up stays warm between runs:
+    the app context, the database connection pool, the HTTP session to OpenWeatherMap, the weather sensor index and the clear-sky irradiance cache.
+    """
+    for scheduled in schedule:
+        scheduled.resolve_locations()
+    sensor_index_cache = SensorIndexCache(
+        current_app.config.get(
+            "OPENWEATHERMAP_SERVE_SENSOR_INDEX_TTL", DEFAULT_SERVE_SENSOR_INDEX_TTL
+        )
+    )
+    daemon = ForecastDaemon(
+        schedule,
+        lambda scheduled: run_scheduled_region(scheduled, api_key, sensor_index_cache),
+    )
+    daemon.install_signal_handlers()
+    click.echo(
+        f"[FLEXMEASURES-OWM] Serving forecasts for region(s) {', '.join(scheduled.region for scheduled in schedule)} ..."
+    )
+    try:
+        daemon.serve()
+    finally:
+        save_clear_sky_cache()
+        db.session.remove()
+        click.echo("[FLEXMEASURES-OWM] Stopped serving forecasts.")
@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+from typing import Dict, List, Optional
+
+from flask import current_app
+import pandas as pd
+from sqlalchemy.dialects.postgresql import insert
+from timely_beliefs import BeliefsDataFrame
+from flexmeasures.data import db
+from flexmeasures.data.models.time_series import Sensor, TimedBelief
+
+
+BELIEF_KEY = ["sensor_id", "event_start", "source_id", "cumulative_probability"]
+INSERT_CHUNK_SIZE = 5000  # rows per INSERT statement, keeps us well below the parameter limit of Postgres
+
+
+def save_beliefs_in_bulk(
+    bdfs: List[BeliefsDataFrame],
+) -> Dict[Sensor, Dict[str, int]]:
+    """
+    Save the beliefs of many sensors at once, with a fixed number of queries (independent of the number of sensors):
+
+    1) One query for the latest stored belief per sensor, event and source.
+       New beliefs with the same value are dropped as unchanged (like save_to_db does, but there it is one query per sensor).
+       Values count as the same if they differ by no more than the change tolerance of their sensor (see get_change_tolerance).
+    2) Bulk INSERTs of all remaining beliefs, where beliefs which had already been saved before are skipped (ON CONFLICT DO NOTHING).
+
+    Returns, per sensor, how many beliefs were inserted, skipped (already saved) and unchanged.
+    Like save_to_db, this does not commit.
+    """
+    bdfs = [bdf for bdf in bdfs if not bdf.empty]
+    if not bdfs:
+        return {}
+    db.session.flush()  # make sure new data sources and sensors have IDs
+    sensors = {bdf.sensor.id: bdf.sensor for bdf in bdfs}
+    beliefs = pd.concat([beliefs_to_rows(bdf) for bdf in bdfs], ignore_index=True)
+    counts = {
+        sensor_id: dict(inserted=0, skipped=0, unchanged=0) for sensor_id in sensors
+    }
+
+    # The same belief may occur more than once (e.g. several locations sharing a sensor)
+    duplicated = beliefs.duplicated(subset=BELIEF_KEY + ["belief_horizon"])
+    count_per_sensor(counts, beliefs[duplicated], "skipped")
+    beliefs = beliefs[~duplicated]
+
+    unchanged = find_unchanged_beliefs(
+        beliefs,
+        tolerances={
+            sensor_id: get_change_tolerance(sensor)
+            for sensor_id, sensor in sensors.items()
+        },
+    )
+    count_per_sensor(counts, beliefs[unchanged], "unchanged")
+    beliefs = beliefs[~unchanged]
+
+    records = [
+        dict(
+            event_start=row.event_start.to_pydatetime(),
+            belief_horizon=row.belief_horizon.to_pytimedelta(),
+            cumulative_probability=float(row.cumulative_probability),
+            event_value=float(row.event_value),
+            sensor_id=int(row.sensor_id),
+            source_id=int(row.source_id),
+        )
+        for row in beliefs.itertuples(index=False)
+    ]
+    inserted_sensor_ids: List[int] = []
+    for i in range(0, len(records), INSERT_CHUNK_SIZE):
+        statement = (
+            insert(TimedBelief.__table__)
+            .values(records[i : i + INSERT_CHUNK_SIZE])
+            .on_conflict_do_nothing()
+            .returning(TimedBelief.__table__.c.sensor_id)
+        )
+        inserted_sensor_ids.extend(
+            row[0] for row in db.session.execute(statement).fetchall()
+        )
+    inserted = pd.Series(inserted_sensor_ids, dtype=int).value_counts()
+    attempted = beliefs["sensor_id"].value_counts()
+    for sensor_id in attempted.index:
+        counts[sensor_id]["inserted"] = int(inserted.get(sensor_id, 0))
+        counts[sensor_id]["skipped"] += int(
+            attempted[sensor_id] - inserted.get(sensor_id, 0)
+        )
+    return {sensors[sensor_id]: count for sensor_id, count in counts.items()}
+
+
+def beliefs_to_rows(bdf: BeliefsDataFrame) -> pd.DataFrame:
+    """Flatten a BeliefsDataFrame into rows as stored in the timed_belief table (belief timing as horizon, IDs for sensor and source)."""
+    rows = bdf.convert_index_from_belief_time_to_horizon().reset_index()
+    rows["sensor_id"] = bdf.sensor.id
+    rows["source_id"] = rows["source"].apply(lambda source: source.id)
+    rows["event_start"] = pd.to_datetime(rows["event_start"], utc=True)
+    return rows[BELIEF_KEY + ["belief_horizon", "event_value"]]
+
+
+def get_change_tolerance(sensor: Sensor) -> float:
+    """
+    How much a new value may differ from the latest stored one and still count as unchanged.
+    Set this per sensor (as its owm_change_tolerance attribute) or per sensor name (in the OPENWEATHERMAP_CHANGE_TOLERANCES setting).
+    Defaults to 0, i.e. only equal values are unchanged.
+    """
+    tolerance = sensor.get_attribute("owm_change_tolerance")
+    if tolerance is None:
+        tolerance = current_app.config.get("OPENWEATHERMAP_CHANGE_TOLERANCES", {}).get(
+            sensor.name, 0
+        )
+    return float(tolerance)
+
+
+def find_unchanged_beliefs(
+    beliefs: pd.DataFrame, tolerances: Optional[Dict[int, float]] = None
+) -> pd.Series:
+    """Mark beliefs whose value equals the latest belief stored before (by the same source, about the same event),
+    or differs from it by no more than the tolerance for their sensor (by sensor ID, see compare_to_latest_beliefs).
+    This takes one query, which selects the belief with the shortest horizon per sensor, event and source.
+    """
+    if beliefs.empty:
+        return pd.Series(False, index=beliefs.index)
+    latest_beliefs = pd.DataFrame(
+        (
+            db.session.query(
+                TimedBelief.sensor_id,
+                TimedBelief.event_start,
+                TimedBelief.source_id,
+                TimedBelief.cumulative_probability,
+                TimedBelief.event_value,
+            )
+            .filter(
+                TimedBelief.sensor_id.in_(beliefs["sensor_id"].unique().tolist()),
+                TimedBelief.event_start >= beliefs["event_start"].min(),
+                TimedBelief.event_start <= beliefs["event_start"].max(),
+            )
+            .distinct(*[getattr(TimedBelief, column) for column in BELIEF_KEY])
+            .order_by(
+                *[getattr(TimedBelief, column) for column in BELIEF_KEY],
+                TimedBelief.belief_horizon,
+            )
+            .all()
+        ),
+        columns=BELIEF_KEY + ["latest_event_value"],
+    )
+    return compare_to_latest_beliefs(beliefs, latest_beliefs, tolerances)
+
+
+def compare_to_latest_beliefs(
+    beliefs: pd.DataFrame,
+    latest_beliefs: pd.DataFrame,
+    tolerances: Optional[Dict[int, float]] = None,
+) -> pd.Series:
+    """Mark beliefs whose value lies within the tolerance (by sensor ID, 0 if not given) of the latest stored value (as latest_event_value).
+    As we compare to what is stored, many small changes cannot add up to a large difference without being saved.
+    """
+    if latest_beliefs.empty:
+        return pd.Series(False, index=beliefs.index)
+    latest_beliefs = latest_beliefs.assign(
+        event_start=pd.to_datetime(latest_beliefs["event_start"], utc=True)
+    )
+    compared = beliefs.merge(latest_beliefs, on=BELIEF_KEY, how="left")
+    tolerance = compared["sensor_id"].map(tolerances or {}).fillna(0)
+    return pd.Series(
+        (
+            (compared["event_value"] - compared["latest_event_value"]).abs()
+            <= tolerance
+        ).to_numpy(),
+        index=beliefs.index,
+    )
+
+
+def count_per_sensor(
+    counts: Dict[int, Dict[str, int]], beliefs: pd.DataFrame, outcome: str
+):
+    for sensor_id, count in beliefs["sensor_id"].value_counts().items():
+        counts[sensor_id][outcome] += int(count)
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from flexmeasures_openweathermap.utils.archiving import append_to_archive, read_archive
+
+pytest.importorskip("pyarrow")
+
+
+def make_forecasts(start: datetime, temp: float):
+    return [
+        {
+            "dt": (start + timedelta(hours=h)).timestamp(),
+            "temp": temp + h,
+            "rain": {"1h": 0.5},
+            "weather": [{"id": 500, "main": "Rain"}],
+        }
+        for h in range(3)
+    ]
+
+
+def test_append_to_and_read_archive(tmp_path):
+    day_1 = datetime(2022, 8, 1, 10, tzinfo=timezone.utc)
+    day_2 = day_1 + timedelta(days=1)
+    here, there = (52.0, 4.0), (33.5, 126.0)
+    for run_time, temp in ((day_1, 20), (day_2, 25)):
+        file_path = append_to_archive(
+            str(tmp_path),
+            run_time,
+            [
+                (here, run_time, make_forecasts(run_time, temp)),
+                (there, run_time, make_forecasts(run_time, temp + 10)),
+            ],
+        )
+        assert f"date={run_time:%Y-%m-%d}" in file_path
+    assert len(list(tmp_path.glob("date=*/*.parquet"))) == 2
+
+    everything = read_archive(str(tmp_path))
+    assert everything.num_rows == 12
+
+    forecasts = read_archive(
+        str(tmp_path),
+        locations=[there],
+        start=day_2 - timedelta(hours=1),
+        columns=["event_start", "temp", "rain_1h", "weather"],
+    ).to_pandas()
+    assert forecasts["temp"].tolist() == [35, 36, 37]
+    assert (forecasts["rain_1h"] == 0.5).all()
+    assert '"main":"Rain"' in forecasts["weather"][0]
+    assert forecasts["event_start"][0] == day_2
+    assert read_archive(str(tmp_path), end=day_1 - timedelta(days=1)).num_rows == 0
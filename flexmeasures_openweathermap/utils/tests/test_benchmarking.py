@@ -0,0 +1,49 @@
+from datetime import datetime, timezone
+
+import requests
+
+from flexmeasures_openweathermap.utils.benchmarking import (
+    StubOWMServer,
+    compare_to_baseline,
+    stub_settings,
+)
+from flexmeasures_openweathermap.utils.caching import get_clear_sky_cache
+
+
+def test_stub_server_serves_synthetic_forecasts():
+    with StubOWMServer(hours=48) as server:
+        res = requests.get(
+            f"{server.url}/3.0/onecall", params=dict(lat=52.1, lon=4.3, appid="x")
+        )
+    data = res.json()
+    assert server.num_calls == 1
+    assert (data["lat"], data["lon"]) == (52.1, 4.3)
+    assert len(data["hourly"]) == 48
+    assert data["hourly"][1]["dt"] - data["hourly"][0]["dt"] == 3600
+    assert data["hourly"][0]["dt"] <= datetime.now(timezone.utc).timestamp()
+    assert all(0 <= forecast["clouds"] <= 100 for forecast in data["hourly"])
+    assert len(data["minutely"]) == 60
+
+
+def test_stub_settings_start_with_a_cold_clear_sky_cache(app):
+    warm_cache = get_clear_sky_cache(app)
+    warm_cache.set((52.1, 4.3, 0), 100.0)
+    for _ in range(2):  # e.g. for two benchmark sizes
+        with stub_settings("http://localhost"):
+            cache = get_clear_sky_cache(app)
+            assert cache is not warm_cache
+            assert len(cache) == 0
+            cache.set((52.1, 4.3, 0), 100.0)
+    assert get_clear_sky_cache(app) is warm_cache
+
+
+def test_compare_to_baseline():
+    baseline = [dict(locations=1, wall_time=1.0), dict(locations=100, wall_time=10.0)]
+    results = [
+        dict(locations=1, wall_time=1.1),
+        dict(locations=100, wall_time=13.0),
+        dict(locations=1000, wall_time=100.0),  # no baseline
+    ]
+    regressions = compare_to_baseline(results, baseline, max_regression=0.2)
+    assert len(regressions) == 1
+    assert "For 100 location(s)" in regressions[0]
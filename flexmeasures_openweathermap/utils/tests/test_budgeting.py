@@ -0,0 +1,181 @@
+import pytest
+
+from flexmeasures_openweathermap.utils import budgeting
+from flexmeasures_openweathermap.utils.budgeting import (
+    APIKeyPool,
+    CallBudget,
+    CallBudgetExceeded,
+    PooledKey,
+    get_api_key_pool,
+    get_call_budget,
+    parse_api_keys,
+)
+
+
+def test_call_budget_is_shared_and_refills(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(budgeting.time, "time", lambda: clock[0])
+    path = str(tmp_path / "budget.sqlite")
+
+    budget = CallBudget(path, calls_per_minute=2, calls_per_day=100)
+    budget.acquire()
+    # another run (e.g. in another process) sees the same budget
+    other_budget = CallBudget(path, calls_per_minute=2, calls_per_day=100)
+    other_budget.acquire()
+    assert other_budget.remaining() == {"minute": 0, "day": 98}
+
+    # the minute bucket refills one call every 30 seconds
+    clock[0] += 30
+    assert budget.remaining()["minute"] == pytest.approx(1)
+
+
+def test_call_budget_waits_for_minute_and_refuses_for_day(tmp_path, monkeypatch):
+    clock = [1000.0]
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        clock[0] += seconds
+
+    monkeypatch.setattr(budgeting.time, "time", lambda: clock[0])
+    monkeypatch.setattr(budgeting.time, "sleep", sleep)
+    budget = CallBudget(
+        str(tmp_path / "budget.sqlite"), calls_per_minute=1, calls_per_day=2
+    )
+
+    budget.check(2)
+    with pytest.raises(CallBudgetExceeded):
+        budget.check(3)
+
+    budget.acquire()
+    budget.acquire()  # has to wait for the minute bucket
+    assert waits == [pytest.approx(60)]
+    with pytest.raises(CallBudgetExceeded):
+        budget.acquire()
+
+
+def test_call_budget_counts_calls_per_utc_day(tmp_path, monkeypatch):
+    day = 24 * 60 * 60
+    clock = [100 * day + day - 10]  # ten seconds before midnight (UTC)
+    monkeypatch.setattr(budgeting.time, "time", lambda: clock[0])
+    budget = CallBudget(
+        str(tmp_path / "budget.sqlite"), calls_per_minute=None, calls_per_day=2
+    )
+
+    budget.acquire()
+    budget.acquire()
+    with pytest.raises(CallBudgetExceeded, match="until midnight UTC"):
+        budget.acquire()
+    # OWM starts counting again at midnight, and so do we
+    clock[0] += 10
+    assert budget.remaining() == {"day": 2}
+    budget.acquire()
+    # but not before the next midnight
+    clock[0] += day - 1
+    assert budget.remaining() == {"day": 1}
+
+
+def test_call_budget_is_off_without_file(app, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_CALL_BUDGET_FILE", None)
+    assert get_call_budget(app) is None
+    monkeypatch.setitem(
+        app.config, "OPENWEATHERMAP_CALL_BUDGET_FILE", str(tmp_path / "budget.sqlite")
+    )
+    assert get_call_budget(app).limits == {"minute": 60, "day": 1000}
+    monkeypatch.setitem(
+        app.config,
+        "OPENWEATHERMAP_CALL_BUDGET_FILE",
+        str(tmp_path / "missing-folder" / "budget.sqlite"),
+    )
+    with pytest.raises(Exception, match="Cannot keep the call budget"):
+        get_call_budget(app)
+
+
+def make_key_pool(path: str, calls_per_day: list) -> APIKeyPool:
+    return APIKeyPool(
+        [
+            PooledKey(
+                f"secret-{i}",
+                CallBudget(
+                    path, name=f"key-{i}", calls_per_minute=None, calls_per_day=n
+                ),
+            )
+            for i, n in enumerate(calls_per_day)
+        ],
+        suspension=300,
+    )
+
+
+def test_key_pool_takes_turns_and_skips_used_up_keys(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(budgeting.time, "time", lambda: clock[0])
+    pool = make_key_pool(str(tmp_path / "budget.sqlite"), [1, 3])
+
+    pool.check(4)
+    with pytest.raises(CallBudgetExceeded):
+        pool.check(5)
+    assert [pool.acquire().value for _ in range(4)] == [
+        "secret-0",
+        "secret-1",
+        "secret-1",  # the first key has no calls left today
+        "secret-1",
+    ]
+    with pytest.raises(CallBudgetExceeded, match="all 2 API keys"):
+        pool.acquire()
+
+
+def test_key_pool_suspends_keys(tmp_path, monkeypatch):
+    clock = [1000.0]
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        clock[0] += seconds
+
+    monkeypatch.setattr(budgeting.time, "time", lambda: clock[0])
+    monkeypatch.setattr(budgeting.time, "sleep", sleep)
+    pool = make_key_pool(str(tmp_path / "budget.sqlite"), [100, 100])
+
+    pool.suspend(pool.keys[0])
+    assert [pool.acquire().value for _ in range(2)] == ["secret-1", "secret-1"]
+    pool.suspend(pool.keys[1], 60)
+    assert not pool.has_available_key()
+    # we wait for the first suspension to end
+    assert pool.acquire().value == "secret-1"
+    assert waits == [60]
+
+
+def test_api_key_setting(app, monkeypatch, tmp_path):
+    assert parse_api_keys("secret") == [dict(key="secret")]
+    assert parse_api_keys("") == []
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_API_KEY", "secret")
+    assert get_api_key_pool(app) is None  # one key works as before
+
+    monkeypatch.setitem(
+        app.config,
+        "OPENWEATHERMAP_API_KEY",
+        ["secret-0", dict(key="secret-1", name="paid", calls_per_day=100000)],
+    )
+    monkeypatch.setitem(
+        app.config, "OPENWEATHERMAP_CALL_BUDGET_FILE", str(tmp_path / "budget.sqlite")
+    )
+    pool = get_api_key_pool(app)
+    assert [key.value for key in pool.keys] == ["secret-0", "secret-1"]
+    assert pool.keys[0].name.startswith("key-")
+    assert "secret" not in pool.keys[0].name
+    assert pool.keys[1].name == "paid"
+    assert pool.keys[1].budget.limits["day"] == 100000
+
+
+def test_key_pool_without_call_budget(app, monkeypatch):
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_API_KEY", ["secret-0", "secret-1"])
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_CALL_BUDGET_FILE", None)
+    pool = get_api_key_pool(app)
+    assert [pool.acquire().value for _ in range(3)] == [
+        "secret-0",
+        "secret-1",
+        "secret-0",
+    ]
+    assert pool.remaining() == {}
+    assert "not limited" in pool.report()
+    assert "secret" not in pool.report()
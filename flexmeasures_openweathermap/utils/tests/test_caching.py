@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+from flexmeasures_openweathermap.utils import caching
+from flexmeasures_openweathermap.utils.caching import TTLCache, ResponseCache
+from flexmeasures_openweathermap.utils.radiating import (
+    compute_irradiances,
+    compute_clear_sky_ghis,
+)
+
+
+def test_ttl_cache_evicts_and_expires(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(caching.time, "time", lambda: clock[0])
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # now "b" is the least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert len(cache) == 2
+
+    clock[0] += 61
+    assert cache.get("a", "expired") == "expired"
+
+
+def test_ttl_cache_is_persisted(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = TTLCache(maxsize=10, ttl=60, path=path)
+    cache.set((52.1, 5.1, 1654077600), 500.0)
+    cache.save()
+    assert TTLCache(maxsize=10, ttl=60, path=path).get((52.1, 5.1, 1654077600)) == 500
+
+
+def test_ttl_cache_ignores_unreadable_file(tmp_path):
+    path = tmp_path / "cache.json"
+    path.write_bytes(b"\x80\x04not json")
+    cache = TTLCache(maxsize=10, ttl=60, path=str(path))
+    assert len(cache) == 0
+    cache.set("a", 1)
+    cache.save()
+    assert TTLCache(maxsize=10, ttl=60, path=str(path)).get("a") == 1
+
+
+def test_clear_sky_values_are_cached():
+    start = pytz.utc.localize(datetime(2022, 6, 1, 10))
+    datetimes = [start + timedelta(hours=h) for h in range(3)]
+    cache = TTLCache(maxsize=10, ttl=60)
+
+    irradiances = compute_irradiances(
+        [52.1] * 3, [5.1] * 3, datetimes, [0.5] * 3, cache=cache
+    )
+    assert len(cache) == 3
+    assert irradiances == pytest.approx(
+        compute_irradiances([52.1] * 3, [5.1] * 3, datetimes, [0.5] * 3)
+    )
+
+    # a close-by location, in the same hours, gets the cached clear-sky values
+    ghi_clear = compute_clear_sky_ghis([52.1] * 3, [5.1] * 3, datetimes)
+    cache.set((52.1, 5.1, int(datetimes[0].timestamp())), 0.0)
+    irradiances = compute_irradiances(
+        [52.1001] * 3,
+        [5.0999] * 3,
+        [dt + timedelta(minutes=10) for dt in datetimes],
+        [0, 0, 0],
+        cache=cache,
+    )
+    assert irradiances == pytest.approx([0.0, ghi_clear[1], ghi_clear[2]])
+
+
+def test_response_cache_is_shared_and_expires(tmp_path, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(caching.time, "time", lambda: clock[0])
+    path = str(tmp_path / "responses.sqlite")
+    time_of_call = pytz.utc.localize(datetime(2022, 6, 1, 10, 5))
+    forecasts = [{"dt": 1654077600, "temp": 20}]
+
+    ResponseCache(path, ttl=600, precision=2).set(
+        (52.1234, 5.1), time_of_call, forecasts
+    )
+    # another process, looking for a location which rounds to the same
+    cache = ResponseCache(path, ttl=600, precision=2)
+    assert cache.get((52.1201, 5.1)) == (time_of_call, forecasts)
+    assert cache.get((52.2, 5.1)) is None
+
+    clock[0] += 601
+    assert cache.get((52.1234, 5.1)) is None
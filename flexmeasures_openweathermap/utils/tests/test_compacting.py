@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+
+from flexmeasures_openweathermap.utils.compacting import (
+    iterate_windows,
+    select_beliefs_to_keep,
+)
+
+
+def make_beliefs(horizons_per_event: dict) -> pd.DataFrame:
+    return pd.DataFrame(
+        [
+            dict(
+                sensor_id=1,
+                event_start=pd.Timestamp(event_start),
+                source_id=1,
+                cumulative_probability=0.5,
+                belief_horizon=timedelta(hours=horizon),
+            )
+            for event_start, horizons in horizons_per_event.items()
+            for horizon in horizons
+        ]
+    )
+
+
+def test_select_beliefs_to_keep():
+    first_event = datetime(2022, 8, 1, 12, tzinfo=timezone.utc)
+    second_event = first_event + timedelta(hours=1)
+    beliefs = make_beliefs(
+        {
+            first_event: [0.25, 0.5, 1, 2, 5, 7, 30],
+            second_event: [3, 4, 47],
+        }
+    )
+    keep = select_beliefs_to_keep(
+        beliefs, [timedelta(hours=1), timedelta(hours=6), timedelta(hours=24)]
+    )
+    kept = beliefs[keep].groupby("event_start")["belief_horizon"].apply(list)
+    # the latest belief, and the latest belief made at least 1, 6 and 24 hours ahead
+    assert kept[first_event] == [timedelta(hours=h) for h in (0.25, 1, 7, 30)]
+    # the latest belief doubles as the one made at least 1 hour ahead, and one belief covers both 6 and 24 hours ahead
+    assert kept[second_event] == [timedelta(hours=h) for h in (3, 47)]
+
+
+def test_select_beliefs_to_keep_without_beliefs():
+    assert select_beliefs_to_keep(make_beliefs({}), [timedelta(hours=1)]).empty
+
+
+def test_iterate_windows():
+    start = datetime(2022, 8, 1, tzinfo=timezone.utc)
+    assert list(
+        iterate_windows(start, start + timedelta(hours=60), timedelta(days=1))
+    ) == [
+        (start, start + timedelta(days=1)),
+        (start + timedelta(days=1), start + timedelta(days=2)),
+        (start + timedelta(days=2), start + timedelta(hours=60)),
+    ]
@@ -0,0 +1,18 @@
+import numpy as np
+
+from flexmeasures_openweathermap.utils.decoding import decode_forecasts
+
+
+def test_decode_forecasts(app):
+    forecasts = [
+        {"dt": 1660000000, "temp": 20.5, "clouds": 50, "weather": [{"id": 800}]},
+        {"dt": 1660003600, "temp": 19},
+    ]
+    fc_frame = decode_forecasts(forecasts, ["temp", "clouds", "clouds", "wind_speed"])
+
+    assert list(fc_frame.columns) == ["temp", "clouds", "wind_speed"]
+    assert fc_frame.index[1] - fc_frame.index[0] == np.timedelta64(1, "h")
+    assert fc_frame.index[0].timestamp() == 1660000000
+    assert fc_frame["temp"].tolist() == [20.5, 19]
+    assert np.isnan(fc_frame.loc[fc_frame.index[1], "clouds"])
+    assert fc_frame["wind_speed"].isna().all()
@@ -0,0 +1,103 @@
+import pytest
+from rq.job import JobStatus
+
+from flexmeasures_openweathermap.utils.distributing import get_exc_string, wait_for_jobs
+from flexmeasures_openweathermap.utils.instrumenting import RunMetrics
+
+
+class FakeResult:
+    def __init__(self, exc_string=None):
+        self.exc_string = exc_string
+
+
+class FakeJob:
+    """Goes through the given statuses, one per check. Its error is kept in its latest result, as by rq >= 1.12."""
+
+    def __init__(self, id, statuses, result=None, exc_string=None):
+        self.id = id
+        self.statuses = list(statuses)
+        self.result = result
+        self.exc_string = exc_string
+
+    def get_status(self, refresh=True):
+        if len(self.statuses) > 1:
+            return self.statuses.pop(0)
+        return self.statuses[0]
+
+    def latest_result(self):
+        return FakeResult(self.exc_string)
+
+
+class OldFakeJob:
+    """Keeps its error in exc_info, as before rq 1.12."""
+
+    def __init__(self, id, exc_info=None):
+        self.id = id
+        self.exc_info = exc_info
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+def test_wait_for_jobs_adds_up_counts():
+    clock = FakeClock()
+    metrics = RunMetrics("test")
+    jobs = [
+        FakeJob("a", [JobStatus.FINISHED], result=dict(locations=2, api_calls=1)),
+        FakeJob(
+            "b",
+            [JobStatus.QUEUED, JobStatus.STARTED, JobStatus.FINISHED],
+            result=dict(locations=3, api_calls=2),
+        ),
+    ]
+    counts = wait_for_jobs(
+        jobs, timeout=60, metrics=metrics, clock=clock, sleep=clock.sleep
+    )
+    assert counts == dict(locations=5, api_calls=3)
+    assert metrics.counts == dict(locations=5, api_calls=3, jobs=2, jobs_failed=0)
+    assert clock.now == 2  # we checked three times
+
+
+def test_wait_for_jobs_reports_failed_jobs():
+    metrics = RunMetrics("test")
+    jobs = [
+        FakeJob("a", [JobStatus.FINISHED], result=dict(locations=2)),
+        FakeJob(
+            "b",
+            [JobStatus.FAILED],
+            exc_string="Traceback (most recent call last):\n...\nException: OWM is down\n",
+        ),
+    ]
+    with pytest.raises(
+        Exception, match=r"1 of 2 job\(s\) failed: b \(Exception: OWM is down\)"
+    ):
+        wait_for_jobs(jobs, timeout=60, metrics=metrics, sleep=lambda s: None)
+    assert metrics.counts == dict(locations=2, jobs=2, jobs_failed=1)
+
+
+def test_get_exc_string():
+    assert get_exc_string(FakeJob("a", [JobStatus.FAILED], exc_string="E")) == "E"
+    assert get_exc_string(FakeJob("a", [JobStatus.FAILED])) == "no error info"
+    assert get_exc_string(OldFakeJob("a", exc_info="E")) == "E"
+    assert get_exc_string(OldFakeJob("a")) == "no error info"
+
+
+def test_wait_for_jobs_times_out():
+    clock = FakeClock()
+    jobs = [FakeJob("a", [JobStatus.QUEUED])]
+    with pytest.raises(Exception, match="not done after 10 seconds"):
+        wait_for_jobs(
+            jobs,
+            timeout=10,
+            metrics=RunMetrics("test"),
+            clock=clock,
+            sleep=clock.sleep,
+        )
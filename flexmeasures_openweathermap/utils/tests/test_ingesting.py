@@ -0,0 +1,20 @@
+from datetime import datetime, timedelta
+
+from flexmeasures_openweathermap.utils import ingesting
+
+
+def test_save_beliefs_per_run(monkeypatch):
+    """Runs are saved one by one, earliest first, and their counts are added up per sensor."""
+    saved_runs = []
+
+    def mock_save_beliefs_in_bulk(bdfs):
+        saved_runs.append(bdfs)
+        return {"wind speed": dict(inserted=len(bdfs), skipped=0, unchanged=1)}
+
+    monkeypatch.setattr(ingesting, "save_beliefs_in_bulk", mock_save_beliefs_in_bulk)
+    first_run = datetime(2024, 1, 1, 12)
+    counts = ingesting.save_beliefs_per_run(
+        {first_run + timedelta(hours=1): ["b", "c"], first_run: ["a"]}
+    )
+    assert saved_runs == [["a"], ["b", "c"]]
+    assert counts == {"wind speed": dict(inserted=3, skipped=0, unchanged=2)}
@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from flexmeasures_openweathermap.utils.instrumenting import (
+    RunMetrics,
+    end_run_metrics,
+    export_run_metrics,
+    get_run_metrics,
+    start_run_metrics,
+)
+
+
+def test_run_metrics_add_up_over_threads():
+    metrics = RunMetrics("test")
+
+    def call():
+        with metrics.measure("http"):
+            metrics.increment("api_calls")
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for _ in range(100):
+            executor.submit(call)
+    assert metrics.counts["api_calls"] == 100
+    assert metrics.durations["http"] > 0
+
+    items = list(metrics.measure_iteration(iter(range(3)), "fetching"))
+    assert items == [0, 1, 2]
+    assert "fetching" in metrics.durations
+
+
+def test_prometheus_text_format():
+    metrics = RunMetrics('get "forecasts"')
+    metrics.add_duration("saving", 1.5)
+    metrics.increment("rows_inserted", 96)
+    text = metrics.to_prometheus()
+    assert "# TYPE flexmeasures_owm_phase_duration_seconds gauge" in text
+    assert (
+        'flexmeasures_owm_phase_duration_seconds{run="get \\"forecasts\\"",phase="saving"} 1.5'
+        in text
+    )
+    assert (
+        'flexmeasures_owm_run_count{run="get \\"forecasts\\"",counter="rows_inserted"} 96'
+        in text
+    )
+    assert text.endswith("\n")
+
+
+def test_export_run_metrics(app, monkeypatch, tmp_path, caplog):
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_METRICS_DIR", str(tmp_path))
+    metrics = start_run_metrics("test-run")
+    assert get_run_metrics() is metrics
+    get_run_metrics().increment("api_calls", 3)
+
+    with caplog.at_level(logging.INFO):
+        export_run_metrics(metrics)
+    logged = json.loads(
+        [
+            r.getMessage()
+            for r in caplog.records
+            if "flexmeasures-owm-run" in r.getMessage()
+        ][0]
+    )
+    assert logged["run"] == "test-run"
+    assert logged["counts"] == {"api_calls": 3}
+    assert 'counter="api_calls"} 3' in (tmp_path / "test-run.prom").read_text()
+    assert os.listdir(tmp_path) == ["test-run.prom"]
+    # the run has ended, so later calls get throwaway metrics
+    assert get_run_metrics() is not metrics
+
+
+def test_nested_run_metrics(app):
+    """When an inner run (e.g. a job running in the enqueuing process) ends, the outer run collects again."""
+    outer = start_run_metrics("outer")
+    inner = start_run_metrics("inner")
+    get_run_metrics().increment("api_calls")
+    end_run_metrics(inner)
+    get_run_metrics().increment("api_calls", 2)
+    end_run_metrics(outer)
+    get_run_metrics().increment("api_calls", 4)
+    assert inner.counts == {"api_calls": 1}
+    assert outer.counts == {"api_calls": 2}
+
+
+def test_export_run_metrics_per_run(app, monkeypatch, tmp_path):
+    """Runs with different names (e.g. serving different regions) do not overwrite each other's metrics."""
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_METRICS_DIR", str(tmp_path))
+    for region, n in (("north", 1), ("south/west", 2)):
+        metrics = start_run_metrics(f"serve-{region}")
+        metrics.increment("api_calls", n)
+        export_run_metrics(metrics)
+    assert sorted(os.listdir(tmp_path)) == ["serve-north.prom", "serve-south_west.prom"]
+    assert 'counter="api_calls"} 1' in (tmp_path / "serve-north.prom").read_text()
+    assert 'counter="api_calls"} 2' in (tmp_path / "serve-south_west.prom").read_text()
@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+
+from flexmeasures_openweathermap.utils.locating import (
+    WeatherSensorIndex,
+    coalesce_locations,
+    find_weather_sensor_by_location,
+)
+
+
+def make_sensor(name: str, latitude: float, longitude: float) -> SimpleNamespace:
+    station = SimpleNamespace(
+        latitude=latitude, longitude=longitude, location=(latitude, longitude)
+    )
+    return SimpleNamespace(name=name, generic_asset=station)
+
+
+def test_weather_sensor_index_finds_closest_sensor(app):
+    sensors = [
+        make_sensor("temperature", 52.0, 4.0),
+        make_sensor("temperature", 52.9, 4.9),
+        make_sensor("temperature", 53.1, 5.1),  # in the neighbouring grid cell
+        make_sensor("wind speed", 52.0, 4.0),
+    ]
+    index = WeatherSensorIndex(sensors, 1)
+
+    assert index.find((53.05, 5.05), "temperature") is sensors[2]
+    assert index.find((52.2, 4.2), "temperature") is sensors[0]
+    assert index.find((52.2, 4.2), "wind speed") is sensors[3]
+    assert index.find((52.2, 4.2), "irradiance") is None
+
+
+def test_weather_sensor_index_warns_about_distant_sensors(app, caplog):
+    index = WeatherSensorIndex([make_sensor("temperature", 52.0, 4.0)], 1)
+
+    assert index.find((52.0, 6.0), "temperature") is None
+    assert "no sufficiently close weather sensor found" in caplog.text
+
+
+def test_weather_sensor_index_loads_weather_sensors(app, add_weather_sensors_fresh_db):
+    wind_sensor = add_weather_sensors_fresh_db["wind"]
+    index = WeatherSensorIndex.load(1)
+
+    assert index.find((33.5, 126.5), "wind speed") == wind_sensor
+    assert index.find((33.5, 126.5), "temperature") is not None
+    assert index.find((36.5, 126), "wind speed") is None
+
+
+def test_find_weather_sensor_by_location(app, add_weather_sensors_fresh_db):
+    """The one-off lookup finds the same sensors as the index does."""
+    wind_sensor = add_weather_sensors_fresh_db["wind"]
+
+    found = find_weather_sensor_by_location((33.5, 126.5), 1, "wind speed")
+    assert found == wind_sensor
+    assert find_weather_sensor_by_location((36.5, 126), 1, "wind speed") is None
+
+
+def test_coalesce_locations():
+    locations = [(52.01, 4.01), (52.04, 3.98), (52.26, 4.0), (52.01, 4.01)]
+    assert coalesce_locations(locations, 0.25) == [(52.0, 4.0), (52.25, 4.0)]
@@ -0,0 +1,26 @@
+import pstats
+
+from flexmeasures_openweathermap.utils.profiling import profiling
+
+
+def test_profiling(app, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_FILE_PATH_LOCATION", str(tmp_path))
+    with profiling("test", profile=True, profile_memory=True):
+        blocks = [bytearray(1024) for _ in range(1000)]  # noqa: F841
+
+    profile_files = list(tmp_path.glob("profile-test-*.pstats"))
+    assert len(profile_files) == 1
+    assert pstats.Stats(str(profile_files[0])).total_calls > 0
+
+    memory_files = list(tmp_path.glob("memory-test-*.txt"))
+    assert len(memory_files) == 1
+    report = memory_files[0].read_text()
+    assert report.startswith("Peak traced memory:")
+    assert "bytearray(1024)" in report
+
+
+def test_no_profiling(app, monkeypatch, tmp_path):
+    monkeypatch.setitem(app.config, "OPENWEATHERMAP_FILE_PATH_LOCATION", str(tmp_path))
+    with profiling("test"):
+        pass
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+import pytz
+from pvlib.location import Location
+
+from flexmeasures_openweathermap.utils.radiating import (
+    compute_irradiance,
+    compute_irradiances,
+    ghi_clear_to_ghi,
+)
+
+
+def irradiance_per_point(
+    latitude: float, longitude: float, dt: datetime, cloud_coverage: float
+) -> float:
+    """Irradiance as computed one point at a time, straight from pvlib (independent of the vectorized code)."""
+    site = Location(latitude, longitude, tz=dt.tzinfo)
+    times = pd.DatetimeIndex([dt])
+    solpos = site.get_solarposition(times)
+    ghi_clear = site.get_clearsky(times, solar_position=solpos)["ghi"].iloc[0]
+    return (1 - 0.87 * cloud_coverage**1.9) * ghi_clear
+
+
+def test_batch_irradiance_matches_single_computations():
+    start = pytz.timezone("Europe/Amsterdam").localize(datetime(2022, 6, 1))
+    datetimes = [start + timedelta(hours=h) for h in range(24)] * 2
+    latitudes = [52.1] * 24 + [33.4] * 24
+    longitudes = [5.1] * 24 + [126] * 24
+    cloud_coverages = np.linspace(0, 1, 48)
+
+    irradiances = compute_irradiances(latitudes, longitudes, datetimes, cloud_coverages)
+    assert irradiances.shape == (48,)
+    expected = [
+        irradiance_per_point(
+            latitudes[i], longitudes[i], datetimes[i], cloud_coverages[i]
+        )
+        for i in range(48)
+    ]
+    assert irradiances == pytest.approx(expected)
+    assert max(expected) > 100  # we also compare daylight values
+    assert compute_irradiance(
+        latitudes[12], longitudes[12], datetimes[12], cloud_coverages[12]
+    ) == pytest.approx(expected[12])
+
+
+def test_ghi_clear_to_ghi_on_arrays():
+    ghi = ghi_clear_to_ghi(np.array([100.0, 100.0]), np.array([0, 1]))
+    assert ghi == pytest.approx([100, 13])
+    with pytest.raises(ValueError):
+        ghi_clear_to_ghi(np.array([100.0, 100.0]), np.array([0.5, 1.2]))
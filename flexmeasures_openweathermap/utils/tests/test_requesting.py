@@ -0,0 +1,143 @@
+from typing import Optional
+
+import pytest
+import requests
+
+from flexmeasures_openweathermap.utils import requesting
+from flexmeasures_openweathermap.utils.budgeting import (
+    APIKeyPool,
+    CallBudget,
+    PooledKey,
+)
+from flexmeasures_openweathermap.utils.requesting import (
+    OWMClient,
+    OpenWeatherMapError,
+    parse_retry_after,
+    redact_api_key,
+)
+
+
+class MockResponse:
+    def __init__(self, status_code: int, headers: Optional[dict] = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = f"mock response with status {status_code}"
+
+
+def mock_session_get(responses: list, calls: list, keys: Optional[list] = None):
+    def get(url, params, timeout):
+        calls.append(timeout)
+        if keys is not None:
+            keys.append(params.get("appid"))
+        return responses.pop(0)
+
+    return get
+
+
+def test_client_retries_after_too_many_requests(app, monkeypatch):
+    client = OWMClient(connect_timeout=1, read_timeout=2, max_retries=2)
+    calls, waits = [], []
+    responses = [MockResponse(429, {"Retry-After": "7"}), MockResponse(200)]
+    monkeypatch.setattr(client.session, "get", mock_session_get(responses, calls))
+    monkeypatch.setattr(requesting.time, "sleep", waits.append)
+
+    res = client.get("https://owm.test", params={})
+    assert res.status_code == 200
+    assert calls == [(1, 2), (1, 2)]
+    assert waits == [7]  # Retry-After is honoured
+
+
+def test_client_gives_up(app, monkeypatch):
+    client = OWMClient(max_retries=1, backoff_factor=1, max_backoff=10)
+    calls, waits = [], []
+    responses = [MockResponse(503), MockResponse(503)]
+    monkeypatch.setattr(client.session, "get", mock_session_get(responses, calls))
+    monkeypatch.setattr(requesting.time, "sleep", waits.append)
+
+    with pytest.raises(OpenWeatherMapError) as exc_info:
+        client.get("https://owm.test", params={})
+    assert exc_info.value.status_code == 503
+    assert len(calls) == 2
+    assert 0 <= waits[0] <= 1  # jittered backoff of the first attempt
+
+
+def test_client_does_not_retry_unauthorized(app, monkeypatch):
+    client = OWMClient(max_retries=3)
+    calls = []
+    monkeypatch.setattr(
+        client.session, "get", mock_session_get([MockResponse(401)], calls)
+    )
+
+    with pytest.raises(OpenWeatherMapError) as exc_info:
+        client.get("https://owm.test", params={})
+    assert exc_info.value.status_code == 401
+    assert len(calls) == 1
+
+
+def test_client_switches_key_after_rejection(app, monkeypatch, tmp_path):
+    key_pool = APIKeyPool(
+        [
+            PooledKey(
+                f"secret-{i}",
+                CallBudget(str(tmp_path / "budget.sqlite"), name=f"key-{i}"),
+            )
+            for i in range(2)
+        ]
+    )
+    client = OWMClient(max_retries=3, key_pool=key_pool)
+    calls, keys, waits = [], [], []
+    responses = [MockResponse(401), MockResponse(200), MockResponse(200)]
+    monkeypatch.setattr(client.session, "get", mock_session_get(responses, calls, keys))
+    monkeypatch.setattr(requesting.time, "sleep", waits.append)
+
+    assert (
+        client.get("https://owm.test", params={"appid": "ignored"}).status_code == 200
+    )
+    assert (
+        client.get("https://owm.test", params={"appid": "ignored"}).status_code == 200
+    )
+    # the first key was rejected, so we switched to the second one right away, and kept using it
+    assert keys == ["secret-0", "secret-1", "secret-1"]
+    assert waits == []
+    assert key_pool.keys[0].suspended_until > requesting.time.time()
+
+
+@pytest.mark.parametrize(
+    "retry_after, expected_seconds",
+    [("12", 12), ("-3", 0), ("Wed, 21 Oct 2015 07:28:00 GMT", 0), ("soon", None)],
+)
+def test_parse_retry_after(retry_after, expected_seconds):
+    assert parse_retry_after(retry_after) == expected_seconds
+
+
+def test_client_caps_retry_after(app, monkeypatch):
+    client = OWMClient(max_retries=1, max_backoff=30)
+    calls, waits = [], []
+    responses = [MockResponse(429, {"Retry-After": "7200"}), MockResponse(200)]
+    monkeypatch.setattr(client.session, "get", mock_session_get(responses, calls))
+    monkeypatch.setattr(requesting.time, "sleep", waits.append)
+
+    client.get("https://owm.test", params={})
+    assert waits == [30]
+
+
+def test_client_keeps_api_key_out_of_errors(app, monkeypatch):
+    client = OWMClient(max_retries=0)
+
+    def get(url, params, timeout):
+        raise requests.ConnectionError(
+            f"HTTPSConnectionPool: Max retries exceeded with url: /data?lat=52&lon=4&appid={params['appid']}&units=metric"
+        )
+
+    monkeypatch.setattr(client.session, "get", get)
+    with pytest.raises(OpenWeatherMapError) as exc_info:
+        client.get("https://owm.test", params=dict(appid="secret-key"))
+    assert "secret-key" not in str(exc_info.value)
+    assert "appid=<redacted>&units=metric" in str(exc_info.value)
+
+
+def test_redact_api_key():
+    assert (
+        redact_api_key("https://owm.test/onecall?lat=52&appid=abc123")
+        == "https://owm.test/onecall?lat=52&appid=<redacted>"
+    )
@@ -0,0 +1,120 @@
+import signal
+
+import pytest
+
+from flexmeasures_openweathermap.utils.serving import (
+    ForecastDaemon,
+    ScheduledRegion,
+    SensorIndexCache,
+    load_schedule,
+    next_run_time,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_load_schedule():
+    schedule = load_schedule(
+        [
+            dict(region="amsterdam", location="52.4,4.8:52.3,5.0", num_cells=4),
+            dict(region="station", asset_id=3, interval=900, store_as="parquet"),
+        ],
+        regions=["station"],
+    )
+    assert schedule == [
+        ScheduledRegion(region="station", asset_id=3, interval=900, store_as="parquet")
+    ]
+
+
+@pytest.mark.parametrize(
+    "entry, expected_msg",
+    [
+        (dict(region="a", location="52,4", every=60), "Unknown key.* every"),
+        (dict(location="52,4"), "needs a name"),
+        (dict(region="a"), "needs a location or an asset_id"),
+        (dict(region="a", location="52,4", store_as="csv"), "cannot be stored as"),
+        (dict(region="a", location="52,4", interval=0), "positive interval"),
+    ],
+)
+def test_load_invalid_schedule(entry, expected_msg):
+    with pytest.raises(Exception, match=expected_msg):
+        load_schedule([entry])
+
+
+def test_next_run_time_keeps_rhythm():
+    assert next_run_time(0, 900, now=30) == 900
+    # a run which took longer than the interval skips the runs it missed
+    assert next_run_time(0, 900, now=2000) == 2700
+
+
+def test_daemon_runs_regions_when_due():
+    clock = FakeClock()
+    schedule = [
+        ScheduledRegion(region="often", location="52,4", interval=60),
+        ScheduledRegion(region="seldom", location="52,4", interval=3600),
+    ]
+    runs = []
+    daemon = ForecastDaemon(
+        schedule, lambda scheduled: runs.append(scheduled.region), clock=clock
+    )
+
+    assert daemon.run_due() == 2  # each region runs right away
+    assert daemon.seconds_until_next_run() == 60
+    clock.now += 30
+    assert daemon.run_due() == 0
+    clock.now += 30
+    assert daemon.run_due() == 1
+    assert runs == ["often", "seldom", "often"]
+
+
+def test_daemon_carries_on_after_failed_run():
+    def run_region(scheduled):
+        raise ValueError("OWM is down")
+
+    daemon = ForecastDaemon(
+        [ScheduledRegion(region="a", location="52,4", interval=60)],
+        run_region,
+        clock=FakeClock(),
+    )
+    assert daemon.run_due() == 1
+    assert daemon.seconds_until_next_run() == 60
+
+
+def test_daemon_stops_gracefully_on_signal():
+    runs = []
+    daemon = ForecastDaemon(
+        [ScheduledRegion(region="a", location="52,4", interval=3600)],
+        lambda scheduled: runs.append(scheduled.region),
+    )
+
+    # the signal arrives during the first run, which is completed before we stop
+    def run_region(scheduled):
+        runs.append(scheduled.region)
+        daemon.handle_signal(signal.SIGTERM)
+
+    daemon.run_region = run_region
+    daemon.serve()  # returns right away, instead of waiting an hour for the next run
+    assert runs == ["a"]
+
+    with pytest.raises(KeyboardInterrupt):
+        daemon.handle_signal(signal.SIGINT)
+
+
+def test_sensor_index_cache_reloads_after_ttl():
+    clock = FakeClock()
+    loads = []
+    cache = SensorIndexCache(
+        ttl=600, load=lambda: loads.append(clock.now) or len(loads), clock=clock
+    )
+    assert cache.get() == 1
+    clock.now += 599
+    assert cache.get() == 1
+    clock.now += 1
+    assert cache.get() == 2
+    assert len(loads) == 2
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+
+from flexmeasures_openweathermap.utils.storing import (
+    BELIEF_KEY,
+    compare_to_latest_beliefs,
+)
+
+
+def make_beliefs(values: dict) -> pd.DataFrame:
+    """Beliefs for sensors 1 and 2, about the same event, with the given values (by sensor ID)."""
+    event_start = pd.Timestamp(datetime(2022, 8, 1, 12, tzinfo=timezone.utc))
+    return pd.DataFrame(
+        [
+            dict(
+                sensor_id=sensor_id,
+                event_start=event_start,
+                source_id=1,
+                cumulative_probability=0.5,
+                belief_horizon=timedelta(hours=1),
+                event_value=value,
+            )
+            for sensor_id, value in values.items()
+        ]
+    )
+
+
+def test_compare_to_latest_beliefs_with_tolerance():
+    beliefs = make_beliefs({1: 20.05, 2: 5.3})
+    latest_beliefs = make_beliefs({1: 20.0, 2: 5.0}).rename(
+        columns={"event_value": "latest_event_value"}
+    )[BELIEF_KEY + ["latest_event_value"]]
+
+    # without tolerance, only equal values are unchanged
+    assert compare_to_latest_beliefs(beliefs, latest_beliefs).tolist() == [
+        False,
+        False,
+    ]
+    # sensor 1 changed within its tolerance, sensor 2 did not
+    assert compare_to_latest_beliefs(
+        beliefs, latest_beliefs, tolerances={1: 0.1, 2: 0.1}
+    ).tolist() == [True, False]
+
+
+def test_compare_to_latest_beliefs_without_stored_beliefs():
+    beliefs = make_beliefs({1: 20.0})
+    latest_beliefs = pd.DataFrame(columns=BELIEF_KEY + ["latest_event_value"])
+    assert compare_to_latest_beliefs(beliefs, latest_beliefs, {1: 1}).tolist() == [
+        False
+    ]